@@ -1,5 +1,4 @@
-async function refresh(){
-  const d = await API.getDashboard();
+function render(d){
   const cur = d.current ?
     `#${d.current.queue_id} — ${d.current.patient_name} → ${d.current.room} (${d.current.status})`
     : '—';
@@ -9,5 +8,22 @@ async function refresh(){
   const lines = (d.logs||[]).map(x=>`[${x.ts}] q=${x.queue_id||'-'} ${x.event} ${x.message||''}`);
   document.getElementById('logs').textContent = lines.join('\n');
 }
-refresh();
-setInterval(refresh, 1500);
+async function refresh(){
+  render(await API.getDashboard());
+}
+
+// push stream (python -m server.asgi); falls back to polling on the Flask dev server
+let timer = null;
+function startPolling(){
+  if (timer) return;
+  refresh();
+  timer = setInterval(refresh, 1500);
+}
+if (window.EventSource){
+  const es = new EventSource('/api/stream');
+  es.addEventListener('dashboard', e => render(JSON.parse(e.data)));
+  es.onerror = () => { if (es.readyState === EventSource.CLOSED) startPolling(); };
+  setTimeout(() => { if (es.readyState !== EventSource.OPEN){ es.close(); startPolling(); } }, 3000);
+} else {
+  startPolling();
+}
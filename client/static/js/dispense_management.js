@@ -6,7 +6,8 @@ let ITEMS = []; // [{pill_id,name,type,amount,quantity}]
 
 // ---- API calls used here ----
 const API = {
-  lookup:    () => fetch('/api/lookup').then(r=>r.json()),
+  lookup:    () => fetch('/api/lookup?patients=0').then(r=>r.json()),
+  patients:  (q) => fetch(`/api/patients?limit=50&q=${encodeURIComponent(q||'')}`).then(r=>r.json()),
   addQueue:  (payload) => fetch('/api/queues',{method:'POST',headers:{'Content-Type':'application/json'},body:JSON.stringify(payload)}).then(r=>r.json()),
   // stock management:
   listPills: () => fetch('/api/pills').then(r=>r.json()),
@@ -80,10 +81,31 @@ async function renderStock(){
 }
 
 // ---- Fill selects ----
+function fillPatients(){
+  const sel = Q('#patient'); const keep = sel.value;
+  sel.innerHTML = LOOKUP.patients
+    .map(p=>`<option value="${p.id}">${p.name}</option>`).join('');
+  if(keep && LOOKUP.patients.some(p=>String(p.id)===keep)) sel.value = keep;
+}
+
+// typeahead: only the 50 newest matches are loaded, never the whole table
+let patientTimer = null;
+async function searchPatients(q){
+  try{
+    LOOKUP.patients = (await API.patients(q)).items || [];
+  }catch(e){
+    LOOKUP.patients = [];
+  }
+  fillPatients();
+}
+Q('#patientSearch').oninput = e=>{
+  clearTimeout(patientTimer);
+  patientTimer = setTimeout(()=>searchPatients(e.target.value.trim()), 200);
+};
+
 function fillSelects(){
   // patients
-  Q('#patient').innerHTML = LOOKUP.patients
-    .map(p=>`<option value="${p.id}">${p.name}</option>`).join('');
+  fillPatients();
   // pills (show amount & unit)
   Q('#pill').innerHTML = LOOKUP.pills
     .map(p=>`<option value="${p.id}" data-type="${p.type}" data-name="${p.name}" data-amount="${p.amount}">
@@ -99,6 +121,7 @@ async function init(){
     Q('#msg').innerHTML = '<span class="danger">โหลดข้อมูลล้มเหลว /api/lookup</span>';
     return;
   }
+  await searchPatients('');
   fillSelects();
   renderItems();
   await renderStock();
@@ -30,6 +30,7 @@ CREATE TABLE IF NOT EXISTS queues(
   served_at DATETIME,
   note TEXT, -- หมายเหตุ/ข้อผิดพลาด หรือข้อความจาก vision (nullable)
   failed_reason TEXT, -- reason for failure (timeout, node1:timeout, etc.)
+  line_id INTEGER, -- สายจ่ายยาที่รับคิวนี้ (server/lines.py), set when dispatched
   FOREIGN KEY(patient_id) REFERENCES patients(id),
   FOREIGN KEY(target_room) REFERENCES rooms(id)
 );
@@ -53,6 +54,36 @@ CREATE TABLE IF NOT EXISTS events(
   FOREIGN KEY(queue_id) REFERENCES queues(id)
 );
 
+-- Completion join state per dispatched queue (server/completion.py)
+-- bit i = i-th participant of the line: its nodes in order, then vision when required
+CREATE TABLE IF NOT EXISTS queue_completion (
+  queue_id INTEGER PRIMARY KEY,
+  line_id INTEGER NOT NULL,
+  required INTEGER NOT NULL,
+  done INTEGER NOT NULL DEFAULT 0,
+  failed INTEGER NOT NULL DEFAULT 0,
+  updated_at REAL
+);
+
+-- Dispatch command outbox (server/outbox.py): written in the same transaction that
+-- reserves the queue, published by a background thread, marked on PUBACK / node ack
+CREATE TABLE IF NOT EXISTS outbox (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  queue_id INTEGER,
+  node_id INTEGER,
+  topic TEXT NOT NULL,
+  payload TEXT NOT NULL,
+  qos INTEGER NOT NULL DEFAULT 1,
+  status TEXT NOT NULL DEFAULT 'pending',   -- pending|sent|delivered|dropped
+  attempts INTEGER NOT NULL DEFAULT 0,
+  next_attempt REAL NOT NULL DEFAULT 0,      -- unix time the row is due (again)
+  created_at REAL NOT NULL,
+  sent_at REAL,
+  delivered_at REAL
+);
+CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox(next_attempt) WHERE status IN ('pending','sent');
+CREATE INDEX IF NOT EXISTS idx_outbox_queue ON outbox(queue_id, node_id);
+
 -- Node status tracking for DB-based readiness
 CREATE TABLE IF NOT EXISTS node_status (
   node_id INTEGER PRIMARY KEY,
@@ -64,6 +95,76 @@ CREATE TABLE IF NOT EXISTS node_status (
   last_online_change DATETIME
 );
 
+-- High-resolution lifecycle spans per queue (see server/tracing.py)
+CREATE TABLE IF NOT EXISTS queue_trace (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  queue_id INTEGER NOT NULL,
+  stage TEXT NOT NULL,   -- created|reserved|published|acked_node{n}|done_node{n}|vision_finalized|served|failed
+  node_id INTEGER,
+  ts REAL NOT NULL       -- unix time (seconds, float)
+);
+CREATE INDEX IF NOT EXISTS idx_queue_trace_queue ON queue_trace(queue_id, ts);
+
+-- keyset pagination (/api/queues, /api/events): newest-first scans by id within a filter
+CREATE INDEX IF NOT EXISTS idx_queues_status_id ON queues(status, id);
+CREATE INDEX IF NOT EXISTS idx_queue_items_queue ON queue_items(queue_id);
+CREATE INDEX IF NOT EXISTS idx_events_queue_id ON events(queue_id, id);
+CREATE INDEX IF NOT EXISTS idx_events_event_id ON events(event, id);
+
+-- Daily rollups (server/reports.py), updated in the same transaction as the queue's final status
+CREATE TABLE IF NOT EXISTS rollup_daily_room (
+  day TEXT NOT NULL,                 -- YYYY-MM-DD (UTC, same clock as CURRENT_TIMESTAMP)
+  room_id INTEGER NOT NULL,
+  success INTEGER NOT NULL DEFAULT 0,
+  failed INTEGER NOT NULL DEFAULT 0,
+  service_sec_sum REAL NOT NULL DEFAULT 0,   -- reserved -> served of successful queues (as in server/intake.py)
+  service_n INTEGER NOT NULL DEFAULT 0,
+  PRIMARY KEY(day, room_id)
+);
+CREATE TABLE IF NOT EXISTS rollup_daily_pill (
+  day TEXT NOT NULL,
+  pill_id INTEGER NOT NULL,
+  quantity INTEGER NOT NULL DEFAULT 0,        -- dispensed in successful queues
+  queues INTEGER NOT NULL DEFAULT 0,
+  failed_quantity INTEGER NOT NULL DEFAULT 0, -- ordered in failed queues
+  PRIMARY KEY(day, pill_id)
+);
+
+-- Service time model per room (server/intake.py): EWMA of reserved -> decided seconds,
+-- updated in the transaction that finishes the queue; drives the predicted wait at intake
+CREATE TABLE IF NOT EXISTS room_service (
+  room_id INTEGER PRIMARY KEY,
+  ewma_sec REAL NOT NULL,
+  samples INTEGER NOT NULL DEFAULT 0,
+  updated_at REAL
+);
+
+-- Catalogue version (server/catalogue.py): any write to pills/rooms bumps it,
+-- so every worker's in-memory copy can tell it is stale with one lookup
+CREATE TABLE IF NOT EXISTS catalogue_version (
+  id INTEGER PRIMARY KEY CHECK(id = 1),
+  version INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO catalogue_version(id, version) VALUES (1, 0);
+CREATE TRIGGER IF NOT EXISTS pills_version_ai AFTER INSERT ON pills BEGIN
+  UPDATE catalogue_version SET version = version + 1 WHERE id = 1;
+END;
+CREATE TRIGGER IF NOT EXISTS pills_version_au AFTER UPDATE ON pills BEGIN
+  UPDATE catalogue_version SET version = version + 1 WHERE id = 1;
+END;
+CREATE TRIGGER IF NOT EXISTS pills_version_ad AFTER DELETE ON pills BEGIN
+  UPDATE catalogue_version SET version = version + 1 WHERE id = 1;
+END;
+CREATE TRIGGER IF NOT EXISTS rooms_version_ai AFTER INSERT ON rooms BEGIN
+  UPDATE catalogue_version SET version = version + 1 WHERE id = 1;
+END;
+CREATE TRIGGER IF NOT EXISTS rooms_version_au AFTER UPDATE ON rooms BEGIN
+  UPDATE catalogue_version SET version = version + 1 WHERE id = 1;
+END;
+CREATE TRIGGER IF NOT EXISTS rooms_version_ad AFTER DELETE ON rooms BEGIN
+  UPDATE catalogue_version SET version = version + 1 WHERE id = 1;
+END;
+
 /* seed */
 INSERT OR IGNORE INTO rooms(id,name) VALUES
  (1,'ห้องจ่ายยา 1'),
@@ -0,0 +1,253 @@
+"""Per-queue counting state for the vision process.
+
+The frame loop is the only writer of a ``CountingSession``; readers (poster loop,
+MQTT finalize timer) only read plain attributes. When a new ``disp/cmd/{node}``
+arrives the MQTT thread builds a fresh session and swaps the module reference in
+one assignment, so a queue reset never waits on the frame loop (no lock needed).
+"""
+
+
+class CountConfig:
+    """Counting parameters shared by every session (read once from ENV by cam.py)."""
+    __slots__ = ('mode', 'window', 'max_count', 'track_dist', 'entrance_y',
+                 'reentry_cooldown', 'single_debounce', 'single_min_hold')
+
+    def __init__(self, mode='peak', window=7, max_count=255, track_dist=45.0,
+                 entrance_y=200, reentry_cooldown=1.2, single_debounce=0.35,
+                 single_min_hold=1):
+        self.mode = mode
+        self.window = window
+        self.max_count = max_count
+        self.track_dist = track_dist
+        self.entrance_y = entrance_y
+        self.reentry_cooldown = reentry_cooldown
+        self.single_debounce = single_debounce
+        self.single_min_hold = single_min_hold
+
+
+class StableWindow:
+    """Fixed-size window of per-frame counts with incremental mode/median/mean.
+
+    Counts are small non-negative ints, so a histogram over [0, max_value] plus a
+    "how many values have frequency f" table gives the mode without re-scanning;
+    the lower median is kept as a pointer into the histogram that moves at most
+    a few bins per push. ``mean()`` and ``median()`` are O(1) (plus a walk over
+    empty bins to the upper middle on even lengths), and so is ``mode()`` while
+    one value holds the top frequency. A tie, or a push that evicts the mode, costs
+    one pass over the window: O(window), i.e. a handful of frames
+    (VISION_STABILIZE_WINDOW, 7 by default).
+
+    Results match what cam.py computed before with the statistics module:
+    ``mode()`` breaks ties by the value seen first in the window (statistics.mode),
+    ``median()`` averages the two middle counts on even lengths and truncates
+    (int(statistics.median)).
+    """
+    __slots__ = ('size', '_ring', '_pos', '_n', '_hist', '_freq', '_max_freq',
+                 '_mode', '_sum', '_med', '_below', '_max_value')
+
+    def __init__(self, size, max_value=255):
+        self.size = max(1, int(size))
+        self._max_value = int(max_value)
+        self.clear()
+
+    def clear(self):
+        self._ring = [0] * self.size
+        self._pos = 0
+        self._n = 0
+        self._hist = [0] * (self._max_value + 1)
+        self._freq = [0] * (self.size + 2)
+        self._max_freq = 0
+        self._mode = None
+        self._sum = 0
+        self._med = None
+        self._below = 0
+
+    def __len__(self):
+        return self._n
+
+    def push(self, value):
+        v = min(max(int(value), 0), self._max_value)
+        if self._n == self.size:
+            self._remove(self._ring[self._pos])
+        self._ring[self._pos] = v
+        self._pos = (self._pos + 1) % self.size
+        self._add(v)
+
+    def _add(self, v):
+        h = self._hist
+        c = h[v]
+        if c:
+            self._freq[c] -= 1
+        h[v] = c + 1
+        self._freq[c + 1] += 1
+        if c + 1 >= self._max_freq:
+            self._max_freq = c + 1
+            self._mode = v
+        self._sum += v
+        if self._n == 0:
+            self._med = v
+            self._below = 0
+        elif v < self._med:
+            self._below += 1
+        self._n += 1
+        self._rebalance()
+
+    def _remove(self, v):
+        h = self._hist
+        c = h[v]
+        self._freq[c] -= 1
+        h[v] = c - 1
+        if c - 1:
+            self._freq[c - 1] += 1
+        if c == self._max_freq and self._freq[c] == 0:
+            self._max_freq = c - 1
+        self._sum -= v
+        self._n -= 1
+        if self._n == 0:
+            self._mode = None
+            self._med = None
+            self._below = 0
+            return
+        if v == self._mode and h[v] < self._max_freq:
+            # the old mode lost a vote and someone else holds max_freq: find it (O(window));
+            # mode() re-checks ties
+            i = self._pos
+            for _ in range(self.size):
+                i = (i - 1) % self.size
+                if h[self._ring[i]] == self._max_freq:
+                    self._mode = self._ring[i]
+                    break
+        if v < self._med:
+            self._below -= 1
+        self._rebalance()
+
+    def _rebalance(self):
+        h = self._hist
+        k = (self._n - 1) // 2
+        while self._below > k:
+            self._med -= 1
+            self._below -= h[self._med]
+        while self._below + h[self._med] <= k:
+            self._below += h[self._med]
+            self._med += 1
+
+    def mode(self):
+        if self._n and self._freq[self._max_freq] > 1:
+            # tie: the value seen first in the window wins, like statistics.mode (one O(window) pass)
+            h, top = self._hist, self._max_freq
+            start = self._pos if self._n == self.size else 0
+            for j in range(self._n):
+                v = self._ring[(start + j) % self.size]
+                if h[v] == top:
+                    return v
+        return self._mode
+
+    def median(self):
+        """int(statistics.median(window)): even lengths average the two middle counts."""
+        if not self._n:
+            return None
+        lo = self._med
+        if self._n % 2:
+            return lo
+        hi = lo
+        if self._below + self._hist[lo] <= self._n // 2:
+            hi += 1
+            while not self._hist[hi]:
+                hi += 1
+        return (lo + hi) // 2
+
+    def mean(self):
+        return int(round(self._sum / self._n)) if self._n else None
+
+    def stable(self, method='mode'):
+        if method == 'median':
+            return self.median()
+        if method == 'mean':
+            return self.mean()
+        return self.mode()
+
+
+class CountingSession:
+    """All counters for one queue; replaced wholesale when the queue changes."""
+    __slots__ = ('cfg', 'queue_id', 'queue_number', 'expected_total', 'window',
+                 'latest', 'peak', 'cumulative', 'last_centroids', 'recent_entries',
+                 'last_increment_at', 'last_increment_amount', 'single_last_seen_at',
+                 'single_present_frames', 'single_total', 'final_sent', 'paused_until',
+                 'pill_status', 'evidence')
+
+    def __init__(self, cfg, queue_id=None, queue_number=None, expected_total=None):
+        self.cfg = cfg
+        self.queue_id = queue_id
+        self.queue_number = queue_number
+        self.expected_total = expected_total
+        self.window = StableWindow(cfg.window, cfg.max_count)
+        self.latest = 0
+        self.peak = 0
+        self.cumulative = 0
+        self.last_centroids = []
+        self.recent_entries = []
+        self.last_increment_at = 0.0
+        self.last_increment_amount = 0
+        self.single_last_seen_at = 0.0
+        self.single_present_frames = 0
+        self.single_total = 0
+        self.final_sent = False
+        self.paused_until = 0.0
+        self.pill_status = "unknown"
+        self.evidence = None  # optional FrameRing (snapshots.py) attached by the vision process
+
+    def observe(self, pills, now):
+        """Feed one frame of detections [(x, y, r), ...]; called from the frame loop only."""
+        cfg = self.cfg
+        count = len(pills)
+        self.latest = count
+        self.window.push(count)
+        if cfg.mode == 'peak':
+            if count > self.peak:
+                self.peak = count
+        elif cfg.mode == 'cumulative':
+            self._observe_cumulative([(x, y) for (x, y, r) in pills], now)
+        elif cfg.mode == 'single':
+            # โหมดเม็ดยาทีละเม็ด: นับเมื่อ transition 0 -> 1 และ debounce
+            if count >= 1:
+                self.single_present_frames += 1
+                if (self.single_present_frames == cfg.single_min_hold and
+                        (now - self.single_last_seen_at) > cfg.single_debounce):
+                    self.single_total += 1
+                    self.single_last_seen_at = now
+            else:
+                self.single_present_frames = 0
+
+    def _observe_cumulative(self, centroids, now):
+        cfg = self.cfg
+        d2 = cfg.track_dist ** 2
+        # ล้าง recent_entries ที่หมดอายุ
+        recent = [(t, c) for (t, c) in self.recent_entries if now - t < cfg.reentry_cooldown]
+        # วัตถุถือว่า "ใหม่" ถ้าผ่านเส้น ENTRANCE และไม่มี centroid เฟรมก่อน/ที่เพิ่งนับ อยู่ใกล้กว่า threshold
+        new_objects = []
+        for (cx, cy) in centroids:
+            if cy < cfg.entrance_y:
+                continue
+            if any((cx - rx) ** 2 + (cy - ry) ** 2 <= d2 for (_, (rx, ry)) in recent):
+                continue
+            if any((cx - px) ** 2 + (cy - py) ** 2 <= d2 for (px, py) in self.last_centroids):
+                continue
+            new_objects.append((cx, cy))
+        for obj in new_objects:
+            recent.append((now, obj))
+        if new_objects:
+            self.cumulative += len(new_objects)
+            self.last_increment_at = now
+            self.last_increment_amount = len(new_objects)
+        self.recent_entries = recent
+        self.last_centroids = centroids
+
+    def final_count(self):
+        if self.cfg.mode == 'cumulative':
+            return int(self.cumulative)
+        if self.cfg.mode == 'single':
+            return int(self.single_total)
+        return int(self.peak)
+
+    def stable(self, method='mode'):
+        return self.window.stable(method)
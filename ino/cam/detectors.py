@@ -0,0 +1,200 @@
+"""Pill detectors used by the vision process (cam.py) and the replay benchmark.
+
+Every detector exposes the same small interface::
+
+    det = make_detector()            # picks VISION_DETECTOR=hough|contour
+    pills = det.detect(frame_bgr)    # -> [(x, y, r), ...] (ints, pixel coords)
+
+so the capture loop does not care which algorithm produced the centroids.
+
+Tuned parameters come from a profile written by tune.py (VISION_PROFILE, default
+vision_profile.json next to this file)::
+
+    {"detector": "hough", "params": {"param2": 24, "min_dist": 40, ...}, "score": {...}}
+
+Precedence: explicit arguments > VISION_* environment > profile > class defaults.
+"""
+import json
+import math
+import os
+
+import cv2
+import numpy as np
+
+
+def _env_float(name, default):
+    v = os.environ.get(name)
+    return float(v) if v not in (None, '') else default
+
+
+class HoughDetector:
+    """ตรวจจับเม็ดยาด้วย HoughCircles (วิธีเดิมของ cam.py)"""
+    name = 'hough'
+
+    def __init__(self, dp=1, min_dist=50, param1=100, param2=30,
+                 min_radius=10, max_radius=200, blur=5):
+        self.dp = dp
+        self.min_dist = min_dist
+        self.param1 = param1
+        self.param2 = param2
+        self.min_radius = min_radius
+        self.max_radius = max_radius
+        self.blur = blur
+
+    def detect(self, frame):
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        if self.blur and self.blur > 1:
+            gray = cv2.medianBlur(gray, int(self.blur) | 1)
+        circles = cv2.HoughCircles(
+            gray,
+            cv2.HOUGH_GRADIENT,
+            dp=self.dp,
+            minDist=self.min_dist,
+            param1=self.param1,
+            param2=self.param2,
+            minRadius=self.min_radius,
+            maxRadius=self.max_radius
+        )
+        if circles is None:
+            return []
+        circles = np.uint16(np.around(circles))
+        return [(int(x), int(y), int(r)) for (x, y, r) in circles[0, :]]
+
+
+class ContourDetector:
+    """Threshold + connected components; splits touching pills by area.
+
+    A blob whose area is ~k times the single-pill area is counted as k pills and
+    its pixels are split with k-means so every pill still gets its own centroid
+    (needed by the cumulative tracking mode). The single-pill area comes from
+    VISION_PILL_AREA, or is estimated per frame as the median blob area.
+    """
+    name = 'contour'
+
+    def __init__(self, blur=5, threshold=0, invert=None, open_kernel=3,
+                 min_area=80, max_area=40000, pill_area=None, split_ratio=1.6):
+        self.blur = blur
+        self.threshold = threshold      # 0 = Otsu
+        self.invert = invert            # None = auto (pills are the minority class)
+        self.open_kernel = open_kernel
+        self.min_area = min_area
+        self.max_area = max_area
+        self.pill_area = pill_area
+        self.split_ratio = split_ratio  # blob >= ratio*pill_area -> treat as touching pills
+        self._kernel = (cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (open_kernel, open_kernel))
+                        if open_kernel and open_kernel > 1 else None)
+
+    def _binarize(self, frame):
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        if self.blur and self.blur > 1:
+            gray = cv2.medianBlur(gray, int(self.blur) | 1)
+        if self.threshold:
+            _, mask = cv2.threshold(gray, self.threshold, 255, cv2.THRESH_BINARY)
+        else:
+            _, mask = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+        invert = self.invert
+        if invert is None:
+            # foreground (pills) should be the smaller part of the tray
+            invert = cv2.countNonZero(mask) > mask.size // 2
+        if invert:
+            mask = cv2.bitwise_not(mask)
+        if self._kernel is not None:
+            mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, self._kernel)
+        return mask
+
+    def detect(self, frame):
+        mask = self._binarize(frame)
+        n, labels, stats, centroids = cv2.connectedComponentsWithStats(mask, connectivity=8)
+        blobs = []
+        for i in range(1, n):  # 0 = background
+            area = int(stats[i, cv2.CC_STAT_AREA])
+            if self.min_area <= area <= self.max_area:
+                blobs.append((i, area))
+        if not blobs:
+            return []
+
+        unit = self.pill_area or float(np.median([a for _, a in blobs]))
+        unit = max(unit, float(self.min_area))
+        r = int(round(math.sqrt(unit / math.pi)))
+
+        out = []
+        for i, area in blobs:
+            k = int(round(area / unit)) if area >= self.split_ratio * unit else 1
+            k = max(1, k)
+            cx, cy = centroids[i]
+            if k == 1:
+                out.append((int(cx), int(cy), r))
+                continue
+            # แยกเม็ดที่ติดกัน: k-means บนพิกัด pixel ของ blob
+            x0 = stats[i, cv2.CC_STAT_LEFT]
+            y0 = stats[i, cv2.CC_STAT_TOP]
+            w = stats[i, cv2.CC_STAT_WIDTH]
+            h = stats[i, cv2.CC_STAT_HEIGHT]
+            ys, xs = np.nonzero(labels[y0:y0 + h, x0:x0 + w] == i)
+            pts = np.column_stack((xs + x0, ys + y0)).astype(np.float32)
+            if len(pts) < k:
+                out.append((int(cx), int(cy), r))
+                continue
+            criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 10, 1.0)
+            _, _, centers = cv2.kmeans(pts, k, None, criteria, 1, cv2.KMEANS_PP_CENTERS)
+            for (px, py) in centers:
+                out.append((int(px), int(py), r))
+        return out
+
+
+DETECTORS = {
+    HoughDetector.name: HoughDetector,
+    ContourDetector.name: ContourDetector,
+}
+
+
+DEFAULT_PROFILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'vision_profile.json')
+
+
+def profile_path():
+    return os.environ.get('VISION_PROFILE') or DEFAULT_PROFILE
+
+
+def load_profile(path=None):
+    """The tuned profile as a dict, or None when there is none (VISION_PROFILE=off disables it)."""
+    path = path or profile_path()
+    if path.lower() in ('off', 'none', '0') or not os.path.isfile(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        prof = json.load(f)
+    if prof.get('detector') not in DETECTORS:
+        raise ValueError(f"{path}: unknown detector '{prof.get('detector')}'")
+    return prof
+
+
+def make_detector(name=None, profile=None, **params):
+    """Create a detector by name (default: ENV VISION_DETECTOR, then the profile's, fallback 'hough').
+
+    ``profile`` is a dict from load_profile(); by default the VISION_PROFILE file is read.
+    Its params apply only when it was tuned for the detector being created.
+    """
+    if profile is None:
+        profile = load_profile()
+    name = (name or os.environ.get('VISION_DETECTOR') or (profile or {}).get('detector') or 'hough').lower()
+    cls = DETECTORS.get(name)
+    if cls is None:
+        raise ValueError(f"unknown detector '{name}' (choose: {', '.join(sorted(DETECTORS))})")
+    kw = {}
+    if profile and profile.get('detector') == name:
+        kw.update(profile.get('params') or {})
+    blur = os.environ.get('VISION_BLUR')
+    if blur:
+        kw['blur'] = int(blur)
+    if cls is ContourDetector:
+        pill_area = _env_float('VISION_PILL_AREA', None)
+        if pill_area:
+            kw['pill_area'] = pill_area
+        if os.environ.get('VISION_MIN_AREA'):
+            kw['min_area'] = int(_env_float('VISION_MIN_AREA', 80))
+        thr = os.environ.get('VISION_THRESHOLD')
+        if thr:
+            kw['threshold'] = int(thr)
+    kw.update(params)
+    det = cls(**kw)
+    det.profile = profile_path() if profile and profile.get('detector') == name else None
+    return det
@@ -0,0 +1,250 @@
+"""Shared-memory frame ring: one capture loop writes, any process reads without copying.
+
+A FrameBus is one ``multiprocessing.shared_memory`` segment holding a small
+ring of frame slots (VISION_FRAMEBUS_SLOTS, each big enough for a
+VISION_FRAMEBUS_MAX frame) plus, per slot, the frame's sequence number,
+timestamp, shape, pill count and detections. The capture loop reads the camera
+straight into the next slot (``capture``), runs the detector on that same array
+and ``commit``s it; a reader takes ``latest()`` and gets a numpy view into the
+segment, not a copy.
+
+There is no lock between processes. A slot's seq is set to 0 while it is being
+written and to the frame's seq when it is committed, so a reader only ever
+returns committed slots, and after using a view it checks ``valid(frame)``: if
+the writer has gone round the ring and reused that slot in the meantime, the
+reader drops what it made from it. With 4 slots at 30 fps a reader has ~100 ms
+to finish with a frame, far more than a JPEG encode takes.
+
+    bus = FrameBus.create(name='vision-cam0')          # writer (or whoever owns the segment)
+    ok, frame = bus.capture(cap)                       # cap.read() into the next slot
+    bus.commit(pills)                                  # publish it with its detections
+
+    bus = FrameBus.attach('vision-cam0')               # reader, any process
+    f = bus.latest()
+    small = cv2.resize(f.image, ...)                   # f.image is a view into shared memory
+    if bus.valid(f): ...
+
+Environment:
+    VISION_FRAMEBUS_SLOTS=4
+    VISION_FRAMEBUS_MAX=1280x720     largest frame a slot holds; bigger frames are not published
+"""
+import os
+import secrets
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+FRAMEBUS_SLOTS = int(os.environ.get('VISION_FRAMEBUS_SLOTS', '4'))
+FRAMEBUS_MAX = os.environ.get('VISION_FRAMEBUS_MAX', '1280x720')
+
+MAX_DETECTIONS = 64   # circles kept per frame (x, y, r); the count is kept even past this
+_MAGIC = 0x46425553   # 'FBUS'
+_VERSION = 1
+_ALIGN = 64
+
+_created = set()      # segments this process created (and its resource tracker knows about)
+
+_HEADER = np.dtype([('magic', '<u4'), ('version', '<u4'), ('slots', '<u4'), ('max_dets', '<u4'),
+                    ('slot_bytes', '<u8'), ('seq', '<u8')])
+_SLOT = np.dtype([('seq', '<u8'), ('ts', '<f8'), ('h', '<u4'), ('w', '<u4'), ('c', '<u4'),
+                  ('count', '<i4'), ('ndets', '<u4'), ('_pad', '<u4'),
+                  ('dets', '<i2', (MAX_DETECTIONS, 3))])
+
+
+def _aligned(n):
+    return (n + _ALIGN - 1) // _ALIGN * _ALIGN
+
+
+def parse_size(spec):
+    """"1280x720" -> (1280, 720)"""
+    w, _, h = spec.lower().partition('x')
+    return int(w), int(h)
+
+
+class Frame:
+    """One committed frame; ``image`` is a view into the bus (check ``bus.valid(frame)`` after using it)."""
+    __slots__ = ('seq', 'ts', 'image', 'count', 'detections', '_slot')
+
+    def __init__(self, seq, ts, image, count, detections, slot):
+        self.seq = seq
+        self.ts = ts
+        self.image = image
+        self.count = count
+        self.detections = detections
+        self._slot = slot
+
+
+class FrameBus:
+    def __init__(self, shm, owner):
+        self.shm = shm
+        self.name = shm.name
+        self.owner = owner
+        buf = shm.buf
+        self._header = np.ndarray((), _HEADER, buffer=buf, offset=0)
+        if self._header['magic'] != _MAGIC or self._header['version'] != _VERSION:
+            raise ValueError(f"shared memory {shm.name} is not a frame bus")
+        self.slots = int(self._header['slots'])
+        self.slot_bytes = int(self._header['slot_bytes'])
+        meta_off = _aligned(_HEADER.itemsize)
+        self._meta = np.ndarray((self.slots,), _SLOT, buffer=buf, offset=meta_off)
+        data_off = _aligned(meta_off + _SLOT.itemsize * self.slots)
+        self._data = np.ndarray((self.slots, self.slot_bytes), np.uint8, buffer=buf, offset=data_off)
+        self._seq = int(self._header['seq'])
+        self._writing = None      # (slot, seq, shape) between capture/begin and commit
+        self._last_shape = None
+        self.oversize = 0         # frames too big for a slot (not published)
+
+    # ------------------------------------------------------------ lifecycle
+
+    @classmethod
+    def create(cls, name=None, slots=None, max_size=None):
+        """New segment (unlinked again by ``close()`` of this object)."""
+        slots = slots or FRAMEBUS_SLOTS
+        w, h = max_size or parse_size(FRAMEBUS_MAX)
+        slot_bytes = _aligned(w * h * 3)
+        size = _aligned(_aligned(_HEADER.itemsize) + _SLOT.itemsize * slots) + slot_bytes * slots
+        name = name or f"vision-{os.getpid()}-{secrets.token_hex(3)}"
+        try:
+            shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        except FileExistsError:
+            # left behind by a process that was killed: take it over
+            stale = shared_memory.SharedMemory(name=name)
+            stale.close()
+            stale.unlink()
+            shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        header = np.ndarray((), _HEADER, buffer=shm.buf, offset=0)
+        header['slots'], header['max_dets'], header['slot_bytes'], header['seq'] = slots, MAX_DETECTIONS, slot_bytes, 0
+        header['version'] = _VERSION
+        header['magic'] = _MAGIC
+        del header
+        _created.add(shm.name)
+        return cls(shm, owner=True)
+
+    @classmethod
+    def attach(cls, name, untrack=True):
+        """Open an existing bus. A child started by the owner through multiprocessing shares the
+        owner's resource tracker and must pass ``untrack=False``."""
+        shm = shared_memory.SharedMemory(name=name)
+        if untrack and shm.name not in _created:
+            # the resource tracker would unlink the segment when this (non-owning) process exits
+            try:
+                from multiprocessing import resource_tracker
+                resource_tracker.unregister(shm._name, 'shared_memory')
+            except Exception:
+                pass
+        return cls(shm, owner=False)
+
+    def close(self):
+        self._header = self._meta = self._data = None
+        try:
+            self.shm.close()
+        except BufferError:
+            pass   # a Frame.image view is still alive somewhere; the mapping goes with the process
+        if self.owner:
+            _created.discard(self.name)
+            try:
+                self.shm.unlink()
+            except FileNotFoundError:
+                pass
+
+    # --------------------------------------------------------------- writer
+
+    def begin(self, shape):
+        """Writable array for the next slot (not visible to readers until ``commit``); None if it won't fit."""
+        nbytes = int(np.prod(shape))
+        if nbytes > self.slot_bytes:
+            self.oversize += 1
+            return None
+        seq = self._seq + 1
+        slot = (seq - 1) % self.slots
+        self._meta['seq'][slot] = 0
+        self._writing = (slot, seq, tuple(shape) if len(shape) == 3 else tuple(shape) + (1,))
+        return self._data[slot, :nbytes].reshape(shape)
+
+    def capture(self, cap):
+        """``cap.read()`` straight into the next slot -> (ok, frame); call ``commit`` once the frame is done."""
+        view = self.begin(self._last_shape) if self._last_shape else None
+        if view is None:
+            ok, frame = cap.read()
+        else:
+            ok, frame = cap.read(view)
+        if not ok or frame is None:
+            self._writing = None
+            return ok, frame
+        if view is None or frame.shape != view.shape or not np.shares_memory(frame, view):
+            # first frame or the camera changed size: copy this one, later ones land in place
+            self._last_shape = frame.shape
+            view = self.begin(frame.shape)
+            if view is None:
+                return ok, frame
+            np.copyto(view, frame)
+            frame = view
+        return ok, frame
+
+    def commit(self, detections=(), count=None, ts=None):
+        """Publish the slot filled since ``begin``/``capture`` with its detections [(x, y, r)]."""
+        if self._writing is None:
+            return None
+        slot, seq, shape = self._writing
+        self._writing = None
+        meta = self._meta
+        n = min(len(detections), MAX_DETECTIONS)
+        if n:
+            meta['dets'][slot, :n] = np.asarray(detections[:n], dtype=np.int16).reshape(n, 3)
+        meta['h'][slot], meta['w'][slot], meta['c'][slot] = shape
+        meta['ndets'][slot] = n
+        meta['count'][slot] = len(detections) if count is None else count
+        meta['ts'][slot] = time.time() if ts is None else ts
+        meta['seq'][slot] = seq
+        self._header['seq'] = seq
+        self._seq = seq
+        return seq
+
+    def publish(self, frame, detections=(), count=None, ts=None):
+        """Copy ``frame`` into the next slot and commit it (for frames that were not captured into the bus)."""
+        self._last_shape = frame.shape
+        view = self.begin(frame.shape)
+        if view is None:
+            return None
+        np.copyto(view, frame)
+        return self.commit(detections, count, ts)
+
+    # --------------------------------------------------------------- reader
+
+    def latest(self, after=0):
+        """Newest committed frame newer than seq ``after``, or None."""
+        for _ in range(3):
+            seq = int(self._header['seq'])
+            if seq <= after:
+                return None
+            slot = (seq - 1) % self.slots
+            meta = self._meta
+            if int(meta['seq'][slot]) != seq:
+                continue   # overwritten while we looked; the header has moved on
+            h, w, c = int(meta['h'][slot]), int(meta['w'][slot]), int(meta['c'][slot])
+            n = int(meta['ndets'][slot])
+            dets = [tuple(int(v) for v in d) for d in meta['dets'][slot, :n]]
+            ts, count = float(meta['ts'][slot]), int(meta['count'][slot])
+            if int(meta['seq'][slot]) != seq:
+                continue
+            image = self._data[slot, :h * w * c].reshape((h, w, c) if c > 1 else (h, w))
+            return Frame(seq, ts, image, count, dets, slot)
+        return None
+
+    def valid(self, frame):
+        """True while ``frame``'s slot still holds that frame (i.e. what was read from it is not torn)."""
+        return frame is not None and int(self._meta['seq'][frame._slot]) == frame.seq
+
+    @property
+    def seq(self):
+        return int(self._header['seq'])
+
+    def wait(self, after, timeout, poll=0.005):
+        """Poll for a frame newer than ``after`` (there is no cross-process notify)."""
+        deadline = time.monotonic() + timeout
+        while True:
+            f = self.latest(after)
+            if f is not None or time.monotonic() >= deadline:
+                return f
+            time.sleep(poll)
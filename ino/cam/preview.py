@@ -0,0 +1,224 @@
+"""MJPEG preview of the frame bus over HTTP, encoded only while someone is watching.
+
+    http://<odroid>:8090/               every camera on one page
+    http://<odroid>:8090/cam/0.mjpg     multipart/x-mixed-replace stream of camera 0
+    http://<odroid>:8090/cam/0.jpg      one frame
+    http://<odroid>:8090/health         viewers / encoded frames per camera (json)
+
+Each camera has one encoder thread, and it only runs while that camera has
+viewers. It waits for a frame newer than the last one it sent, takes it from
+the FrameBus as a view (no copy), downscales it to VISION_PREVIEW_WIDTH,
+checks the slot was not reused in the meantime, draws the detections and
+JPEG-encodes it, at most VISION_PREVIEW_FPS times a second. Every viewer of
+the camera gets those same bytes and always the newest ones, so a slow client
+skips frames instead of queueing them. Nobody connected means nothing is
+resized or encoded: the capture loop costs the same as without a preview.
+
+Environment:
+    VISION_PREVIEW_PORT=8090      0 disables
+    VISION_PREVIEW_HOST=0.0.0.0
+    VISION_PREVIEW_FPS=5
+    VISION_PREVIEW_WIDTH=640
+    VISION_PREVIEW_QUALITY=70
+"""
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import cv2
+
+PREVIEW_PORT = int(os.environ.get('VISION_PREVIEW_PORT', '8090'))
+PREVIEW_HOST = os.environ.get('VISION_PREVIEW_HOST', '0.0.0.0')
+PREVIEW_FPS = float(os.environ.get('VISION_PREVIEW_FPS', '5'))
+PREVIEW_WIDTH = int(os.environ.get('VISION_PREVIEW_WIDTH', '640'))
+PREVIEW_QUALITY = int(os.environ.get('VISION_PREVIEW_QUALITY', '70'))
+
+_BOUNDARY = b'frame'
+
+
+class _Encoder:
+    """Latest JPEG of one bus, produced on demand for however many viewers there are."""
+
+    def __init__(self, key, bus, annotate):
+        self.key = key
+        self.bus = bus
+        self.annotate = annotate
+        self.cond = threading.Condition()
+        self.viewers = 0
+        self.jpeg = None
+        self.jpeg_n = 0         # bumps with every new JPEG
+        self.frame_seq = 0      # bus seq of the frame in self.jpeg
+        self.torn = 0           # frames dropped because the slot was reused while we read it
+        self.encode_ms = 0.0
+        self._thread = None
+
+    def join(self):
+        with self.cond:
+            self.viewers += 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=f'preview-{self.key}', daemon=True)
+                self._thread.start()
+
+    def leave(self):
+        with self.cond:
+            self.viewers -= 1
+
+    def next_jpeg(self, after, timeout):
+        """(n, jpeg) newer than ``after``, or None after ``timeout`` seconds."""
+        with self.cond:
+            self.cond.wait_for(lambda: self.jpeg_n > after, timeout)
+            return (self.jpeg_n, self.jpeg) if self.jpeg_n > after else None
+
+    def _run(self):
+        interval = 1.0 / PREVIEW_FPS if PREVIEW_FPS > 0 else 0.0
+        next_at = 0.0
+        while True:
+            with self.cond:
+                if self.viewers <= 0:
+                    self._thread = None
+                    return
+            delay = next_at - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            frame = self.bus.wait(self.frame_seq, timeout=1.0)
+            if frame is None:
+                continue
+            next_at = time.monotonic() + interval
+            t0 = time.perf_counter()
+            jpeg = self._encode(frame)
+            if jpeg is None:
+                continue
+            with self.cond:
+                self.encode_ms = (time.perf_counter() - t0) * 1000.0
+                self.frame_seq = frame.seq
+                self.jpeg = jpeg
+                self.jpeg_n += 1
+                self.cond.notify_all()
+
+    def _encode(self, frame):
+        img = frame.image
+        h, w = img.shape[:2]
+        scale = PREVIEW_WIDTH / float(w) if PREVIEW_WIDTH and w > PREVIEW_WIDTH else 1.0
+        if scale < 1.0:
+            small = cv2.resize(img, (PREVIEW_WIDTH, int(h * scale)), interpolation=cv2.INTER_AREA)
+        else:
+            small = img.copy()
+        if not self.bus.valid(frame):
+            self.torn += 1
+            return None
+        if self.annotate:
+            for (x, y, r) in frame.detections:
+                cv2.circle(small, (int(x * scale), int(y * scale)), max(1, int(r * scale)), (0, 255, 0), 2)
+            cv2.putText(small, f"{frame.count} pills", (8, 24), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (255, 0, 0), 2)
+        ok, buf = cv2.imencode('.jpg', small, [cv2.IMWRITE_JPEG_QUALITY, PREVIEW_QUALITY])
+        return buf.tobytes() if ok else None
+
+    def stats(self):
+        return {'viewers': self.viewers, 'encoding': self._thread is not None, 'jpegs': self.jpeg_n,
+                'frame_seq': self.frame_seq, 'bus_seq': self.bus.seq, 'torn': self.torn,
+                'encode_ms': round(self.encode_ms, 1)}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    encoders = {}   # set per server in PreviewServer
+
+    def log_message(self, fmt, *args):
+        pass
+
+    def _send(self, code, ctype, body):
+        self.send_response(code)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-store')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = self.path.split('?', 1)[0]
+        if path == '/':
+            imgs = ''.join(f'<figure><img src="/cam/{k}.mjpg"><figcaption>camera {k}</figcaption></figure>'
+                           for k in self.encoders)
+            self._send(200, 'text/html; charset=utf-8', f'<html><body>{imgs}</body></html>'.encode())
+        elif path == '/health':
+            body = json.dumps({k: e.stats() for k, e in self.encoders.items()}).encode()
+            self._send(200, 'application/json', body)
+        elif path.startswith('/cam/'):
+            key, _, ext = path[len('/cam/'):].rpartition('.')
+            enc = self.encoders.get(key)
+            if enc is None or ext not in ('mjpg', 'jpg'):
+                self._send(404, 'text/plain', b'unknown camera')
+            elif ext == 'jpg':
+                self._snapshot(enc)
+            else:
+                self._stream(enc)
+        else:
+            self._send(404, 'text/plain', b'not found')
+
+    def _snapshot(self, enc):
+        enc.join()
+        try:
+            got = enc.next_jpeg(0, timeout=3.0)
+        finally:
+            enc.leave()
+        if got is None:
+            self._send(503, 'text/plain', b'no frame from camera')
+        else:
+            self._send(200, 'image/jpeg', got[1])
+
+    def _stream(self, enc):
+        self.send_response(200)
+        self.send_header('Content-Type', 'multipart/x-mixed-replace; boundary=' + _BOUNDARY.decode())
+        self.send_header('Cache-Control', 'no-store')
+        self.end_headers()
+        enc.join()
+        n = 0
+        try:
+            while True:
+                got = enc.next_jpeg(n, timeout=5.0)
+                if got is None:
+                    continue
+                n, jpeg = got
+                self.wfile.write(b'--' + _BOUNDARY + b'\r\nContent-Type: image/jpeg\r\nContent-Length: '
+                                 + str(len(jpeg)).encode() + b'\r\n\r\n' + jpeg + b'\r\n')
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError, TimeoutError):
+            pass
+        finally:
+            enc.leave()
+
+
+class PreviewServer:
+    """Serve ``buses`` ({camera key: FrameBus}) from a daemon thread."""
+
+    def __init__(self, buses, annotate=True, host=None, port=None):
+        handler = type('PreviewHandler', (_Handler,), {
+            'encoders': {str(k): _Encoder(str(k), bus, annotate) for k, bus in buses.items()},
+        })
+        self.encoders = handler.encoders
+        self.httpd = ThreadingHTTPServer((host or PREVIEW_HOST, PREVIEW_PORT if port is None else port), handler)
+        self.httpd.daemon_threads = True
+        self.port = self.httpd.server_address[1]
+        threading.Thread(target=self.httpd.serve_forever, name='preview-http', daemon=True).start()
+
+    def stats(self):
+        return {k: e.stats() for k, e in self.encoders.items()}
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def start_preview(buses, annotate=True, port=None):
+    """PreviewServer, or None when VISION_PREVIEW_PORT=0 or the port is taken."""
+    port = PREVIEW_PORT if port is None else port
+    if not port:
+        return None
+    try:
+        server = PreviewServer(buses, annotate=annotate, port=port)
+    except OSError as e:
+        print(f"[vision] preview disabled: cannot listen on {PREVIEW_HOST}:{port} ({e})")
+        return None
+    print(f"[vision] preview on http://{PREVIEW_HOST}:{server.port}/ ({PREVIEW_FPS:g} fps, only while viewed)")
+    return server
@@ -0,0 +1,132 @@
+"""Replay recorded clips through the pill detectors and compare speed / accuracy.
+
+Usage:
+    python ino/cam/replay_bench.py clips/tray1.mp4 clips/tray2.mp4 [--detectors hough,contour]
+
+Each clip may be a video file or a directory of images (sorted by name). Ground
+truth is read from a sidecar ``<clip>.json`` next to it:
+
+    {"count": 5}                  # same number of pills on every frame
+    {"counts": [0, 1, 1, 2, ...]} # per-frame labels (frames without a label are skipped)
+
+Clips without labels are still timed, accuracy columns show '-'.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import cv2
+
+from detectors import DETECTORS, make_detector
+
+
+def load_labels(clip):
+    base = clip.rstrip('/\\')
+    for path in (base + '.json', os.path.splitext(base)[0] + '.json'):
+        if os.path.isfile(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+    return {}
+
+
+def label_for(labels, idx):
+    if 'counts' in labels:
+        counts = labels['counts']
+        return counts[idx] if idx < len(counts) else None
+    return labels.get('count')
+
+
+def iter_frames(clip, max_frames=None):
+    if os.path.isdir(clip):
+        names = sorted(n for n in os.listdir(clip)
+                       if n.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp')))
+        for i, n in enumerate(names):
+            if max_frames and i >= max_frames:
+                return
+            frame = cv2.imread(os.path.join(clip, n))
+            if frame is not None:
+                yield frame
+        return
+    cap = cv2.VideoCapture(clip)
+    i = 0
+    try:
+        while True:
+            if max_frames and i >= max_frames:
+                return
+            ret, frame = cap.read()
+            if not ret:
+                return
+            i += 1
+            yield frame
+    finally:
+        cap.release()
+
+
+def load_clip(clip, max_frames=None):
+    """Decode a clip once so decoding cost is not charged to the detectors."""
+    labels = load_labels(clip)
+    frames = list(iter_frames(clip, max_frames))
+    return frames, [label_for(labels, i) for i in range(len(frames))]
+
+
+def evaluate(detector, frames, truth):
+    """Run one detector over decoded frames -> dict of timing / accuracy stats."""
+    times = []
+    abs_err = 0
+    exact = 0
+    labelled = 0
+    for frame, want in zip(frames, truth):
+        t0 = time.perf_counter()
+        got = len(detector.detect(frame))
+        times.append(time.perf_counter() - t0)
+        if want is None:
+            continue
+        labelled += 1
+        abs_err += abs(got - int(want))
+        exact += int(got == int(want))
+    total = sum(times)
+    times.sort()
+    return {
+        'frames': len(times),
+        'fps': (len(times) / total) if total > 0 else 0.0,
+        'p50_ms': times[len(times) // 2] * 1000 if times else 0.0,
+        'p95_ms': times[min(len(times) - 1, int(len(times) * 0.95))] * 1000 if times else 0.0,
+        'labelled': labelled,
+        'mae': (abs_err / labelled) if labelled else None,
+        'exact': (exact / labelled) if labelled else None,
+    }
+
+
+def _fmt(v, pat):
+    return '-' if v is None else pat % v
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description='Replay clips through pill detectors')
+    ap.add_argument('clips', nargs='+', help='video files or image directories')
+    ap.add_argument('--detectors', default=','.join(sorted(DETECTORS)),
+                    help='comma separated detector names (default: all)')
+    ap.add_argument('--max-frames', type=int, default=0, help='limit frames per clip (0 = all)')
+    args = ap.parse_args(argv)
+
+    names = [n.strip() for n in args.detectors.split(',') if n.strip()]
+    detectors = [make_detector(n) for n in names]
+
+    print(f"{'clip':30} {'detector':9} {'frames':>6} {'fps':>8} {'p50ms':>7} {'p95ms':>7} {'MAE':>6} {'exact':>6}")
+    for clip in args.clips:
+        frames, truth = load_clip(clip, args.max_frames or None)
+        if not frames:
+            print(f"{os.path.basename(clip):30} (no frames)")
+            continue
+        for det in detectors:
+            r = evaluate(det, frames, truth)
+            print(f"{os.path.basename(clip)[:30]:30} {det.name:9} {r['frames']:6d} {r['fps']:8.1f} "
+                  f"{r['p50_ms']:7.2f} {r['p95_ms']:7.2f} {_fmt(r['mae'], '%6.2f'):>6} "
+                  f"{_fmt(None if r['exact'] is None else r['exact'] * 100, '%5.1f%%'):>6}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
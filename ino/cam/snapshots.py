@@ -0,0 +1,118 @@
+"""Evidence snapshots for vision_complete.
+
+FrameRing keeps a few annotated frames for the active queue (one per observed
+count, newest wins, smallest counts evicted first), downscaled so the longest
+side is at most ``max_side`` and memory stays bounded at
+``capacity * max_side^2 * 3`` bytes. Frames are only copied when the
+count is new or its entry is older than ``refresh`` seconds, so the capture loop
+pays for a resize+copy a few times per queue rather than on every frame.
+
+SnapshotWriter JPEG-encodes on a single background thread and stores the file
+under its sha256 (``<root>/ab/cd/<sha>.jpg``); identical frames are written once.
+Submissions never block: if the writer is busy the snapshot is skipped.
+"""
+import hashlib
+import os
+import queue
+import threading
+import time
+
+import cv2
+
+
+class FrameRing:
+    __slots__ = ('capacity', 'max_side', 'refresh', '_frames')
+
+    def __init__(self, capacity=6, max_side=640, refresh=1.0):
+        self.capacity = max(1, int(capacity))
+        self.max_side = int(max_side)
+        self.refresh = float(refresh)
+        self._frames = {}  # count -> (ts, frame)
+
+    def offer(self, frame, count, now=None, detections=None):
+        """Called from the frame loop; returns quickly unless a copy is due.
+
+        ``detections`` [(x, y, r)] are drawn on the stored copy, for frames that
+        were not annotated by the caller (the shared frame itself is left untouched).
+        """
+        now = time.time() if now is None else now
+        prev = self._frames.get(count)
+        if prev is not None and now - prev[0] < self.refresh:
+            return
+        if len(self._frames) >= self.capacity and prev is None:
+            lowest = min(self._frames)
+            if count < lowest:
+                return
+            del self._frames[lowest]
+        h, w = frame.shape[:2]
+        scale = 1.0
+        if self.max_side and max(h, w) > self.max_side:
+            scale = self.max_side / float(max(h, w))
+            size = (max(1, int(w * scale)), max(1, int(h * scale)))
+            small = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+        else:
+            small = frame.copy()
+        if detections is not None:
+            for (x, y, r) in detections:
+                cv2.circle(small, (int(x * scale), int(y * scale)), max(1, int(r * scale)), (0, 255, 0), 2)
+            cv2.putText(small, f"{count} pills", (8, 24), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (255, 0, 0), 2)
+        self._frames[count] = (now, small)
+
+    def best(self, count=None):
+        """Frame showing ``count`` pills if we have one, else the most recent frame."""
+        entries = dict(self._frames)  # snapshot: the frame loop may still be offering
+        if not entries:
+            return None
+        if count in entries:
+            return entries[count][1]
+        return max(entries.values(), key=lambda e: e[0])[1]
+
+    def clear(self):
+        self._frames = {}
+
+
+class SnapshotWriter:
+    def __init__(self, root, quality=85, backlog=2):
+        self.root = os.path.abspath(root)
+        self.quality = int(quality)
+        self._q = queue.Queue(maxsize=max(1, int(backlog)))
+        self._t = threading.Thread(target=self._run, name='snapshot-writer', daemon=True)
+        self._t.start()
+
+    def submit(self, frame, on_done):
+        """Queue ``frame`` for encoding; ``on_done(path_or_None)`` runs on the writer thread."""
+        try:
+            self._q.put_nowait((frame, on_done))
+            return True
+        except queue.Full:
+            return False
+
+    def path_for(self, digest):
+        return os.path.join(self.root, digest[:2], digest[2:4], digest + '.jpg')
+
+    def _store(self, frame):
+        ok, buf = cv2.imencode('.jpg', frame, [int(cv2.IMWRITE_JPEG_QUALITY), self.quality])
+        if not ok:
+            return None
+        data = buf.tobytes()
+        path = self.path_for(hashlib.sha256(data).hexdigest())
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{os.getpid()}.tmp"
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        return path
+
+    def _run(self):
+        while True:
+            frame, on_done = self._q.get()
+            path = None
+            try:
+                path = self._store(frame)
+            except Exception as e:
+                print(f"[vision] snapshot write failed: {e}")
+            try:
+                on_done(path)
+            except Exception as e:
+                print(f"[vision] snapshot callback failed: {e}")
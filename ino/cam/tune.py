@@ -0,0 +1,214 @@
+"""Tune detector parameters against labelled clips and write the winning profile.
+
+Usage:
+    python ino/cam/tune.py clips/tray1.mp4 clips/tray2/ [--detector hough] [--trials 150] [--workers 4]
+
+Clips and their ``<clip>.json`` labels are the same as for replay_bench.py.
+Every candidate configuration runs over all clips in a process pool (one
+detector per task, clips decoded once per worker), so a search uses every
+core. Candidates come from the detector's grid below:
+
+    --search grid     every combination (small grids only)
+    --search random   --trials samples of the grid, then --refine samples next to
+                      the best few (one grid step per parameter), which homes in on
+                      a good region without walking the whole grid
+
+Configurations are ranked by exact-count rate, then mean absolute error, then
+frames/sec; ``--min-fps`` pushes anything slower than the camera needs to the
+bottom. The best one is written to ``vision_profile.json`` (or ``--out`` /
+VISION_PROFILE), which cam.py and vision_service.py load at startup through
+detectors.make_detector().
+"""
+import argparse
+import itertools
+import json
+import os
+import random
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from detectors import make_detector, profile_path
+from replay_bench import evaluate, load_clip
+
+# candidate values per parameter (class defaults included)
+GRIDS = {
+    'hough': {
+        'dp': [1, 1.2, 1.5],
+        'min_dist': [20, 35, 50, 70],
+        'param1': [60, 100, 140],
+        'param2': [18, 24, 30, 38],
+        'min_radius': [5, 10, 15],
+        'max_radius': [40, 80, 200],
+        'blur': [3, 5, 7],
+    },
+    'contour': {
+        'blur': [0, 3, 5, 7],
+        'threshold': [0, 80, 110, 140],
+        'open_kernel': [0, 3, 5],
+        'min_area': [40, 80, 150],
+        'split_ratio': [1.4, 1.6, 1.9],
+    },
+}
+
+_clips = None   # per worker process: [(frames, truth)]
+
+
+def _init_worker(paths, max_frames):
+    global _clips
+    import cv2
+    cv2.setNumThreads(1)   # the pool already uses every core
+    _clips = [load_clip(p, max_frames) for p in paths]
+
+
+def _score(name, params):
+    """Run one configuration over every clip (in a worker) -> aggregate stats."""
+    det = make_detector(name, profile={}, **params)
+    frames = labelled = 0
+    seconds = abs_err = exact = 0.0
+    for clip_frames, truth in _clips:
+        if not clip_frames:
+            continue
+        r = evaluate(det, clip_frames, truth)
+        frames += r['frames']
+        seconds += r['frames'] / r['fps'] if r['fps'] else 0.0
+        if r['labelled']:
+            labelled += r['labelled']
+            abs_err += r['mae'] * r['labelled']
+            exact += r['exact'] * r['labelled']
+    return {
+        'params': params,
+        'frames': frames,
+        'labelled': labelled,
+        'fps': frames / seconds if seconds else 0.0,
+        'mae': abs_err / labelled if labelled else None,
+        'exact': exact / labelled if labelled else None,
+    }
+
+
+def rank_key(min_fps):
+    def key(r):
+        fast_enough = r['fps'] >= min_fps
+        return (not fast_enough, -(r['exact'] or 0.0), r['mae'] if r['mae'] is not None else float('inf'), -r['fps'])
+    return key
+
+
+def grid_candidates(grid):
+    names = sorted(grid)
+    for values in itertools.product(*(grid[n] for n in names)):
+        yield dict(zip(names, values))
+
+
+def random_candidates(grid, n, rng):
+    size = 1
+    for v in grid.values():
+        size *= len(v)
+    if n >= size:
+        return list(grid_candidates(grid))
+    seen, out = set(), []
+    while len(out) < n:
+        c = {k: rng.choice(v) for k, v in sorted(grid.items())}
+        key = tuple(sorted(c.items()))
+        if key not in seen:
+            seen.add(key)
+            out.append(c)
+    return out
+
+
+def neighbours(grid, best, n, rng):
+    """Up to ``n`` configurations at most one grid step away from ``best`` in each parameter."""
+    out = []
+    for _ in range(n):
+        c = {}
+        for k, values in grid.items():
+            i = values.index(best[k]) if best.get(k) in values else rng.randrange(len(values))
+            c[k] = values[min(len(values) - 1, max(0, i + rng.choice((-1, 0, 1))))]
+        out.append(c)
+    return out
+
+
+def run_pool(pool, name, candidates, seen, results, progress=True):
+    todo = []
+    for c in candidates:
+        key = tuple(sorted(c.items()))
+        if key not in seen:
+            seen.add(key)
+            todo.append(c)
+    futures = [pool.submit(_score, name, c) for c in todo]
+    for i, fut in enumerate(as_completed(futures), 1):
+        results.append(fut.result())
+        if progress and (i % 10 == 0 or i == len(futures)):
+            print(f"  {i}/{len(futures)} configurations", file=sys.stderr)
+
+
+def _fmt(v, pat):
+    return '-' if v is None else pat % v
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description='Search detector parameters on labelled clips')
+    ap.add_argument('clips', nargs='+', help='video files or image directories (with <clip>.json labels)')
+    ap.add_argument('--detector', default=os.environ.get('VISION_DETECTOR', 'hough'), choices=sorted(GRIDS))
+    ap.add_argument('--search', default='random', choices=('grid', 'random'))
+    ap.add_argument('--trials', type=int, default=150, help='random samples of the grid')
+    ap.add_argument('--refine', type=int, default=40, help='extra samples around the best few (random search)')
+    ap.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    ap.add_argument('--max-frames', type=int, default=0, help='limit frames per clip (0 = all)')
+    ap.add_argument('--min-fps', type=float, default=0.0, help='rank slower configurations last')
+    ap.add_argument('--seed', type=int, default=0)
+    ap.add_argument('--top', type=int, default=10, help='rows to print')
+    ap.add_argument('--out', default=profile_path(), help='profile to write (default: VISION_PROFILE or vision_profile.json)')
+    ap.add_argument('--dry-run', action='store_true', help='print the ranking, do not write the profile')
+    args = ap.parse_args(argv)
+
+    name = args.detector
+    grid = GRIDS[name]
+    rng = random.Random(args.seed)
+    t0 = time.time()
+    results, seen = [], set()
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=_init_worker,
+                             initargs=(args.clips, args.max_frames or None)) as pool:
+        first = list(grid_candidates(grid)) if args.search == 'grid' else random_candidates(grid, args.trials, rng)
+        print(f"[tune] {name}: {len(first)} configurations on {len(args.clips)} clip(s), {args.workers} workers", file=sys.stderr)
+        run_pool(pool, name, first, seen, results)
+        if args.search == 'random' and args.refine:
+            results.sort(key=rank_key(args.min_fps))
+            per_best = max(1, args.refine // 3)
+            around = [c for r in results[:3] for c in neighbours(grid, r['params'], per_best, rng)]
+            print(f"[tune] refining around the best {min(3, len(results))}", file=sys.stderr)
+            run_pool(pool, name, around, seen, results)
+
+    if not results or not results[0]['labelled']:
+        print("[tune] no labelled frames: add <clip>.json with 'count' or 'counts'", file=sys.stderr)
+        return 1
+    results.sort(key=rank_key(args.min_fps))
+
+    cols = sorted(grid)
+    print(f"{'#':>3} {'exact':>6} {'MAE':>6} {'fps':>8}  " + ' '.join(f"{c:>11}" for c in cols))
+    for i, r in enumerate(results[:args.top], 1):
+        print(f"{i:3d} {_fmt(r['exact'] * 100, '%5.1f%%'):>6} {_fmt(r['mae'], '%6.2f'):>6} {r['fps']:8.1f}  "
+              + ' '.join(f"{r['params'][c]:>11}" for c in cols))
+    best = results[0]
+    print(f"[tune] {len(results)} configurations in {time.time() - t0:.1f}s", file=sys.stderr)
+    if args.dry_run:
+        return 0
+
+    profile = {
+        'detector': name,
+        'params': best['params'],
+        'score': {'exact': round(best['exact'], 4), 'mae': round(best['mae'], 4), 'fps': round(best['fps'], 1),
+                  'frames': best['frames'], 'labelled': best['labelled']},
+        'clips': [os.path.basename(c.rstrip('/\\')) for c in args.clips],
+        'search': {'mode': args.search, 'configurations': len(results), 'min_fps': args.min_fps},
+        'tuned_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+    tmp = args.out + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(profile, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, args.out)
+    print(f"[tune] wrote {args.out}: {name} {best['params']}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,367 @@
+"""Multi-camera vision service: one worker process per camera, one MQTT connection.
+
+    VISION_CAMERAS="0:2,1:4" python ino/cam/vision_service.py
+
+Each entry is ``<source>:<nodeId>`` (source = camera index, file or stream URL).
+Camera N listens on disp/cmd/{nodeId} + disp/evt/{nodeId}, publishes
+``vision_complete`` to disp/evt/{nodeId} once the node reports success, and sends
+a health/FPS snapshot to disp/vision/{nodeId} every VISION_HEALTH_INTERVAL seconds.
+
+The coordinator (this process) owns the paho client: it routes incoming commands
+to each worker's inbox queue and publishes whatever the workers put on the shared
+outbox queue. Workers never touch the network, and a crashed worker is restarted.
+
+The coordinator also owns one FrameBus (shared memory, framebus.py) per camera.
+The worker captures straight into it and detects on the same array, so frames
+never go through a queue. The coordinator serves them as an MJPEG preview
+(preview.py, http://<host>:VISION_PREVIEW_PORT/cam/<index>.mjpg), which is
+encoded only while someone is watching. A restarted worker reuses its camera's bus.
+
+With VISION_SNAPSHOTS=1 each worker also keeps an evidence FrameRing for its
+current queue (snapshots.py) and attaches the JPEG path of the best frame to
+``vision_complete`` as ``snapshot``, like cam.py does.
+"""
+import json
+import multiprocessing as mp
+import os
+import queue
+import signal
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+
+VISION_MQTT_BROKER = os.environ.get('VISION_MQTT_BROKER', '127.0.0.1')
+VISION_MQTT_PORT = int(os.environ.get('VISION_MQTT_PORT', '1883'))
+VISION_CAMERAS = os.environ.get('VISION_CAMERAS', '0:2')
+VISION_CMD_TOPIC_FMT = os.environ.get('VISION_CMD_TOPIC_FMT', 'disp/cmd/{node}')
+VISION_EVT_TOPIC_FMT = os.environ.get('VISION_EVT_TOPIC_FMT', 'disp/evt/{node}')
+VISION_HEALTH_TOPIC_FMT = os.environ.get('VISION_HEALTH_TOPIC_FMT', 'disp/vision/{node}')
+HEALTH_INTERVAL_SEC = float(os.environ.get('VISION_HEALTH_INTERVAL', '5.0'))
+FINAL_DELAY_SEC = float(os.environ.get('VISION_FINAL_DELAY', '0.5'))
+STABLE_METHOD = os.environ.get('VISION_STABLE_METHOD', 'mode')
+VISION_FRAMEBUS_PREFIX = os.environ.get('VISION_FRAMEBUS_PREFIX', 'vision-cam')
+REOPEN_BACKOFF_MAX = 30.0
+IDLE_POLL_SEC = 0.05   # loop period while there is no camera (inbox, finalize and health keep running)
+SNAPSHOTS_ENABLED = os.environ.get('VISION_SNAPSHOTS', '1') == '1'
+SNAPSHOT_DIR = os.environ.get('VISION_SNAPSHOT_DIR',
+                              os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'data', 'snapshots'))
+SNAPSHOT_RING = int(os.environ.get('VISION_SNAPSHOT_RING', '6'))
+SNAPSHOT_MAX_SIDE = int(os.environ.get('VISION_SNAPSHOT_MAX_SIDE', os.environ.get('VISION_SNAPSHOT_MAX_WIDTH', '640')))
+
+
+def parse_cameras(spec):
+    """Parse "0:2,rtsp://cam/1:4" -> [{'index': 0, 'source': 0, 'node': 2}, ...]"""
+    cams = []
+    for i, part in enumerate(p.strip() for p in spec.split(',') if p.strip()):
+        src, _, node = part.rpartition(':')
+        if not src:
+            raise ValueError(f"camera spec '{part}' must be <source>:<nodeId>")
+        cams.append({
+            'index': i,
+            'source': int(src) if src.isdigit() else src,
+            'node': int(node),
+        })
+    return cams
+
+
+def count_config_from_env():
+    from counting import CountConfig
+    return CountConfig(
+        mode=os.environ.get('VISION_COUNT_MODE', 'peak').lower(),
+        window=int(os.environ.get('VISION_STABILIZE_WINDOW', '7')),
+        track_dist=float(os.environ.get('VISION_TRACK_DIST_THRESHOLD', '45')),
+        entrance_y=int(os.environ.get('VISION_ENTRANCE_LINE_Y', '200')),
+        reentry_cooldown=float(os.environ.get('VISION_REENTRY_COOLDOWN', '1.2')),
+        single_debounce=float(os.environ.get('VISION_SINGLE_DEBOUNCE', '0.35')),
+        single_min_hold=int(os.environ.get('VISION_SINGLE_MIN_HOLD', '1')),
+    )
+
+
+# ---------------------------------------------------------------- worker side
+
+def _expected_from_items(items):
+    exp = 0
+    for it in items or []:
+        try:
+            exp += int(it.get('quantity') or 0)
+        except Exception:
+            pass
+    return exp if exp > 0 else None
+
+
+def camera_worker(cam, inbox, outbox, stop):
+    """Capture + detect + count loop for one camera (runs in its own process)."""
+    import cv2
+    from counting import CountingSession
+    from detectors import make_detector
+    from framebus import FrameBus
+    from snapshots import FrameRing, SnapshotWriter
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # coordinator handles Ctrl-C
+    node = cam['node']
+    evt_topic = VISION_EVT_TOPIC_FMT.format(node=node)
+    health_topic = VISION_HEALTH_TOPIC_FMT.format(node=node)
+    tag = f"[vision cam{cam['index']} node{node}]"
+
+    cfg = count_config_from_env()
+    detector = make_detector()
+    # started by the coordinator (spawn), so we share its resource tracker
+    bus = FrameBus.attach(cam['framebus'], untrack=False) if cam.get('framebus') else None
+    writer = SnapshotWriter(SNAPSHOT_DIR) if SNAPSHOTS_ENABLED else None
+    session = CountingSession(cfg)
+    finalize_at = None  # เวลาที่ต้องส่ง vision_complete (หลัง node success + delay)
+
+    started = time.time()
+    frames = 0
+    window_frames = 0
+    window_start = time.time()
+    fps = 0.0
+    last_health = 0.0
+    error = None
+    cap = None
+    backoff = 1.0
+    reopen_at = 0.0
+
+    def send(topic, payload):
+        try:
+            outbox.put_nowait((topic, json.dumps(payload), 1))
+        except queue.Full:
+            pass
+
+    def finalize():
+        nonlocal finalize_at
+        finalize_at = None
+        if session.queue_id is None or session.final_sent:
+            return
+        session.final_sent = True
+        final = session.final_count()
+        payload = {
+            "queue_id": session.queue_id,
+            "done": 1,
+            "status": "vision_complete",
+            "count_detected": final,
+            "expected": session.expected_total,
+            "camera": cam['index'],
+        }
+
+        def publish(snapshot=None):
+            if snapshot:
+                payload["snapshot"] = snapshot
+            send(evt_topic, payload)
+            print(f"{tag} vision_complete {final}/{payload['expected']} queue={payload['queue_id']} snapshot={snapshot}")
+
+        ring, session.evidence = session.evidence, None
+        frame = ring.best(final) if ring is not None else None
+        # JPEG goes to disk on the writer thread, which then publishes; if it is busy, publish without one
+        if frame is not None and writer.submit(frame, publish):
+            return
+        publish()
+
+    def handle(kind, payload):
+        nonlocal session, finalize_at
+        if kind == 'cmd':
+            qid = payload.get('queue_id')
+            expected = _expected_from_items(payload.get('items'))
+            qnum = payload.get('queue_number') or str(qid)
+            if qid != session.queue_id or session.final_sent:
+                session = CountingSession(cfg, qid, qnum, expected)
+                if writer is not None and qid is not None:
+                    session.evidence = FrameRing(SNAPSHOT_RING, SNAPSHOT_MAX_SIDE)
+                finalize_at = None
+            else:
+                session.queue_number = qnum
+                session.expected_total = expected
+            print(f"{tag} queue #{qnum} (id={qid}) expected={expected}")
+        elif kind == 'evt':
+            st = (payload.get('status') or '').lower()
+            if payload.get('done') == 1 and st == 'success' and payload.get('queue_id') == session.queue_id:
+                if not session.final_sent and finalize_at is None:
+                    finalize_at = time.time() + FINAL_DELAY_SEC
+
+    while not stop.is_set():
+        now = time.time()
+        # ---- inbox (non-blocking, handled between frames)
+        while True:
+            try:
+                kind, payload = inbox.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                handle(kind, payload)
+            except Exception as e:
+                print(f"{tag} bad message {kind}: {e}")
+        if finalize_at is not None and now >= finalize_at:
+            finalize()
+
+        # ---- camera (re)open with backoff; the loop keeps draining the inbox while it waits
+        if cap is None and now >= reopen_at:
+            cap = cv2.VideoCapture(cam['source'])
+            if not cap.isOpened():
+                cap.release()
+                cap = None
+                error = f"cannot open camera {cam['source']}"
+                reopen_at = time.time() + backoff
+                backoff = min(backoff * 2, REOPEN_BACKOFF_MAX)
+            else:
+                error = None
+                backoff = 1.0
+        if cap is None:
+            stop.wait(IDLE_POLL_SEC)
+        else:
+            ret, frame = bus.capture(cap) if bus is not None else cap.read()
+            if not ret:
+                cap.release()
+                cap = None
+                error = "frame read failed"
+            else:
+                pills = detector.detect(frame)
+                if bus is not None:
+                    bus.commit(pills, ts=now)
+                session.observe(pills, now)
+                if session.evidence is not None:
+                    session.evidence.offer(frame, len(pills), now, detections=pills)
+                frames += 1
+                window_frames += 1
+
+        # ---- health / fps
+        if now - window_start >= 1.0:
+            fps = window_frames / (now - window_start)
+            window_frames = 0
+            window_start = now
+        if now - last_health >= HEALTH_INTERVAL_SEC:
+            last_health = now
+            send(health_topic, {
+                "camera": cam['index'],
+                "source": str(cam['source']),
+                "healthy": error is None,
+                "error": error,
+                "fps": round(fps, 1),
+                "frames": frames,
+                "uptime": int(now - started),
+                "detector": detector.name,
+                "profile": os.path.basename(detector.profile) if detector.profile else None,
+                "queue_id": session.queue_id,
+                "latest": session.latest,
+                "stable": session.stable(STABLE_METHOD),
+            })
+
+    if cap is not None:
+        cap.release()
+    if bus is not None:
+        bus.close()
+
+
+# ------------------------------------------------------------ coordinator side
+
+class VisionCoordinator:
+    """Owns the MQTT connection and the camera worker processes."""
+
+    def __init__(self, cameras):
+        self.cameras = cameras
+        self.ctx = mp.get_context('spawn')
+        self.stop = self.ctx.Event()
+        self.outbox = self.ctx.Queue(maxsize=1000)
+        self.inboxes = {}
+        self.procs = {}
+        self.routes = {}  # topic -> (camera index, 'cmd'|'evt')
+        for cam in cameras:
+            self.inboxes[cam['index']] = self.ctx.Queue(maxsize=100)
+            self.routes[VISION_CMD_TOPIC_FMT.format(node=cam['node'])] = (cam['index'], 'cmd')
+            self.routes[VISION_EVT_TOPIC_FMT.format(node=cam['node'])] = (cam['index'], 'evt')
+        self.client = mqtt.Client()
+        self.client.on_connect = self._on_connect
+        self.client.on_message = self._on_message
+        self.buses = {}
+        self.preview = None
+
+    def _on_connect(self, client, userdata, flags, rc):
+        print(f"[vision] MQTT connected with result code {rc}")
+        if rc == 0:
+            for topic in self.routes:
+                client.subscribe(topic)
+            print(f"[vision] subscribed to {', '.join(self.routes)}")
+
+    def _on_message(self, client, userdata, msg):
+        route = self.routes.get(msg.topic)
+        if route is None:
+            return
+        try:
+            payload = json.loads(msg.payload.decode())
+        except Exception as e:
+            print(f"[vision] failed to parse MQTT message on {msg.topic}: {e}")
+            return
+        idx, kind = route
+        try:
+            self.inboxes[idx].put_nowait((kind, payload))
+        except queue.Full:
+            print(f"[vision] inbox full for camera {idx}, dropped {kind}")
+
+    def _start_worker(self, cam):
+        p = self.ctx.Process(target=camera_worker, name=f"vision-cam{cam['index']}",
+                             args=(cam, self.inboxes[cam['index']], self.outbox, self.stop),
+                             daemon=True)
+        p.start()
+        self.procs[cam['index']] = p
+        print(f"[vision] camera {cam['index']} ({cam['source']}) -> node {cam['node']} pid={p.pid}")
+
+    def _publisher_loop(self):
+        while not self.stop.is_set():
+            try:
+                topic, payload, qos = self.outbox.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            try:
+                self.client.publish(topic, payload, qos=qos)
+            except Exception as e:
+                print(f"[vision] publish failed on {topic}: {e}")
+
+    def _start_framebuses(self):
+        from framebus import FrameBus
+        from preview import start_preview
+        for cam in self.cameras:
+            bus = FrameBus.create(f"{VISION_FRAMEBUS_PREFIX}{cam['index']}")
+            self.buses[cam['index']] = bus
+            cam['framebus'] = bus.name
+        self.preview = start_preview(self.buses)   # None when VISION_PREVIEW_PORT=0
+
+    def run(self):
+        self.client.connect_async(VISION_MQTT_BROKER, VISION_MQTT_PORT, keepalive=60)
+        self.client.loop_start()
+        threading.Thread(target=self._publisher_loop, daemon=True).start()
+        self._start_framebuses()
+        for cam in self.cameras:
+            self._start_worker(cam)
+        try:
+            while not self.stop.is_set():
+                time.sleep(1.0)
+                for cam in self.cameras:
+                    p = self.procs.get(cam['index'])
+                    if p is not None and not p.is_alive():
+                        print(f"[vision] camera {cam['index']} worker exited ({p.exitcode}), restarting")
+                        self.client.publish(VISION_HEALTH_TOPIC_FMT.format(node=cam['node']), json.dumps({
+                            "camera": cam['index'], "healthy": False,
+                            "error": f"worker exited ({p.exitcode})", "fps": 0.0,
+                        }), qos=1)
+                        self._start_worker(cam)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop.set()
+            for p in self.procs.values():
+                p.join(timeout=3)
+            self.client.loop_stop()
+            if self.preview is not None:
+                self.preview.close()
+            for bus in self.buses.values():
+                bus.close()
+
+
+def main():
+    cameras = parse_cameras(VISION_CAMERAS)
+    print(f"[vision] starting {len(cameras)} camera worker(s), broker {VISION_MQTT_BROKER}:{VISION_MQTT_PORT}")
+    VisionCoordinator(cameras).run()
+
+
+if __name__ == '__main__':
+    main()
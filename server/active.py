@@ -0,0 +1,191 @@
+"""Active-queue context: what each line is working on right now.
+
+The dispatcher has everything about a queue in hand when it reserves it
+(items, patient, room), so it keeps that here instead of letting every
+vision report, node evt and dashboard refresh look it up again:
+
+    queue_id, line_id, patient, room, items, expected total,
+    per-node ack/done progress, created/dispatched timestamps, note
+
+Only the process that owns the MQTT client and dispatches has an
+authoritative context (``rebuild()`` at startup marks it so). Elsewhere, e.g.
+follower workers under gunicorn, ``for_line``/``get``/``current`` return None
+and callers fall back to SQL. The readiness watchdog calls ``reconcile()`` so
+queues finished or deleted through another path don't linger.
+"""
+import collections
+import logging
+import threading
+import time
+
+from . import catalogue
+from . import completion
+from . import lines
+from .db import query
+
+_logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_by_id = {}      # queue_id -> ActiveQueue
+_owner = False   # True once rebuild() ran in this process
+_finished = collections.deque(maxlen=256)   # recently finished ids, so reconcile() can't resurrect them
+
+
+class ActiveQueue:
+    __slots__ = ('queue_id', 'queue_number', 'line_id', 'patient_id', 'patient_name', 'target_room',
+                 'items', 'expected', 'note', 'created_at', 'dispatched_at', 'acked', 'done')
+
+    def __init__(self, row, line_id, items, dispatched_at=None):
+        self.queue_id = row['id']
+        self.queue_number = row.get('queue_number') or f"{row['id']:03d}"
+        self.line_id = line_id
+        self.patient_id = row['patient_id']
+        self.patient_name = row.get('patient_name')
+        self.target_room = row['target_room']
+        self.items = [{'pill_id': it['pill_id'], 'quantity': it['quantity']} for it in items]
+        self.expected = sum(it['quantity'] for it in items)
+        self.note = row.get('note')
+        self.created_at = row.get('created_at')
+        self.dispatched_at = dispatched_at or time.time()
+        self.acked = {}   # node_id -> ts
+        self.done = {}    # node_id -> status
+
+    def card(self):
+        """Same shape as a row of dashboard_payload()['pending']."""
+        pills = catalogue.pills_by_id()
+        room = next((r['name'] for r in catalogue.rooms() if r['id'] == self.target_room), None)
+        return {
+            'queue_id': self.queue_id,
+            'queue_number': self.queue_number,
+            'patient_name': self.patient_name,
+            'room': room,
+            'status': 'in_progress',
+            'note': self.note,
+            'line_id': self.line_id,
+            'items': [{'pill_id': it['pill_id'], 'name': pills.get(it['pill_id'], {}).get('name'),
+                       'quantity': it['quantity']} for it in self.items],
+        }
+
+    def as_dict(self):
+        return {k: getattr(self, k) for k in self.__slots__}
+
+
+def is_owner():
+    return _owner
+
+
+def start(row, line_id, items):
+    """Register a queue the dispatcher just reserved for ``line_id``."""
+    aq = ActiveQueue(row, line_id, items)
+    with _lock:
+        _by_id[aq.queue_id] = aq
+    return aq
+
+
+def get(qid):
+    return _by_id.get(qid) if _owner else None
+
+
+def for_line(line_id):
+    if not _owner:
+        return None
+    with _lock:
+        found = [aq for aq in _by_id.values() if aq.line_id == line_id]
+    return min(found, key=lambda aq: aq.queue_id) if found else None
+
+
+def current():
+    """Lowest-id active queue over all lines (the dashboard "current" card)."""
+    if not _owner:
+        return None
+    with _lock:
+        return min(_by_id.values(), key=lambda aq: aq.queue_id) if _by_id else None
+
+
+def snapshot():
+    with _lock:
+        return [aq.as_dict() for aq in sorted(_by_id.values(), key=lambda aq: aq.queue_id)]
+
+
+def mark_acked(qid, node_id):
+    aq = _by_id.get(qid)
+    if aq is not None and node_id is not None:
+        aq.acked.setdefault(node_id, time.time())
+
+
+def set_note(qid, note):
+    aq = _by_id.get(qid)
+    if aq is not None:
+        aq.note = note
+
+
+def finish(qid):
+    with _lock:
+        _finished.append(qid)
+        return _by_id.pop(qid, None)
+
+
+def _load(rows):
+    ids = [r['id'] for r in rows]
+    if not ids:
+        return {}
+    marks = ','.join('?' * len(ids))
+    items, done = {}, {}
+    for it in query(f"SELECT queue_id, pill_id, quantity FROM queue_items WHERE queue_id IN ({marks}) ORDER BY id", ids):
+        items.setdefault(it['queue_id'], []).append(it)
+    for c in query(f"SELECT queue_id, line_id, done, failed, required FROM queue_completion WHERE queue_id IN ({marks})", ids):
+        line = lines.get(c['line_id'])
+        if line is not None:
+            st = completion.State(c['done'], c['failed'], c['required'], line.nodes_mask).outcome(line)
+            done[c['queue_id']] = {p: v for p, v in st.items() if v}
+    out = {}
+    for r in rows:
+        aq = ActiveQueue(r, r['line_id'] or lines.DEFAULT_LINE, items.get(r['id'], []))
+        aq.done = done.get(r['id'], {})
+        out[aq.queue_id] = aq
+    return out
+
+
+_IN_PROGRESS_SQL = """
+    SELECT q.id, q.queue_number, q.patient_id, p.name AS patient_name, q.target_room, q.note,
+           q.created_at, q.line_id
+    FROM queues q LEFT JOIN patients p ON p.id=q.patient_id
+    WHERE q.status='in_progress'
+"""
+
+
+def rebuild():
+    """Load every in_progress queue from the DB and make this process the owner (startup)."""
+    global _owner
+    loaded = _load(query(_IN_PROGRESS_SQL))
+    with _lock:
+        _by_id.clear()
+        _by_id.update(loaded)
+        _owner = True
+    if loaded:
+        _logger.info('active queues rebuilt from DB: %s', sorted(loaded))
+    return len(loaded)
+
+
+def reconcile():
+    """Drop queues that are no longer in_progress and pick up ones reserved elsewhere."""
+    if not _owner:
+        return
+    t0 = time.time()
+    rows = query(_IN_PROGRESS_SQL)
+    want = {r['id'] for r in rows}
+    with _lock:
+        have = set(_by_id)
+        # a queue dispatched while the query ran is not in ``want`` yet
+        stale = [qid for qid in have - want if _by_id[qid].dispatched_at < t0]
+        for qid in stale:
+            _by_id.pop(qid, None)
+        missing = [r for r in rows if r['id'] not in have and r['id'] not in _finished]
+    if missing:
+        loaded = _load(missing)
+        with _lock:
+            for qid, aq in loaded.items():
+                if qid not in _finished:
+                    _by_id.setdefault(qid, aq)
+    if stale or missing:
+        _logger.info('active queues reconciled: dropped %s, loaded %s', sorted(stale), [r['id'] for r in missing])
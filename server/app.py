@@ -1,11 +1,26 @@
-from flask import Flask, send_from_directory, request, jsonify, current_app
+from flask import Flask, send_from_directory, request, jsonify, current_app, g, Response, stream_with_context
 from flask_cors import CORS
+import csv
+import io
 import json
-from .db import init_db, query, execute
+from .db import init_db, query, execute, get_conn, patient_fts_available
 from .config import FLASK_HOST, FLASK_PORT, MQTT_TOPIC_CMD
 from . import mqtt_client
+from . import dispatcher
+from . import metrics
+from . import tracing
+from . import reports
+from . import lines
+from . import catalogue
+from . import active
+from . import backup
+from . import intake
+from . import outbox
+from .logging_setup import setup_logging
 import os
+import time
 import logging
+from datetime import date, datetime, timedelta
 
 # detect react build folder
 build_static = os.path.join(os.path.dirname(__file__), '..', 'client', 'build', 'static')
@@ -20,10 +35,39 @@ else:
 app = Flask(__name__, static_folder=static_folder, static_url_path=static_url_path)
 CORS(app)
 
-# configure logging to show debug messages in console
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
-app.logger.setLevel(logging.DEBUG)
-logging.getLogger('werkzeug').setLevel(logging.INFO)
+# logging: queued to a listener thread, levels per category (see server/logging_setup.py)
+setup_logging()
+
+# ---- request metrics (latency per endpoint; db time is attributed via metrics.current_endpoint) ----
+@app.before_request
+def _metrics_start():
+    g._metrics_t0 = time.perf_counter()
+    g._metrics_token = metrics.current_endpoint.set(request.endpoint or '-')
+
+@app.after_request
+def _metrics_stop(response):
+    t0 = g.pop('_metrics_t0', None)
+    if t0 is not None:
+        metrics.HTTP_SECONDS.observe(time.perf_counter() - t0, request.endpoint or '-', request.method, response.status_code)
+    token = g.pop('_metrics_token', None)
+    if token is not None:
+        metrics.current_endpoint.reset(token)
+    return response
+
+# under gunicorn these live in the dispatcher owner's memory; followers ask it (server/dispatcher.py)
+dispatcher.register_query('metrics', metrics.REGISTRY.render)
+dispatcher.register_query('latency', lambda window=None: tracing.latency_stats(window))
+dispatcher.register_query('live_status', lambda: {
+    "node_ready": getattr(mqtt_client, '_node_ready', {}),
+    "node_online": getattr(mqtt_client, '_node_online', {}),
+    "vision_health": getattr(mqtt_client, '_vision_health', {}),
+    "active": active.snapshot(),
+    "pid": os.getpid(),
+})
+
+@app.get('/metrics')
+def prometheus_metrics():
+    return Response(dispatcher.ask_owner('metrics'), mimetype='text/plain; version=0.0.4')
 
 # ---- serve pages / react ----
 @app.route('/')
@@ -46,14 +90,14 @@ def serve_any(filename):
     return ('Not Found', 404)
 
 # ---- API: dashboard ----
-@app.get("/api/dashboard")
-def api_dashboard():
+def dashboard_payload():
+    """Everything the dashboard shows; shared by GET /api/dashboard and the push stream (server/asgi.py)."""
     pending = query("""
         SELECT q.id AS queue_id, q.queue_number, p.name AS patient_name, r.name AS room, q.status, q.note AS note
         FROM queues q
         JOIN patients p ON p.id=q.patient_id
         JOIN rooms r ON r.id=q.target_room
-        WHERE q.status IN ('pending','sent','in_progress')
+        WHERE q.status IN ('pending','sent','in_progress','deferred')
         ORDER BY q.created_at ASC
     """)
 
@@ -77,7 +121,9 @@ def api_dashboard():
     for q in pending:
         q['items'] = items_by_queue.get(q['queue_id'], [])
 
-    current = pending[0] if pending else None
+    # the queue a line is working on comes from the dispatcher's context when this process has it
+    aq = active.current()
+    current = aq.card() if aq is not None else (pending[0] if pending else None)
     next_q = pending[1] if len(pending) > 1 else None
 
     prev = query("""
@@ -90,7 +136,8 @@ def api_dashboard():
     """)
 
     processing = query("""
-        SELECT q.id AS queue_id, q.queue_number, p.name AS patient_name, r.name AS room, q.status, q.note AS note
+        SELECT q.id AS queue_id, q.queue_number, p.name AS patient_name, r.name AS room, q.status, q.note AS note,
+               q.line_id
         FROM queues q
         JOIN patients p ON p.id=q.patient_id
         JOIN rooms r ON r.id=q.target_room
@@ -120,9 +167,8 @@ def api_dashboard():
     """)
 
     logs = query("SELECT id, queue_id, ts, event, message FROM events ORDER BY id DESC LIMIT 50")
-    success_count = query("SELECT COUNT(*) AS cnt FROM queues WHERE status='success'")[0]["cnt"]
-    failed_count = query("SELECT COUNT(*) AS cnt FROM queues WHERE status='failed'")[0]["cnt"]
-    return jsonify({
+    success_count, failed_count = reports.totals()
+    return {
         "pending": pending,
         "processing": processing,
         "served": served,
@@ -133,14 +179,20 @@ def api_dashboard():
         "logs": logs,
         "success_count": success_count,
         "failed_count": failed_count
-    })
+    }
+
+@app.get("/api/dashboard")
+def api_dashboard():
+    return jsonify(dashboard_payload())
 
 @app.get("/api/lookup")
 def api_lookup():
+    # ?patients=0 skips the patient list (large tables: use /api/patients?q= typeahead instead)
+    with_patients = request.args.get("patients", "1") not in ("0", "false", "no")
     return jsonify({
-        "patients": query("SELECT id,name,note FROM patients ORDER BY id DESC"),
-        "pills": query("SELECT id,name,type,amount FROM pills ORDER BY id"),
-        "rooms": query("SELECT id,name FROM rooms ORDER BY id")
+        "patients": query("SELECT id,name,note FROM patients ORDER BY id DESC") if with_patients else [],
+        "pills": catalogue.pills(),
+        "rooms": catalogue.rooms()
     })
 
 
@@ -157,16 +209,13 @@ def api_add_queue():
       ]
     }
     """
-    # log raw body for debugging
-    raw = request.get_data(as_text=True)
     try:
         data = request.get_json(force=True)
     except Exception as e:
         app.logger.exception('Failed to parse JSON for /api/queues: %s', e)
         return jsonify({"error": "invalid json"}), 400
 
-    app.logger.debug('POST /api/queues raw body: %s', raw)
-    app.logger.debug('POST /api/queues parsed json: %s', data)
+    app.logger.debug('POST /api/queues payload: %s', data)
 
     patient_id = data.get("patient_id")
     items = data.get("items", [])
@@ -181,11 +230,7 @@ def api_add_queue():
         return jsonify({"error": "invalid patient_id"}), 400
 
     # Validate + normalize quantity (liquid = 1)
-    pill_ids = [int(x["pill_id"]) for x in items]
-    db_pills = {p["id"]: p for p in query(
-        f"SELECT id,name,type,amount FROM pills WHERE id IN ({','.join(['?']*len(pill_ids))})",
-        tuple(pill_ids)
-    )}
+    db_pills = catalogue.pills_by_id()
 
     norm_items = []
     any_liquid = False
@@ -205,79 +250,119 @@ def api_add_queue():
     # routing rule: ถ้ามีของเหลว ส่งไปห้อง 3, ถ้าไม่มี เลือก R1/R2 แบบ balance
     target_room = 3 if any_liquid else _pick_solid_room()
 
-    # สร้างคิว (header)
-    qid = execute(
-        "INSERT INTO queues(patient_id,target_room,status) VALUES(?,?,?)",
-        (patient_id, target_room, "pending")
-    )
-
-    # แทรกรายการยา (items)
-    for it in norm_items:
-        execute(
-            "INSERT INTO queue_items(queue_id,pill_id,quantity) VALUES(?,?,?)",
-            (qid, it["pill_id"], it["quantity"]) 
-        )
-        # ลดจำนวนสต็อกยาในตาราง pills ตามจำนวนที่จ่าย (ไม่ให้ติดลบ)
-        try:
-            # log current amount
-            before = query("SELECT amount FROM pills WHERE id=?", (it["pill_id"],))
-            app.logger.debug('Pill %s before amount=%s', it.get('pill_id'), (before[0]["amount"] if before else None))
-
-            execute(
+    # สร้างคิว (header) + รายการยา + ตัดสต็อก ใน transaction เดียว
+    # (the dispatcher never sees a queue without its items, and the stock we report is the stock we wrote)
+    updated_ids = sorted({it["pill_id"] for it in norm_items})
+    conn = get_conn()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        # admission limits are counted under the same write lock as the insert
+        status = intake.admit(conn, target_room)
+        qid = conn.execute(
+            "INSERT INTO queues(patient_id,target_room,status) VALUES(?,?,?)",
+            (patient_id, target_room, status)
+        ).lastrowid
+
+        # แทรกรายการยา (items)
+        for it in norm_items:
+            conn.execute(
+                "INSERT INTO queue_items(queue_id,pill_id,quantity) VALUES(?,?,?)",
+                (qid, it["pill_id"], it["quantity"])
+            )
+            # ลดจำนวนสต็อกยาในตาราง pills ตามจำนวนที่จ่าย (ไม่ให้ติดลบ)
+            conn.execute(
                 "UPDATE pills SET amount = MAX(0, amount - ?) WHERE id=?",
                 (it["quantity"], it["pill_id"])
             )
-
-            after = query("SELECT amount FROM pills WHERE id=?", (it["pill_id"],))
-            app.logger.debug('Pill %s after amount=%s', it.get('pill_id'), (after[0]["amount"] if after else None))
-        except Exception as e:
-            app.logger.exception('Failed to update pill amount for pill_id=%s: %s', it.get('pill_id'), e)
+        updated_pills = [dict(r) for r in conn.execute(
+            f"SELECT id, amount FROM pills WHERE id IN ({','.join(['?'] * len(updated_ids))})", updated_ids)]
+        conn.commit()
+    except intake.Overloaded as e:
+        conn.rollback()
+        app.logger.warning('Queue for patient %s rejected: %s', patient_id, e.reason)
+        resp = jsonify({"error": "overloaded", "reason": e.reason, "retry_after": e.retry_after})
+        resp.headers['Retry-After'] = str(e.retry_after)
+        return resp, 429
+    except Exception as e:
+        conn.rollback()
+        app.logger.exception('Failed to create queue for patient %s: %s', patient_id, e)
+        return jsonify({"error": "failed to create queue"}), 500
+    finally:
+        conn.close()
+    catalogue.set_stock(updated_pills)
 
     # event log
     # enrich items with pill name for event log (for all event types)
     def enrich_items(items):
-        pill_ids = [int(x["pill_id"]) for x in items]
-        pills = {p["id"]: p for p in query(
-            f"SELECT id,name FROM pills WHERE id IN ({','.join(['?']*len(pill_ids))})",
-            tuple(pill_ids)
-        )}
-        return [{"pill_id": it["pill_id"], "name": pills.get(it["pill_id"],{}).get("name"), "quantity": it["quantity"]} for it in items]
+        return [{"pill_id": it["pill_id"], "name": db_pills.get(it["pill_id"], {}).get("name"), "quantity": it["quantity"]} for it in items]
 
     execute("INSERT INTO events(queue_id, event, message) VALUES(?,?,?)",
             (qid, "created", json.dumps({"patient_id": patient_id, "items": enrich_items(norm_items)})))
+    tracing.mark(qid, 'created')
 
     # Try to dispatch immediately if both nodes are ready
     try:
-        client = mqtt_client.get_client()
-        # Use centralized dispatch instead of per-node dispatch
-        mqtt_client._dispatch_next_queue(client)
+        # Use centralized dispatch (forwarded to the elected dispatcher under server/wsgi.py)
+        dispatcher.trigger()
     except Exception as e:
         app.logger.exception('Failed to dispatch queue immediately: %s', e)
 
     # return queue_number และ updated pill amounts เพื่อให้ client อัปเดตสต็อกทันที
     qrow = query("SELECT queue_number FROM queues WHERE id=?", (qid,))
+    app.logger.debug('Queue %s created, updated_pills: %s', qid, updated_pills)
 
-    # build list of pill ids from the normalized items (safer)
+    body = {"queue_id": qid, "queue_number": qrow[0]["queue_number"], "target_room": target_room,
+            "status": status, "updated_pills": updated_pills}
     try:
-        updated_ids = [it['pill_id'] for it in norm_items]
-        if updated_ids:
-            placeholders = ','.join(['?'] * len(updated_ids))
-            updated_pills = query(f"SELECT id, amount FROM pills WHERE id IN ({placeholders})", tuple(updated_ids))
-        else:
-            updated_pills = []
+        body.update(intake.predict(qid))
     except Exception as e:
-        app.logger.exception('Failed to fetch updated_pills: %s', e)
-        updated_pills = []
-    app.logger.debug('Returning updated_pills: %s', updated_pills)
-
-    return jsonify({"queue_id": qid, "queue_number": qrow[0]["queue_number"], "target_room": target_room, "updated_pills": updated_pills})
+        app.logger.warning('wait prediction failed for queue %s: %s', qid, e)
+    return jsonify(body), (202 if status == 'deferred' else 200)
 
 def _pick_solid_room():
     r1 = query("SELECT COUNT(*) cnt FROM queues WHERE target_room=1")[0]["cnt"]
     r2 = query("SELECT COUNT(*) cnt FROM queues WHERE target_room=2")[0]["cnt"]
     return 1 if r1 <= r2 else 2
 
-# ---- API: CRUD (ตัวอย่างเดิม) ----
+# ---- API: patients (ค้นหา + แบ่งหน้า) ----
+PATIENTS_PAGE_MAX = 100
+
+@app.get("/api/patients")
+def list_patients():
+    """Newest first, cursor-paginated: ?q=&cursor=<last id>&limit=.
+
+    q of 3+ characters per word uses the trigram FTS index (substring match, Thai ok);
+    shorter input, or an SQLite without FTS5 trigram, falls back to LIKE.
+    """
+    q = (request.args.get("q") or "").strip()
+    try:
+        limit = max(1, min(PATIENTS_PAGE_MAX, int(request.args.get("limit", 20))))
+        cursor = int(request.args["cursor"]) if request.args.get("cursor") else None
+    except ValueError:
+        return jsonify({"error": "invalid cursor/limit"}), 400
+
+    where, params = [], []
+    if cursor is not None:
+        where.append("p.id < ?")
+        params.append(cursor)
+    words = q.split()
+    if words and all(len(w) >= 3 for w in words) and patient_fts_available():
+        sql = "SELECT p.id, p.name, p.note FROM patients_fts f JOIN patients p ON p.id=f.rowid"
+        where.insert(0, "patients_fts MATCH ?")
+        params.insert(0, " AND ".join('"%s"' % w.replace('"', '""') for w in words))
+    else:
+        sql = "SELECT p.id, p.name, p.note FROM patients p"
+        for w in words:
+            where.append("(p.name LIKE ? ESCAPE '\\' OR p.note LIKE ? ESCAPE '\\')")
+            pat = "%" + w.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+            params += [pat, pat]
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    rows = query(sql + " ORDER BY p.id DESC LIMIT ?", tuple(params) + (limit + 1,))
+    more = len(rows) > limit
+    rows = rows[:limit]
+    return jsonify({"items": rows, "next_cursor": rows[-1]["id"] if more else None})
+
 @app.post("/api/patients")
 def add_patient():
     d = request.get_json(force=True)
@@ -295,43 +380,210 @@ def patch_queue_note(qid):
 @app.post('/api/vision/current')
 def vision_update_current():
     """Attach vision detection result to the currently in_progress queue.
-    Body JSON: {"count_detected": <int>}.
-    Logic: find lowest-id queue with status='in_progress'; compare detected with expected sum(quantity) in queue_items; update note.
+    Body JSON: {"count_detected": <int>, "snapshot": <path> (optional), "line_id": <int> (optional)}.
+    Logic: find lowest-id queue with status='in_progress' (on that line); compare detected with expected sum(quantity) in queue_items; update note.
     """
     data = request.get_json(force=True) or {}
     try:
         detected = int(data.get('count_detected'))
     except Exception:
         return jsonify({"error": "count_detected required int"}), 400
-    # find current in_progress queue
-    cur = query("SELECT id FROM queues WHERE status='in_progress' ORDER BY id ASC LIMIT 1")
-    if not cur:
-        return jsonify({"error": "no in_progress queue"}), 404
-    qid = cur[0]['id']
-    expected_row = query("SELECT COALESCE(SUM(quantity),0) AS total FROM queue_items WHERE queue_id=?", (qid,))
-    expected = expected_row[0]['total'] if expected_row else 0
+    # find current in_progress queue (in-memory in the dispatching process, see server/active.py)
+    if active.is_owner():
+        aq = active.for_line(data['line_id']) if data.get('line_id') is not None else active.current()
+        if aq is None:
+            return jsonify({"error": "no in_progress queue"}), 404
+        qid, expected = aq.queue_id, aq.expected
+    else:
+        if data.get('line_id') is not None:
+            cur = query("SELECT id FROM queues WHERE status='in_progress' AND line_id=? ORDER BY id ASC LIMIT 1",
+                        (data['line_id'],))
+        else:
+            cur = query("SELECT id FROM queues WHERE status='in_progress' ORDER BY id ASC LIMIT 1")
+        if not cur:
+            return jsonify({"error": "no in_progress queue"}), 404
+        qid = cur[0]['id']
+        expected_row = query("SELECT COALESCE(SUM(quantity),0) AS total FROM queue_items WHERE queue_id=?", (qid,))
+        expected = expected_row[0]['total'] if expected_row else 0
     if detected == expected:
         note = f"ตรวจนับถูกต้อง {detected}/{expected}"
     else:
         note = f"จำนวนไม่ตรง {detected}/{expected}"
+    message = note
+    if data.get('snapshot'):
+        message = f"{note} snapshot={data['snapshot']}"
     execute("UPDATE queues SET note=? WHERE id=?", (note, qid))
-    execute("INSERT INTO events(queue_id,event,message) VALUES(?,?,?)", (qid, 'vision_check', note))
+    execute("INSERT INTO events(queue_id,event,message) VALUES(?,?,?)", (qid, 'vision_check', message))
+    active.set_note(qid, note)
+    tracing.mark(qid, 'vision_finalized')
+    state = mqtt_client.record_vision(qid, detected == expected)
+    if state is not None and state.complete and dispatcher.role() == 'follower':
+        # the owner dispatched nothing for this completion: hand it the next queue like the other follower writes do
+        dispatcher.trigger()
     return jsonify({"queue_id": qid, "expected": expected, "detected": detected, "note": note})
 
+@app.get('/api/queues/<int:qid>/trace')
+def queue_trace(qid):
+    """Lifecycle spans of one queue (created → reserved → published → acked/done per node → vision → served)."""
+    return jsonify({"queue_id": qid, "spans": tracing.trace(qid)})
+
+@app.get('/api/stats/latency')
+def stats_latency():
+    """p50/p95/p99 per stage (ms since created) over the in-memory sliding window. ?window=<sec>"""
+    window = request.args.get('window', type=float)
+    return jsonify({"window_sec": window or tracing.TRACE_WINDOW_SEC, "stages": dispatcher.ask_owner('latency', window=window)})
+
+# ---- API: history (keyset pagination + streaming export) ----
+HISTORY_PAGE_MAX = 500
+EXPORT_BATCH = 1000
+
+QUEUE_HISTORY_SQL = """
+    SELECT q.id, q.queue_number, q.patient_id, p.name AS patient_name, q.target_room, r.name AS room,
+           q.status, q.created_at, q.served_at, q.note, q.failed_reason
+    FROM {db}.queues q
+    JOIN patients p ON p.id=q.patient_id
+    JOIN rooms r ON r.id=q.target_room
+"""
+QUEUE_HISTORY_COLUMNS = ['id', 'queue_number', 'patient_id', 'patient_name', 'target_room', 'room',
+                         'status', 'created_at', 'served_at', 'note', 'failed_reason']
+EVENT_HISTORY_SQL = "SELECT e.id, e.queue_id, e.ts, e.event, e.message FROM {db}.events e"
+EVENT_HISTORY_COLUMNS = ['id', 'queue_id', 'ts', 'event', 'message']
+
+
+def _keyset_rows(sql, key, where, params, before, limit):
+    """Rows newest-first (``key`` DESC) below ``before``, fetched EXPORT_BATCH at a time.
+
+    Each batch is its own short query, so an export never holds a read
+    transaction open or more than one batch in memory. ``sql`` names its main
+    table as ``{db}.<table>``; every batch reads app.db and archive.db (ids are
+    shared, see server/archive.py), each side on its own index, and merges.
+    """
+    remaining = limit
+    while remaining is None or remaining > 0:
+        n = EXPORT_BATCH if remaining is None else min(EXPORT_BATCH, remaining)
+        w, p = list(where), list(params)
+        if before is not None:
+            w.append(f"{key} < ?")
+            p.append(before)
+        arm = sql + (" WHERE " + " AND ".join(w) if w else "") + f" ORDER BY {key} DESC LIMIT ?"
+        rows = query(f"SELECT * FROM ({arm.format(db='main')}) UNION ALL SELECT * FROM ({arm.format(db='archive')}) "
+                     "ORDER BY id DESC LIMIT ?", (tuple(p) + (n,)) * 2 + (n,), archive=True)
+        yield from rows
+        if len(rows) < n:
+            return
+        before = rows[-1]['id']
+        if remaining is not None:
+            remaining -= len(rows)
+
+
+def _history_response(sql, key, where, params, columns, name):
+    """JSON page ({items, next_before}) or, with ?format=csv|ndjson, a streamed export."""
+    try:
+        before = int(request.args['before']) if request.args.get('before') else None
+        limit = int(request.args['limit']) if request.args.get('limit') else None
+    except ValueError:
+        return jsonify({"error": "invalid before/limit"}), 400
+    fmt = request.args.get('format', 'json')
+    if fmt in ('csv', 'ndjson'):
+        rows = _keyset_rows(sql, key, where, params, before, limit)   # limit=None: everything
+        if fmt == 'ndjson':
+            body = (json.dumps(r, ensure_ascii=False, default=str) + '\n' for r in rows)
+            mimetype = 'application/x-ndjson'
+        else:
+            def body():
+                buf = io.StringIO()
+                w = csv.writer(buf)
+                w.writerow(columns)
+                yield '\ufeff' + buf.getvalue()   # BOM so spreadsheet apps read Thai as UTF-8
+                for r in rows:
+                    buf.seek(0)
+                    buf.truncate()
+                    w.writerow([r.get(c) for c in columns])
+                    yield buf.getvalue()
+            body = body()
+            mimetype = 'text/csv'
+        resp = Response(stream_with_context(body), mimetype=mimetype)
+        resp.headers['Content-Disposition'] = f'attachment; filename={name}.{fmt}'
+        return resp
+    if fmt != 'json':
+        return jsonify({"error": "format must be json, csv or ndjson"}), 400
+    limit = max(1, min(HISTORY_PAGE_MAX, limit or 50))
+    items = list(_keyset_rows(sql, key, where, params, before, limit + 1))
+    more = len(items) > limit
+    items = items[:limit]
+    return jsonify({"items": items, "next_before": items[-1]['id'] if more else None})
+
+
+@app.get("/api/queues")
+def list_queues():
+    """Queue history, newest first: ?status=success,failed&before=<id>&limit=&format=json|csv|ndjson"""
+    where, params = [], []
+    statuses = [x for x in (request.args.get('status') or '').split(',') if x]
+    if statuses:
+        where.append(f"q.status IN ({','.join(['?'] * len(statuses))})")
+        params += statuses
+    return _history_response(QUEUE_HISTORY_SQL, 'q.id', where, params, QUEUE_HISTORY_COLUMNS, 'queues')
+
+
+@app.get("/api/events")
+def list_events():
+    """Event log, newest first: ?queue_id=&event=a,b&before=<id>&limit=&format=json|csv|ndjson"""
+    where, params = [], []
+    if request.args.get('queue_id'):
+        try:
+            params.append(int(request.args['queue_id']))
+        except ValueError:
+            return jsonify({"error": "invalid queue_id"}), 400
+        where.append("e.queue_id = ?")
+    events = [x for x in (request.args.get('event') or '').split(',') if x]
+    if events:
+        where.append(f"e.event IN ({','.join(['?'] * len(events))})")
+        params += events
+    return _history_response(EVENT_HISTORY_SQL, 'e.id', where, params, EVENT_HISTORY_COLUMNS, 'events')
+
+# ---- API: reports (อ่านจาก rollup รายวันเท่านั้น) ----
+@app.get("/api/reports")
+def api_reports():
+    """?from=YYYY-MM-DD&to=YYYY-MM-DD (default: last 30 days) -> totals + per day / room / pill."""
+    today = datetime.utcnow().date()
+    try:
+        day_to = date.fromisoformat(request.args['to']) if request.args.get('to') else today
+        day_from = date.fromisoformat(request.args['from']) if request.args.get('from') else day_to - timedelta(days=29)
+    except ValueError:
+        return jsonify({"error": "from/to must be YYYY-MM-DD"}), 400
+    return jsonify(reports.report(day_from.isoformat(), day_to.isoformat()))
+
+# ---- API: backups (online backup API ทีละไม่กี่หน้า ไม่บล็อกการ dispatch) ----
+@app.post("/api/backup")
+def api_backup():
+    try:
+        return jsonify({"backups": backup.run_once()})
+    except backup.BackupBusy:
+        return jsonify({"error": "a backup is already running"}), 409
+    except Exception as e:
+        app.logger.exception('on-demand backup failed: %s', e)
+        return jsonify({"error": str(e)}), 500
+
+@app.get("/api/backups")
+def api_backups():
+    return jsonify({"backups": backup.list_backups()})
+
 @app.delete("/api/queues/<int:qid>")
 def del_queue(qid):
     execute("DELETE FROM queues WHERE id=?", (qid,))
+    active.finish(qid)
     return jsonify({"ok": True})
 
 @app.get("/api/pills")
 def list_pills():
-    return jsonify(query("SELECT id,name,type,amount FROM pills ORDER BY id"))
+    return jsonify(catalogue.pills())
 
 @app.post("/api/pills")
 def create_pill():
     d = request.get_json(force=True)
     pid = execute("INSERT INTO pills(name,amount,type) VALUES(?,?,?)",
                   (d["name"], int(d.get("amount",0)), d["type"]))
+    catalogue.invalidate()
     return jsonify({"id": pid})
 
 @app.patch("/api/pills/<int:pid>")
@@ -339,11 +591,13 @@ def patch_pill(pid):
     d = request.get_json(force=True)
     if "delta" in d:
       execute("UPDATE pills SET amount = MAX(0, amount + ?) WHERE id=?", (int(d["delta"]), pid))
+      catalogue.invalidate()
     return jsonify({"ok": True})
 
 @app.delete("/api/pills/<int:pid>")
 def delete_pill(pid):
     execute("DELETE FROM pills WHERE id=?", (pid,))
+    catalogue.invalidate()
     return jsonify({"ok": True})
 
 @app.post('/api/drugs')
@@ -374,6 +628,7 @@ def update_drugs():
     for old in old_pills:
         if int(old['id']) not in new_ids:
             execute('DELETE FROM pills WHERE id=?', (int(old['id']),))
+    catalogue.invalidate()
     return jsonify({'ok': True})
 
 
@@ -382,8 +637,9 @@ def update_drugs():
 def debug_manual_dispatch():
     """Manual dispatch trigger for debugging"""
     try:
-        client = mqtt_client.get_client()
-        result = mqtt_client._dispatch_next_queue(client)
+        result = dispatcher.trigger()
+        if dispatcher.role() == 'follower':
+            return jsonify({"dispatched": None, "message": "Dispatch forwarded to the dispatcher worker"})
         return jsonify({"dispatched": result, "message": "Manual dispatch attempted"})
     except Exception as e:
         app.logger.exception('Manual dispatch failed: %s', e)
@@ -392,16 +648,26 @@ def debug_manual_dispatch():
 @app.get('/api/debug/status')
 def debug_system_status():
     """Get system status for debugging"""
-    active_queues = query("SELECT id, status FROM queues WHERE status='in_progress'")
+    active_queues = query("SELECT id, status, line_id FROM queues WHERE status='in_progress'")
+    in_progress = {q['line_id']: q['id'] for q in active_queues}
     pending_queues = query("SELECT id, status FROM queues WHERE status='pending' ORDER BY id ASC LIMIT 5")
     recent_events = query("SELECT * FROM events ORDER BY id DESC LIMIT 10")
+    live = dispatcher.ask_owner('live_status')
     
     return jsonify({
         "active_queues": active_queues,
         "pending_queues": pending_queues, 
         "recent_events": recent_events,
-        "node_ready": getattr(mqtt_client, '_node_ready', {}),
-        "node_online": getattr(mqtt_client, '_node_online', {})
+        "node_ready": live['node_ready'],
+        "node_online": live['node_online'],
+        "vision_health": live['vision_health'],
+        "active": live['active'],
+        "owner_pid": live['pid'],
+        "outbox": outbox.stats(),
+        "lines": [{"line_id": l.id, "nodes": l.nodes, "ready": mqtt_client._line_ready_db(l),
+                   "in_progress": in_progress.get(l.id)} for l in lines.all_lines()],
+        "dispatcher_role": dispatcher.role(),
+        "pid": os.getpid()
     })
 
 
@@ -0,0 +1,200 @@
+"""Move finished queues out of the hot tables into an attached archive DB.
+
+``queues`` and its per-queue tables (CHILD_TABLES) in app.db only keep
+what dispatch and the dashboard work on: pending/in-progress queues and the
+recently finished ones. ``success``/``failed`` queues older than
+ARCHIVE_AFTER_DAYS move, together with their items, events, trace spans and
+completion state, to data/archive.db (same tables, same ids). Each batch is
+one transaction over both files: copy with ``INSERT OR IGNORE`` then delete,
+so a batch that is interrupted is simply redone.
+
+History reads (/api/queues, /api/events, traces, rollup backfill) attach the
+archive and cover both. Daily rollups are not touched: they already count
+archived queues.
+
+    python -m server.archive run [--days N] [--batch N]
+    python -m server.archive stats
+
+Environment:
+    ARCHIVE_PATH=data/archive.db   (next to DB_PATH)
+    ARCHIVE_AFTER_DAYS=30          0 disables the scheduled run
+    ARCHIVE_BATCH=500              queues per transaction
+    ARCHIVE_INTERVAL=3600          seconds between scheduled runs
+"""
+import argparse
+import logging
+import os
+import threading
+import time
+from contextlib import closing
+
+from .db import get_conn
+
+_logger = logging.getLogger(__name__)
+
+ARCHIVE_AFTER_DAYS = float(os.getenv("ARCHIVE_AFTER_DAYS", "30"))
+ARCHIVE_BATCH = int(os.getenv("ARCHIVE_BATCH", "500"))
+ARCHIVE_INTERVAL = float(os.getenv("ARCHIVE_INTERVAL", "3600"))
+
+# same layout as init.sql, without foreign keys (patients/rooms/pills stay in app.db)
+ARCHIVE_SQL = """
+CREATE TABLE IF NOT EXISTS archive.queues(
+  id INTEGER PRIMARY KEY,
+  patient_id INTEGER NOT NULL,
+  target_room INTEGER NOT NULL,
+  queue_number TEXT GENERATED ALWAYS AS (printf('%03d',id)) VIRTUAL,
+  status TEXT NOT NULL,
+  retry_count INTEGER NOT NULL DEFAULT 0,
+  created_at DATETIME,
+  served_at DATETIME,
+  note TEXT,
+  failed_reason TEXT,
+  line_id INTEGER,
+  archived_at DATETIME DEFAULT CURRENT_TIMESTAMP
+);
+CREATE TABLE IF NOT EXISTS archive.queue_items(
+  id INTEGER PRIMARY KEY,
+  queue_id INTEGER NOT NULL,
+  pill_id INTEGER NOT NULL,
+  quantity INTEGER NOT NULL DEFAULT 1
+);
+CREATE TABLE IF NOT EXISTS archive.events(
+  id INTEGER PRIMARY KEY,
+  queue_id INTEGER,
+  ts DATETIME,
+  event TEXT NOT NULL,
+  message TEXT
+);
+CREATE TABLE IF NOT EXISTS archive.queue_trace(
+  id INTEGER PRIMARY KEY,
+  queue_id INTEGER NOT NULL,
+  stage TEXT NOT NULL,
+  node_id INTEGER,
+  ts REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS archive.queue_completion(
+  queue_id INTEGER PRIMARY KEY,
+  line_id INTEGER NOT NULL,
+  required INTEGER NOT NULL,
+  done INTEGER NOT NULL DEFAULT 0,
+  failed INTEGER NOT NULL DEFAULT 0,
+  updated_at REAL
+);
+CREATE INDEX IF NOT EXISTS archive.idx_queues_status_id ON queues(status, id);
+CREATE INDEX IF NOT EXISTS archive.idx_queue_items_queue ON queue_items(queue_id);
+CREATE INDEX IF NOT EXISTS archive.idx_events_queue_id ON events(queue_id, id);
+CREATE INDEX IF NOT EXISTS archive.idx_events_event_id ON events(event, id);
+CREATE INDEX IF NOT EXISTS archive.idx_queue_trace_queue ON queue_trace(queue_id, ts);
+"""
+
+# tables whose rows follow their queue into the archive
+CHILD_TABLES = ('queue_items', 'events', 'queue_trace', 'queue_completion')
+
+_started = False
+
+
+def _columns(conn, schema, table):
+    # table_info leaves out generated columns (queue_number), which cannot be inserted
+    return [r[1] for r in conn.execute(f"PRAGMA {schema}.table_info({table})")]
+
+
+def init_archive():
+    """Create the archive tables and add any column app.db gained since (called from init_db)."""
+    with closing(get_conn(archive=True)) as conn:
+        conn.executescript(ARCHIVE_SQL)
+        for table in ('queues',) + CHILD_TABLES:
+            have = set(_columns(conn, 'archive', table))
+            types = {r[1]: r[2] for r in conn.execute(f"PRAGMA main.table_info({table})")}
+            for col in _columns(conn, 'main', table):
+                if col not in have:
+                    conn.execute(f"ALTER TABLE archive.{table} ADD COLUMN {col} {types[col]}")
+        conn.commit()
+
+
+def archive_batch(conn, days, batch):
+    """Move up to ``batch`` finished queues older than ``days``; returns how many moved."""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        ids = [r[0] for r in conn.execute("""
+            SELECT id FROM main.queues
+            WHERE status IN ('success','failed') AND COALESCE(served_at, created_at) < datetime('now', ?)
+            ORDER BY id LIMIT ?""", (f'-{days} days', batch))]
+        if not ids:
+            conn.rollback()
+            return 0
+        marks = ','.join('?' * len(ids))
+        for table, key in (('queues', 'id'),) + tuple((t, 'queue_id') for t in CHILD_TABLES):
+            cols = ','.join(_columns(conn, 'main', table))
+            conn.execute(f"INSERT OR IGNORE INTO archive.{table}({cols}) "
+                         f"SELECT {cols} FROM main.{table} WHERE {key} IN ({marks})", ids)
+        for table in CHILD_TABLES:
+            conn.execute(f"DELETE FROM main.{table} WHERE queue_id IN ({marks})", ids)
+        conn.execute(f"DELETE FROM main.queues WHERE id IN ({marks})", ids)
+        conn.commit()
+        return len(ids)
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def run_once(days=None, batch=None):
+    """Archive everything that is due, one batch per transaction (short write locks)."""
+    days = ARCHIVE_AFTER_DAYS if days is None else days
+    batch = batch or ARCHIVE_BATCH
+    t0 = time.time()
+    moved = 0
+    with closing(get_conn(archive=True)) as conn:
+        conn.isolation_level = None   # explicit BEGIN/COMMIT per batch
+        while True:
+            n = archive_batch(conn, days, batch)
+            moved += n
+            if n < batch:
+                break
+            time.sleep(0.05)   # let dispatch / API writes in between batches
+    if moved:
+        _logger.info('archived %s queues older than %s days in %.1fs', moved, days, time.time() - t0)
+    return moved
+
+
+def stats():
+    with closing(get_conn(archive=True)) as conn:
+        return {f"{schema}.{table}": conn.execute(f"SELECT COUNT(*) FROM {schema}.{table}").fetchone()[0]
+                for schema in ('main', 'archive') for table in ('queues',) + CHILD_TABLES}
+
+
+def start_scheduler():
+    """Run the archiver every ARCHIVE_INTERVAL seconds on a daemon thread (once per process)."""
+    global _started
+    if _started or ARCHIVE_AFTER_DAYS <= 0:
+        return
+    _started = True
+
+    def loop():
+        while True:
+            try:
+                run_once()
+            except Exception as e:
+                _logger.warning('archive run failed: %s', e)
+            time.sleep(ARCHIVE_INTERVAL)
+
+    threading.Thread(target=loop, name='archiver', daemon=True).start()
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(prog='python -m server.archive', description='Move old finished queues to the archive DB')
+    sub = ap.add_subparsers(dest='cmd', required=True)
+    r = sub.add_parser('run', help='archive finished queues older than --days')
+    r.add_argument('--days', type=float, default=ARCHIVE_AFTER_DAYS)
+    r.add_argument('--batch', type=int, default=ARCHIVE_BATCH)
+    sub.add_parser('stats', help='row counts in app.db and archive.db')
+    args = ap.parse_args(argv)
+    init_archive()
+    if args.cmd == 'run':
+        print(f"archived {run_once(args.days, args.batch)} queues")
+    else:
+        for k, v in stats().items():
+            print(f"{k:24} {v}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,465 @@
+"""Optional asyncio runtime: HTTP API, MQTT and the dashboard push stream on one event loop.
+
+    python -m server.asgi                 # uvicorn if installed, else the built-in asyncio server
+    uvicorn server.asgi:app --port 5000   # same app under any ASGI server
+
+* the existing Flask routes run unchanged through a WSGI bridge on a small
+  thread pool (``ASGI_HTTP_WORKERS``); nothing blocking runs on the loop
+* MQTT is an ``AsyncMQTTClient`` (server/mqtt_async.py) whose handlers run on
+  one dedicated thread, so message order matches the paho runtime
+  (MQTT_MODE=embedded keeps the in-process broker client instead)
+* the readiness watchdog and the initial dispatch are loop timers, their DB
+  work goes to ``ASGI_DB_WORKERS`` threads
+* ``GET /api/stream`` is a Server-Sent Events feed of the dashboard payload.
+  One snapshot is computed per change (MQTT message, write request) or every
+  ``ASGI_PUSH_INTERVAL`` seconds and fanned out to every subscriber, so a
+  hundred open dashboards cost the same DB work as one
+"""
+import asyncio
+import io
+import json
+import logging
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote
+
+from .config import FLASK_HOST, FLASK_PORT, MQTT_BROKER, MQTT_CLIENT_ID, MQTT_MODE, MQTT_PORT
+from .db import init_db
+from . import archive
+from . import backup
+from . import mqtt_client
+from .app import app as flask_app, dashboard_payload
+
+_logger = logging.getLogger(__name__)
+
+HTTP_WORKERS = int(os.getenv("ASGI_HTTP_WORKERS", "8"))
+DB_WORKERS = int(os.getenv("ASGI_DB_WORKERS", "2"))
+PUSH_INTERVAL = float(os.getenv("ASGI_PUSH_INTERVAL", "2.0"))    # refresh even without a change trigger
+PUSH_KEEPALIVE = float(os.getenv("ASGI_PUSH_KEEPALIVE", "15"))   # SSE comment to keep proxies from closing
+
+_http_pool = ThreadPoolExecutor(HTTP_WORKERS, thread_name_prefix='asgi-http')
+_db_pool = ThreadPoolExecutor(DB_WORKERS, thread_name_prefix='asgi-db')
+_mqtt_pool = ThreadPoolExecutor(1, thread_name_prefix='asgi-mqtt')
+
+
+# ---------------------------------------------------------------- dashboard push
+
+class DashboardHub:
+    """Computes the dashboard payload once per change and fans it out to all subscribers."""
+
+    def __init__(self, interval=PUSH_INTERVAL):
+        self.interval = interval
+        self._subs = set()
+        self._last = None
+        self._wake = None
+        self._task = None
+        self._loop = None
+
+    def poke(self):
+        """Something changed; refresh now (safe from any thread)."""
+        loop = self._loop
+        if loop is not None and self._wake is not None:
+            loop.call_soon_threadsafe(self._wake.set)
+
+    def subscribe(self):
+        q = asyncio.Queue(maxsize=1)
+        self._subs.add(q)
+        if self._last is not None:
+            q.put_nowait(self._last)
+        if self._task is None or self._task.done():
+            self._loop = asyncio.get_running_loop()
+            self._wake = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+        return q
+
+    def unsubscribe(self, q):
+        self._subs.discard(q)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while self._subs:
+            self._wake.clear()
+            try:
+                data = await loop.run_in_executor(_db_pool, _dashboard_json)
+            except Exception as e:
+                _logger.warning('dashboard snapshot failed: %s', e)
+                data = None
+            if data is not None and data != self._last:
+                self._last = data
+                for q in list(self._subs):
+                    if q.full():
+                        q.get_nowait()   # slow client: keep only the newest snapshot
+                    q.put_nowait(data)
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+        self._last = None
+
+
+def _dashboard_json():
+    return json.dumps(dashboard_payload(), ensure_ascii=False, default=str)
+
+
+hub = DashboardHub()
+
+
+async def _sse(scope, receive, send):
+    await send({'type': 'http.response.start', 'status': 200, 'headers': [
+        (b'content-type', b'text/event-stream; charset=utf-8'),
+        (b'cache-control', b'no-cache'),
+        (b'x-accel-buffering', b'no'),
+    ]})
+    q = hub.subscribe()
+    disconnected = asyncio.create_task(_wait_disconnect(receive))
+    try:
+        while not disconnected.done():
+            getter = asyncio.ensure_future(q.get())
+            done, _ = await asyncio.wait({getter, disconnected}, timeout=PUSH_KEEPALIVE,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            if getter in done:
+                chunk = f'event: dashboard\ndata: {getter.result()}\n\n'.encode('utf-8')
+            else:
+                getter.cancel()
+                if disconnected in done:
+                    break
+                chunk = b': keepalive\n\n'
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+    except (ConnectionError, OSError):
+        pass
+    finally:
+        hub.unsubscribe(q)
+        disconnected.cancel()
+
+
+async def _wait_disconnect(receive):
+    while True:
+        msg = await receive()
+        if msg['type'] == 'http.disconnect':
+            return
+
+
+# ---------------------------------------------------------------- WSGI bridge
+
+def _environ(scope, body):
+    headers = [(k.decode('latin-1'), v.decode('latin-1')) for k, v in scope.get('headers', [])]
+    server = scope.get('server') or ('localhost', FLASK_PORT)
+    client = scope.get('client') or ('', 0)
+    env = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': unquote(scope['path']).encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': str(server[0]),
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+        'REMOTE_ADDR': client[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+        'CONTENT_LENGTH': str(len(body)),
+    }
+    for k, v in headers:
+        if k == 'content-type':
+            env['CONTENT_TYPE'] = v
+        elif k != 'content-length':
+            key = 'HTTP_' + k.upper().replace('-', '_')
+            env[key] = env[key] + ',' + v if key in env else v
+    return env
+
+
+def _run_wsgi(env):
+    """-> (status, headers, body bytes, or the open iterable when the body is streamed)."""
+    status_headers = {}
+
+    def start_response(status, headers, exc_info=None):
+        status_headers['status'] = int(status.split(' ', 1)[0])
+        status_headers['headers'] = headers
+
+    result = flask_app(env, start_response)
+    headers = status_headers['headers']
+    if not any(k.lower() == 'content-length' for k, _ in headers):
+        return status_headers['status'], headers, result   # streamed (exports): pulled chunk by chunk
+    try:
+        body = b''.join(result)
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
+    return status_headers['status'], headers, body
+
+
+async def _call_wsgi(scope, receive, send):
+    chunks = []
+    while True:
+        msg = await receive()
+        if msg['type'] == 'http.disconnect':
+            return
+        chunks.append(msg.get('body', b''))
+        if not msg.get('more_body'):
+            break
+    loop = asyncio.get_running_loop()
+    status, headers, body = await loop.run_in_executor(_http_pool, _run_wsgi, _environ(scope, b''.join(chunks)))
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers]})
+    if isinstance(body, bytes):
+        await send({'type': 'http.response.body', 'body': body})
+    else:
+        it = iter(body)
+        try:
+            while True:
+                chunk = await loop.run_in_executor(_http_pool, next, it, None)
+                if chunk is None:
+                    break
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            if hasattr(body, 'close'):
+                await loop.run_in_executor(_http_pool, body.close)
+    if scope['method'] in ('POST', 'PATCH', 'PUT', 'DELETE') and status < 400:
+        hub.poke()
+
+
+# ---------------------------------------------------------------- lifespan
+
+_background = []
+
+
+def _on_mqtt_message(client, userdata, msg):
+    mqtt_client.on_message(client, userdata, msg)
+    hub.poke()
+
+
+async def _periodic(fn, first_delay, period):
+    loop = asyncio.get_running_loop()
+    await asyncio.sleep(first_delay)
+    while True:
+        try:
+            await loop.run_in_executor(_db_pool, fn)
+        except Exception as e:
+            _logger.warning('periodic %s failed: %s', getattr(fn, '__name__', fn), e)
+        if not period:
+            return
+        await asyncio.sleep(period)
+
+
+async def startup():
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(_db_pool, init_db)
+    if MQTT_MODE == 'embedded':
+        c = await loop.run_in_executor(_db_pool, mqtt_client.get_client)   # thread-based, starts its own watchdog
+        c.on_message = _on_mqtt_message
+        return
+    from .mqtt_async import AsyncMQTTClient
+    # the outbox resends unconfirmed commands on its own backoff; a client-level retry would double them
+    c = AsyncMQTTClient(MQTT_CLIENT_ID, handler_executor=_mqtt_pool, retry_interval=None)
+    c.on_connect = mqtt_client.on_connect   # resubscribes and runs a dispatch pass on every (re)connect
+    c.on_message = _on_mqtt_message
+    mqtt_client.use_client(c)
+    _background.append(asyncio.create_task(c.run(MQTT_BROKER, MQTT_PORT, keepalive=60)))
+    _background.append(asyncio.create_task(_periodic(lambda: mqtt_client.watchdog_tick(c), 2, 2)))
+    if archive.ARCHIVE_AFTER_DAYS > 0:
+        _background.append(asyncio.create_task(_periodic(archive.run_once, 60, archive.ARCHIVE_INTERVAL)))
+    if backup.BACKUP_INTERVAL > 0:
+        _background.append(asyncio.create_task(_periodic(backup.run_if_due, 30, min(backup.BACKUP_INTERVAL, 600))))
+    _logger.info('asyncio runtime: MQTT %s:%s, %s http / %s db workers', MQTT_BROKER, MQTT_PORT, HTTP_WORKERS, DB_WORKERS)
+
+
+async def shutdown():
+    client = mqtt_client._client
+    if hasattr(client, 'disconnect'):
+        client.disconnect()
+    for t in _background:
+        t.cancel()
+    _background.clear()
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        while True:
+            msg = await receive()
+            if msg['type'] == 'lifespan.startup':
+                try:
+                    await startup()
+                except Exception as e:
+                    await send({'type': 'lifespan.startup.failed', 'message': str(e)})
+                    return
+                await send({'type': 'lifespan.startup.complete'})
+            elif msg['type'] == 'lifespan.shutdown':
+                await shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+    elif scope['type'] == 'http':
+        if scope['path'] == '/api/stream' and scope['method'] == 'GET':
+            await _sse(scope, receive, send)
+        else:
+            await _call_wsgi(scope, receive, send)
+
+
+# ---------------------------------------------------------------- fallback server (no uvicorn)
+
+_REASONS = {200: 'OK', 201: 'Created', 204: 'No Content', 304: 'Not Modified', 400: 'Bad Request',
+            404: 'Not Found', 405: 'Method Not Allowed', 409: 'Conflict', 413: 'Payload Too Large',
+            429: 'Too Many Requests', 500: 'Internal Server Error', 501: 'Not Implemented',
+            503: 'Service Unavailable'}
+_MAX_BODY = 1 << 20   # request bodies are small JSON documents
+
+
+async def _read_chunked(reader):
+    """Body of a ``Transfer-Encoding: chunked`` request (trailers are read and dropped)."""
+    body = bytearray()
+    while True:
+        size = int((await reader.readuntil(b'\r\n')).split(b';', 1)[0].strip(), 16)
+        if size == 0:
+            while await reader.readuntil(b'\r\n') != b'\r\n':
+                pass
+            return bytes(body)
+        if len(body) + size > _MAX_BODY:
+            raise OverflowError('chunked body too large')
+        body += await reader.readexactly(size)
+        if await reader.readexactly(2) != b'\r\n':
+            raise ValueError('bad chunk terminator')
+
+
+def _reject(writer, status):
+    writer.write(f"HTTP/1.1 {status} {_REASONS[status]}\r\ncontent-length: 0\r\nconnection: close\r\n\r\n"
+                 .encode('latin-1'))
+
+
+async def _handle_conn(reader, writer):
+    peer = writer.get_extra_info('peername') or ('', 0)
+    try:
+        while True:
+            try:
+                head = await reader.readuntil(b'\r\n\r\n')
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                return
+            lines = head.decode('latin-1').split('\r\n')
+            method, target, version = lines[0].split(' ', 2)
+            headers = []
+            for line in lines[1:]:
+                if ':' in line:
+                    k, v = line.split(':', 1)
+                    headers.append((k.strip().lower().encode('latin-1'), v.strip().encode('latin-1')))
+            hdr = dict(headers)
+            te = hdr.get(b'transfer-encoding', b'').lower()
+            if te == b'chunked':
+                try:
+                    body = await _read_chunked(reader)
+                except OverflowError:
+                    _reject(writer, 413)
+                    return
+                except ValueError:
+                    _reject(writer, 400)
+                    return
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+                    return
+            elif te and te != b'identity':
+                # can't find where this body ends, so the rest of the stream can't be trusted either
+                _reject(writer, 501)
+                return
+            else:
+                body = await reader.readexactly(int(hdr.get(b'content-length', b'0') or 0))
+            path, _, qs = target.partition('?')
+            keep_alive = version == 'HTTP/1.1' and hdr.get(b'connection', b'').lower() != b'close'
+            scope = {'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': version[5:], 'method': method,
+                     'scheme': 'http', 'path': path, 'raw_path': path.encode('latin-1'), 'root_path': '',
+                     'query_string': qs.encode('latin-1'), 'headers': headers,
+                     'client': peer[:2], 'server': writer.get_extra_info('sockname')[:2]}
+            closed = asyncio.Event()
+            sent_body = False
+            state = {'chunked': False}
+
+            async def receive():
+                nonlocal sent_body
+                if not sent_body:
+                    sent_body = True
+                    return {'type': 'http.request', 'body': body, 'more_body': False}
+                await closed.wait()
+                return {'type': 'http.disconnect'}
+
+            async def send(msg):
+                if msg['type'] == 'http.response.start':
+                    hs = msg.get('headers', [])
+                    names = {k.lower() for k, _ in hs}
+                    out = [f"HTTP/1.1 {msg['status']} {_REASONS.get(msg['status'], '')}\r\n".encode('latin-1')]
+                    out += [k + b': ' + v + b'\r\n' for k, v in hs]
+                    if b'content-length' not in names:
+                        state['chunked'] = True
+                        out.append(b'transfer-encoding: chunked\r\n')
+                    out.append(b'connection: keep-alive\r\n' if keep_alive else b'connection: close\r\n')
+                    writer.write(b''.join(out) + b'\r\n')
+                elif msg['type'] == 'http.response.body':
+                    data = msg.get('body', b'')
+                    more = msg.get('more_body', False)
+                    if state['chunked']:
+                        if data:
+                            writer.write(b'%x\r\n%s\r\n' % (len(data), data))
+                        if not more:
+                            writer.write(b'0\r\n\r\n')
+                    else:
+                        writer.write(data)
+                    await writer.drain()
+
+            watcher = asyncio.create_task(_watch_eof(reader, closed)) if path == '/api/stream' else None
+            try:
+                await app(scope, receive, send)
+            finally:
+                closed.set()
+                if watcher:
+                    watcher.cancel()
+            if not keep_alive or watcher:
+                return
+    except (ConnectionError, ValueError) as e:
+        _logger.debug('connection %s closed: %s', peer, e)
+    finally:
+        writer.close()
+
+
+async def _watch_eof(reader, closed):
+    try:
+        await reader.read()
+    finally:
+        closed.set()
+
+
+async def serve(host=FLASK_HOST, port=FLASK_PORT):
+    """Minimal HTTP/1.1 server for the ASGI app (used when uvicorn is not installed)."""
+    lifespan_q = asyncio.Queue()
+    lifespan_out = asyncio.Queue()
+    await lifespan_q.put({'type': 'lifespan.startup'})
+    life = asyncio.create_task(app({'type': 'lifespan'}, lifespan_q.get, lifespan_out.put))
+    started = await lifespan_out.get()
+    if started['type'] != 'lifespan.startup.complete':
+        raise RuntimeError(started.get('message', 'startup failed'))
+    server = await asyncio.start_server(_handle_conn, host, port, limit=1 << 16)
+    _logger.info('asyncio server listening on %s:%s', host, port)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await lifespan_q.put({'type': 'lifespan.shutdown'})
+        await life
+
+
+def main():
+    try:
+        import uvicorn
+    except ImportError:
+        uvicorn = None
+    if uvicorn is not None:
+        uvicorn.run(app, host=FLASK_HOST, port=FLASK_PORT, lifespan='on', log_level='info')
+        return
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,268 @@
+"""Online backups of app.db (and archive.db) while the server runs.
+
+Copying the files by hand mid-write can tear them, and one big read
+transaction would keep dispatch from writing for the whole copy. This uses
+SQLite's online backup API a few pages at a time (BACKUP_PAGES per step,
+BACKUP_STEP_SLEEP between steps): a step only holds a read lock for that
+many pages, so writers wait milliseconds, not seconds. A write from another
+connection restarts the copy at the next step; after BACKUP_MAX_RESTARTS the
+run gives up and tries again at the next schedule.
+
+Each copy is checked (``PRAGMA quick_check``) and gzipped into BACKUP_DIR as
+``app-YYYYmmdd-HHMMSS.db.gz`` / ``archive-....db.gz``; only the newest
+BACKUP_KEEP per database are kept.
+
+    python -m server.backup run
+    python -m server.backup list
+    python -m server.backup verify data/backups/app-20250101-030000.db.gz
+    python -m server.backup restore data/backups/app-20250101-030000.db.gz   (server stopped)
+
+POST /api/backup runs one on demand; GET /api/backups lists them.
+
+Environment:
+    BACKUP_DIR=data/backups       (next to DB_PATH)
+    BACKUP_INTERVAL=86400         seconds between scheduled runs, 0 disables
+    BACKUP_KEEP=7                 backups kept per database
+    BACKUP_PAGES=256              pages copied per step
+    BACKUP_STEP_SLEEP=0.01        seconds between steps
+    BACKUP_MAX_RESTARTS=50
+"""
+import argparse
+import gzip
+import logging
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from contextlib import closing
+
+from .config import ARCHIVE_PATH, DB_PATH
+
+_logger = logging.getLogger(__name__)
+
+BACKUP_DIR = os.getenv("BACKUP_DIR") or os.path.join(os.path.dirname(DB_PATH), "backups")
+BACKUP_INTERVAL = float(os.getenv("BACKUP_INTERVAL", "86400"))
+BACKUP_KEEP = int(os.getenv("BACKUP_KEEP", "7"))
+BACKUP_PAGES = int(os.getenv("BACKUP_PAGES", "256"))
+BACKUP_STEP_SLEEP = float(os.getenv("BACKUP_STEP_SLEEP", "0.01"))
+BACKUP_MAX_RESTARTS = int(os.getenv("BACKUP_MAX_RESTARTS", "50"))
+
+# name in the file -> live database it is a copy of
+DATABASES = {'app': DB_PATH, 'archive': ARCHIVE_PATH}
+
+_run_lock = threading.Lock()
+_started = False
+
+
+class BackupBusy(Exception):
+    """Another backup is running in this process."""
+
+
+def _copy(src_path, dst_path):
+    """Online copy of ``src_path`` into a new file ``dst_path``; returns (pages, restarts)."""
+    seen = {'remaining': None, 'restarts': 0, 'pages': 0}
+
+    def progress(status, remaining, total):
+        # remaining going up again means a write elsewhere restarted the copy
+        if seen['remaining'] is not None and remaining > seen['remaining']:
+            seen['restarts'] += 1
+            if seen['restarts'] > BACKUP_MAX_RESTARTS:
+                raise RuntimeError(f"backup of {src_path} restarted {seen['restarts']} times, giving up")
+        seen['remaining'], seen['pages'] = remaining, total
+
+    with closing(sqlite3.connect(src_path)) as src, closing(sqlite3.connect(dst_path)) as dst:
+        src.backup(dst, pages=BACKUP_PAGES, progress=progress, sleep=BACKUP_STEP_SLEEP)
+        ok = dst.execute("PRAGMA quick_check").fetchone()[0]
+        if ok != 'ok':
+            raise RuntimeError(f"backup copy of {src_path} failed quick_check: {ok}")
+    return seen['pages'], seen['restarts']
+
+
+def _gzip(src, dst):
+    tmp = dst + '.partial'
+    with open(src, 'rb') as f, gzip.open(tmp, 'wb', compresslevel=6) as g:
+        shutil.copyfileobj(f, g, 1024 * 1024)
+    os.replace(tmp, dst)
+
+
+def backup_one(name, stamp=None):
+    """Back up one database (``app`` or ``archive``); returns a summary dict, or None if it does not exist."""
+    src_path = DATABASES[name]
+    if not os.path.exists(src_path):
+        return None
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    stamp = stamp or time.strftime('%Y%m%d-%H%M%S')
+    out = os.path.join(BACKUP_DIR, f"{name}-{stamp}.db.gz")
+    t0 = time.time()
+    fd, tmp = tempfile.mkstemp(prefix=f".{name}-", suffix='.db', dir=BACKUP_DIR)
+    os.close(fd)
+    try:
+        pages, restarts = _copy(src_path, tmp)
+        copied = time.time()
+        _gzip(tmp, out)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    info = {'database': name, 'file': out, 'pages': pages, 'restarts': restarts,
+            'bytes': os.path.getsize(out), 'copy_sec': round(copied - t0, 3), 'total_sec': round(time.time() - t0, 3)}
+    _logger.info('backup %s -> %s (%s pages, %s restarts, %.1fs)', name, out, pages, restarts, info['total_sec'])
+    return info
+
+
+def run_once():
+    """Back up every database, then apply retention; raises BackupBusy if one is already running."""
+    if not _run_lock.acquire(blocking=False):
+        raise BackupBusy()
+    try:
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        done = [info for info in (backup_one(name, stamp) for name in DATABASES) if info]
+        prune()
+        return done
+    finally:
+        _run_lock.release()
+
+
+def list_backups():
+    """Newest first: [{database, file, bytes, mtime}]."""
+    if not os.path.isdir(BACKUP_DIR):
+        return []
+    out = []
+    for fn in os.listdir(BACKUP_DIR):
+        name, _, rest = fn.partition('-')
+        if name in DATABASES and rest.endswith('.db.gz'):
+            path = os.path.join(BACKUP_DIR, fn)
+            st = os.stat(path)
+            out.append({'database': name, 'file': path, 'bytes': st.st_size, 'mtime': st.st_mtime})
+    # the timestamp in the name sorts the same as the time it was taken
+    return sorted(out, key=lambda b: os.path.basename(b['file']).partition('-')[2], reverse=True)
+
+
+def prune(keep=None):
+    keep = BACKUP_KEEP if keep is None else keep
+    removed = []
+    for name in DATABASES:
+        for b in [b for b in list_backups() if b['database'] == name][keep:]:
+            os.remove(b['file'])
+            removed.append(b['file'])
+    if removed:
+        _logger.info('backup retention removed %s', removed)
+    return removed
+
+
+def run_if_due():
+    """Scheduled entry point: back up when the newest app backup is older than BACKUP_INTERVAL."""
+    latest = next((b for b in list_backups() if b['database'] == 'app'), None)
+    if latest is not None and time.time() - latest['mtime'] < BACKUP_INTERVAL:
+        return []
+    try:
+        return run_once()
+    except BackupBusy:
+        return []
+
+
+def _unpack(path, dst):
+    with gzip.open(path, 'rb') as g, open(dst, 'wb') as f:
+        shutil.copyfileobj(g, f, 1024 * 1024)
+
+
+def verify(path):
+    """Unpack a backup to a temp file and run a full integrity check; returns a summary dict."""
+    fd, tmp = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    try:
+        _unpack(path, tmp)
+        with closing(sqlite3.connect(tmp)) as conn:
+            integrity = conn.execute("PRAGMA integrity_check").fetchone()[0]
+            tables = [r[0] for r in conn.execute(
+                "SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%' ORDER BY name")]
+            counts = {t: conn.execute(f'SELECT COUNT(*) FROM "{t}"').fetchone()[0]
+                      for t in ('queues', 'events', 'patients', 'pills') if t in tables}
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+        return {'file': path, 'ok': integrity == 'ok', 'integrity': integrity,
+                'user_version': version, 'tables': len(tables), 'rows': counts}
+    finally:
+        os.remove(tmp)
+
+
+def restore(path, force=False):
+    """Replace the live database the backup was taken from (run with the server stopped).
+
+    The current file is first copied to ``<db>.pre-restore`` so a restore can be undone.
+    """
+    name = os.path.basename(path).partition('-')[0]
+    if name not in DATABASES:
+        raise ValueError(f"can't tell which database {path} belongs to (expected app-*.db.gz or archive-*.db.gz)")
+    target = DATABASES[name]
+    summary = verify(path)
+    if not summary['ok']:
+        raise RuntimeError(f"{path} failed integrity_check: {summary['integrity']}")
+    if os.path.exists(target) and not force:
+        raise FileExistsError(f"{target} exists; stop the server and pass --force to replace it")
+    fd, tmp = tempfile.mkstemp(suffix='.db', dir=os.path.dirname(target) or '.')
+    os.close(fd)
+    try:
+        _unpack(path, tmp)
+        if os.path.exists(target):
+            _copy(target, target + '.pre-restore.partial')
+            os.replace(target + '.pre-restore.partial', target + '.pre-restore')
+        # the backup API writes the target under its own lock, so a stray reader sees old or new, never half
+        with closing(sqlite3.connect(tmp)) as src, closing(sqlite3.connect(target)) as dst:
+            src.backup(dst)
+    finally:
+        os.remove(tmp)
+    return dict(summary, restored_to=target)
+
+
+def start_scheduler():
+    """Check every few minutes whether a backup is due, on a daemon thread (once per process)."""
+    global _started
+    if _started or BACKUP_INTERVAL <= 0:
+        return
+    _started = True
+
+    def loop():
+        while True:
+            try:
+                run_if_due()
+            except Exception as e:
+                _logger.warning('scheduled backup failed: %s', e)
+            time.sleep(min(BACKUP_INTERVAL, 600))
+
+    threading.Thread(target=loop, name='backup', daemon=True).start()
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(prog='python -m server.backup', description='Online backups of app.db / archive.db')
+    sub = ap.add_subparsers(dest='cmd', required=True)
+    sub.add_parser('run', help='back up now (safe while the server runs)')
+    sub.add_parser('list', help='backups in BACKUP_DIR, newest first')
+    v = sub.add_parser('verify', help='integrity-check a backup file')
+    v.add_argument('file')
+    r = sub.add_parser('restore', help='replace the live database with a backup (server stopped)')
+    r.add_argument('file')
+    r.add_argument('--force', action='store_true', help='overwrite the existing database file')
+    args = ap.parse_args(argv)
+    if args.cmd == 'run':
+        for info in run_once():
+            print(f"{info['file']}  {info['bytes']} bytes  {info['pages']} pages  {info['total_sec']}s")
+    elif args.cmd == 'list':
+        for b in list_backups():
+            print(f"{b['file']}  {b['bytes']} bytes  {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(b['mtime']))}")
+    elif args.cmd == 'verify':
+        s = verify(args.file)
+        print(f"{s['file']}: {s['integrity']}  user_version={s['user_version']}  tables={s['tables']}  rows={s['rows']}")
+        raise SystemExit(0 if s['ok'] else 1)
+    else:
+        try:
+            s = restore(args.file, force=args.force)
+        except (ValueError, RuntimeError, FileExistsError) as e:
+            raise SystemExit(f"restore refused: {e}")
+        print(f"restored {s['file']} -> {s['restored_to']}")
+        if os.path.exists(s['restored_to'] + '.pre-restore'):
+            print(f"previous file kept as {s['restored_to']}.pre-restore")
+
+
+if __name__ == '__main__':
+    main()
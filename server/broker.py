@@ -0,0 +1,521 @@
+"""Embedded MQTT broker stand-in (MQTT_MODE=embedded).
+
+Implements the subset of MQTT the dispenser uses:
+
+* topic wildcards (``disp/+/+``, ``disp/#``)
+* QoS 0/1 with redelivery: a TCP delivery without PUBACK is re-sent (DUP)
+  every ``MQTT_EMBEDDED_RETRY`` seconds up to ``MQTT_EMBEDDED_MAX_RETRIES``
+  times. In-process delivery is a queue handoff and is not retried; a handler
+  that fails has to recover on its own (the command outbox re-publishes)
+* retained messages (the nodes' ``{"online":1}``) replayed on subscribe
+* last-will messages for TCP clients that drop without DISCONNECT
+
+In-process clients (``get_broker().client(id)``) expose the part of the paho
+``Client`` API that ``mqtt_client`` and the tools use, and deliver on their own
+thread like paho's network loop, so handlers never run inside ``publish``.
+Set ``MQTT_EMBEDDED_LISTEN=0.0.0.0:1883`` to also accept real NodeMCUs over TCP
+(MQTT 3.1/3.1.1, clean sessions only) and skip mosquitto on a single-box install.
+"""
+import itertools
+import logging
+import os
+import queue
+import socket
+import socketserver
+import struct
+import threading
+import time
+
+_logger = logging.getLogger(__name__)
+
+RETRY_INTERVAL = float(os.getenv("MQTT_EMBEDDED_RETRY", "5"))
+MAX_RETRIES = int(os.getenv("MQTT_EMBEDDED_MAX_RETRIES", "5"))
+
+# packet types
+CONNECT, CONNACK, PUBLISH, PUBACK, PUBREC, PUBREL, PUBCOMP = 1, 2, 3, 4, 5, 6, 7
+SUBSCRIBE, SUBACK, UNSUBSCRIBE, UNSUBACK, PINGREQ, PINGRESP, DISCONNECT = 8, 9, 10, 11, 12, 13, 14
+
+
+def topic_matches(filt, topic):
+    """MQTT topic filter match ('+' = one level, '#' = rest, incl. parent)."""
+    if topic.startswith('$') and filt[:1] in ('+', '#'):
+        return False
+    f = filt.split('/')
+    t = topic.split('/')
+    for i, part in enumerate(f):
+        if part == '#':
+            return True
+        if i >= len(t):
+            return False
+        if part != '+' and part != t[i]:
+            return False
+    return len(f) == len(t)
+
+
+def _to_bytes(payload):
+    if payload is None:
+        return b''
+    if isinstance(payload, bytes):
+        return payload
+    if isinstance(payload, (bytearray, memoryview)):
+        return bytes(payload)
+    return str(payload).encode('utf-8')
+
+
+class MQTTMessage:
+    """Same attributes as paho's MQTTMessage that handlers read."""
+    __slots__ = ('topic', 'payload', 'qos', 'retain', 'mid', 'dup')
+
+    def __init__(self, topic, payload, qos=0, retain=False, mid=0, dup=False):
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.retain = retain
+        self.mid = mid
+        self.dup = dup
+
+
+class PublishInfo:
+    """Stand-in for paho's MQTTMessageInfo."""
+    __slots__ = ('mid', 'rc', '_done')
+
+    def __init__(self, mid):
+        self.mid = mid
+        self.rc = 0
+        self._done = threading.Event()
+
+    def is_published(self):
+        return self._done.is_set()
+
+    def wait_for_publish(self, timeout=None):
+        self._done.wait(timeout)
+
+
+class Broker:
+    def __init__(self, retry_interval=RETRY_INTERVAL, max_retries=MAX_RETRIES):
+        self.retry_interval = retry_interval
+        self.max_retries = max_retries
+        self._lock = threading.RLock()
+        self._subs = {}       # session -> {filter: qos}
+        self._retained = {}   # topic -> (payload, qos)
+        self._server = None
+        threading.Thread(target=self._retry_loop, name='mqtt-embedded-retry', daemon=True).start()
+
+    # ---- sessions
+    def client(self, client_id=''):
+        return EmbeddedClient(self, client_id)
+
+    def attach(self, session):
+        with self._lock:
+            self._subs.setdefault(session, {})
+
+    def detach(self, session):
+        with self._lock:
+            self._subs.pop(session, None)
+
+    def subscribe(self, session, filt, qos=0):
+        with self._lock:
+            self._subs.setdefault(session, {})[filt] = min(int(qos), 1)
+            retained = [(t, p, q) for t, (p, q) in self._retained.items() if topic_matches(filt, t)]
+        for topic, payload, rq in retained:
+            session.deliver(topic, payload, min(rq, qos, 1), True)
+
+    def unsubscribe(self, session, filt):
+        with self._lock:
+            self._subs.get(session, {}).pop(filt, None)
+
+    # ---- routing
+    def publish(self, topic, payload, qos=0, retain=False):
+        payload = _to_bytes(payload)
+        qos = min(int(qos), 1)
+        with self._lock:
+            if retain:
+                if payload:
+                    self._retained[topic] = (payload, qos)
+                else:
+                    self._retained.pop(topic, None)
+            targets = []
+            for session, filters in self._subs.items():
+                best = -1
+                for filt, sq in filters.items():
+                    if sq > best and topic_matches(filt, topic):
+                        best = sq
+                if best >= 0:
+                    targets.append((session, min(qos, best)))
+        for session, q in targets:
+            session.deliver(topic, payload, q, False)
+        return len(targets)
+
+    def _retry_loop(self):
+        while True:
+            time.sleep(min(1.0, self.retry_interval))
+            now = time.time()
+            with self._lock:
+                sessions = list(self._subs)
+            for s in sessions:
+                try:
+                    s.retry(now)
+                except Exception as e:
+                    _logger.debug('embedded broker retry failed: %s', e)
+
+    # ---- TCP listener
+    def listen(self, host='0.0.0.0', port=1883):
+        broker = self
+
+        class Handler(_TCPSession):
+            pass
+        Handler.broker = broker
+        server = _ThreadingServer((host, int(port)), Handler)
+        threading.Thread(target=server.serve_forever, name='mqtt-embedded-listener', daemon=True).start()
+        self._server = server
+        _logger.info('Embedded MQTT broker listening on %s:%s', host, port)
+        return server
+
+
+class EmbeddedClient:
+    """In-process client with the paho.mqtt.client.Client methods we use."""
+
+    def __init__(self, broker, client_id=''):
+        self._broker = broker
+        self._client_id = client_id
+        self._userdata = None
+        self.on_connect = None
+        self.on_disconnect = None
+        self.on_message = None
+        self.on_publish = None
+        self.on_subscribe = None
+        self._inbox = queue.Queue()
+        self._connected = False
+        self._thread = None
+        self._mids = itertools.count(1)
+
+    # ---- paho-compatible API
+    def user_data_set(self, userdata):
+        self._userdata = userdata
+
+    def will_set(self, topic, payload=None, qos=0, retain=False):
+        pass  # an in-process client cannot drop off the network
+
+    def reconnect_delay_set(self, min_delay=1, max_delay=120):
+        pass
+
+    def connect(self, host=None, port=None, keepalive=60, *args, **kwargs):
+        self._broker.attach(self)
+        self._connected = True
+        self._inbox.put(('connect', None))
+        return 0
+
+    connect_async = connect
+
+    def reconnect(self):
+        return self.connect()
+
+    def disconnect(self, *args, **kwargs):
+        self._broker.detach(self)
+        self._connected = False
+        self._inbox.put(('disconnect', None))
+        return 0
+
+    def is_connected(self):
+        return self._connected
+
+    def loop_start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.loop_forever, name=f'mqtt-embedded-{self._client_id}', daemon=True)
+            self._thread.start()
+        return 0
+
+    def loop_stop(self, force=False):
+        if self._thread is not None:
+            self._inbox.put(None)
+            self._thread.join(timeout=2)
+            self._thread = None
+        return 0
+
+    def subscribe(self, topic, qos=0, *args, **kwargs):
+        topics = topic if isinstance(topic, list) else [(topic, qos)]
+        mid = next(self._mids)
+        for t, q in topics:
+            self._broker.subscribe(self, t, q)
+        self._inbox.put(('suback', (mid, tuple(min(int(q), 1) for _, q in topics))))
+        return (0, mid)
+
+    def unsubscribe(self, topic, *args, **kwargs):
+        for t in (topic if isinstance(topic, list) else [topic]):
+            self._broker.unsubscribe(self, t)
+        return (0, next(self._mids))
+
+    def publish(self, topic, payload=None, qos=0, retain=False, *args, **kwargs):
+        info = PublishInfo(next(self._mids))
+        self._broker.publish(topic, payload, qos, retain)
+        info._done.set()
+        self._inbox.put(('published', info.mid))
+        return info
+
+    # ---- broker side
+    def deliver(self, topic, payload, qos, retain, dup=False):
+        self._inbox.put(('message', MQTTMessage(topic, payload, qos, retain, 0, dup)))
+
+    def retry(self, now):
+        pass  # nothing is in flight: delivery to an in-process client cannot be lost
+
+    def loop_forever(self, *args, **kwargs):
+        while True:
+            item = self._inbox.get()
+            if item is None:
+                return
+            kind, arg = item[0], item[1]
+            try:
+                if kind == 'message':
+                    if self.on_message:
+                        self.on_message(self, self._userdata, arg)
+                elif kind == 'connect' and self.on_connect:
+                    self.on_connect(self, self._userdata, {'session present': 0}, 0)
+                elif kind == 'published' and self.on_publish:
+                    self.on_publish(self, self._userdata, arg)
+                elif kind == 'suback' and self.on_subscribe:
+                    self.on_subscribe(self, self._userdata, arg[0], arg[1])
+                elif kind == 'disconnect' and self.on_disconnect:
+                    self.on_disconnect(self, self._userdata, 0)
+            except Exception as e:
+                _logger.exception('embedded client %s callback %s failed: %s', self._client_id, kind, e)
+
+
+# ---------------------------------------------------------------- TCP (3.1.1)
+
+def _encode_len(n):
+    out = bytearray()
+    while True:
+        b = n % 128
+        n //= 128
+        out.append(b | 0x80 if n else b)
+        if not n:
+            return bytes(out)
+
+
+def encode_str(s):
+    b = s.encode('utf-8') if isinstance(s, str) else s
+    return struct.pack('!H', len(b)) + b
+
+
+def encode_packet(ptype, flags=0, body=b''):
+    return bytes([(ptype << 4) | flags]) + _encode_len(len(body)) + body
+
+
+def encode_publish(topic, payload, qos=0, retain=False, mid=None, dup=False):
+    flags = (0x08 if dup else 0) | (qos << 1) | (0x01 if retain else 0)
+    body = encode_str(topic) + (struct.pack('!H', mid) if qos else b'') + payload
+    return encode_packet(PUBLISH, flags, body)
+
+
+def read_packet(sock):
+    """-> (ptype, flags, body) or None on EOF."""
+    head = _recv_exact(sock, 1)
+    if not head:
+        return None
+    mult, length = 1, 0
+    while True:
+        b = _recv_exact(sock, 1)
+        if not b:
+            return None
+        length += (b[0] & 0x7F) * mult
+        if not b[0] & 0x80:
+            break
+        mult *= 128
+    body = _recv_exact(sock, length) if length else b''
+    if length and not body:
+        return None
+    return head[0] >> 4, head[0] & 0x0F, body
+
+
+def _recv_exact(sock, n):
+    buf = bytearray()
+    while len(buf) < n:
+        chunk = sock.recv(n - len(buf))
+        if not chunk:
+            return b''
+        buf.extend(chunk)
+    return bytes(buf)
+
+
+def next_packet_id(counter, inflight=()):
+    """Next MQTT packet identifier (1..65535, wrapping) from an ``itertools.count``, skipping ids in ``inflight``."""
+    for _ in range(65535):
+        mid = next(counter) % 65535 + 1
+        if mid not in inflight:
+            return mid
+    raise RuntimeError('all 65535 packet identifiers are in flight')
+
+
+def decode_str(body, i):
+    n = struct.unpack_from('!H', body, i)[0]
+    return body[i + 2:i + 2 + n], i + 2 + n
+
+
+class _ThreadingServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _TCPSession(socketserver.BaseRequestHandler):
+    broker = None  # set on the per-listener subclass
+
+    def setup(self):
+        self._wlock = threading.Lock()
+        self._mid_lock = threading.Lock()   # _mids/_inflight: publishers, the retry loop and this reader
+        self._mids = itertools.count(1)
+        self._inflight = {}   # packet id -> [due, attempts, topic, payload]
+        self._qos2 = set()
+        self.client_id = '?'
+        self.will = None
+
+    def _send(self, data):
+        with self._wlock:
+            self.request.sendall(data)
+
+    def _next_mid(self):
+        # caller holds _mid_lock
+        return next_packet_id(self._mids, self._inflight)
+
+    # called by Broker.publish (any thread)
+    def deliver(self, topic, payload, qos, retain, dup=False):
+        mid = None
+        if qos:
+            with self._mid_lock:
+                mid = self._next_mid()
+                self._inflight[mid] = [time.time() + self.broker.retry_interval, 0, topic, payload]
+        try:
+            self._send(encode_publish(topic, payload, qos, retain, mid, dup))
+        except OSError:
+            pass
+
+    def retry(self, now):
+        resend = []
+        with self._mid_lock:
+            for mid, entry in list(self._inflight.items()):
+                due, attempts, topic, payload = entry
+                if due > now:
+                    continue
+                if attempts >= self.broker.max_retries:
+                    del self._inflight[mid]
+                    _logger.warning('embedded broker: giving up on %s to %s', topic, self.client_id)
+                    continue
+                entry[0] = now + self.broker.retry_interval
+                entry[1] = attempts + 1
+                resend.append((mid, topic, payload))
+        for mid, topic, payload in resend:
+            try:
+                self._send(encode_publish(topic, payload, 1, False, mid, True))
+            except OSError:
+                pass
+
+    def handle(self):
+        sock = self.request
+        pkt = read_packet(sock)
+        if not pkt or pkt[0] != CONNECT:
+            return
+        keepalive = self._on_connect(pkt[2])
+        if keepalive is None:
+            return
+        sock.settimeout(keepalive * 1.5 if keepalive else None)
+        self.broker.attach(self)
+        clean = False
+        try:
+            while True:
+                pkt = read_packet(sock)
+                if pkt is None:
+                    break
+                ptype, flags, body = pkt
+                if ptype == DISCONNECT:
+                    clean = True
+                    break
+                self._dispatch(ptype, flags, body)
+        except (OSError, socket.timeout, struct.error) as e:
+            _logger.info('embedded broker: client %s dropped: %s', self.client_id, e)
+        finally:
+            self.broker.detach(self)
+            if not clean and self.will:
+                self.broker.publish(*self.will)
+
+    def _on_connect(self, body):
+        try:
+            proto, i = decode_str(body, 0)
+            level, cflags = body[i], body[i + 1]
+            keepalive = struct.unpack_from('!H', body, i + 2)[0]
+            i += 4
+            cid, i = decode_str(body, i)
+            self.client_id = cid.decode('utf-8', 'replace') or f'anon-{id(self)}'
+            if cflags & 0x04:
+                wt, i = decode_str(body, i)
+                wm, i = decode_str(body, i)
+                self.will = (wt.decode('utf-8'), wm, (cflags >> 3) & 0x03, bool(cflags & 0x20))
+        except (IndexError, struct.error):
+            return None
+        if proto not in (b'MQTT', b'MQIsdp'):
+            self._send(encode_packet(CONNACK, 0, b'\x00\x01'))
+            return None
+        self._send(encode_packet(CONNACK, 0, b'\x00\x00'))
+        _logger.info('embedded broker: client %s connected (level %s)', self.client_id, level)
+        return keepalive
+
+    def _dispatch(self, ptype, flags, body):
+        if ptype == PUBLISH:
+            qos = (flags >> 1) & 0x03
+            topic, i = decode_str(body, 0)
+            mid = None
+            if qos:
+                mid = struct.unpack_from('!H', body, i)[0]
+                i += 2
+            if qos == 2 and mid in self._qos2:
+                self._send(encode_packet(PUBREC, 0, struct.pack('!H', mid)))
+                return
+            self.broker.publish(topic.decode('utf-8'), body[i:], qos, bool(flags & 0x01))
+            if qos == 1:
+                self._send(encode_packet(PUBACK, 0, struct.pack('!H', mid)))
+            elif qos == 2:
+                self._qos2.add(mid)
+                self._send(encode_packet(PUBREC, 0, struct.pack('!H', mid)))
+        elif ptype == PUBACK:
+            with self._mid_lock:
+                self._inflight.pop(struct.unpack_from('!H', body, 0)[0], None)
+        elif ptype == PUBREL:
+            mid = struct.unpack_from('!H', body, 0)[0]
+            self._qos2.discard(mid)
+            self._send(encode_packet(PUBCOMP, 0, struct.pack('!H', mid)))
+        elif ptype == SUBSCRIBE:
+            mid = struct.unpack_from('!H', body, 0)[0]
+            i = 2
+            subs = []
+            while i < len(body):
+                filt, i = decode_str(body, i)
+                subs.append((filt.decode('utf-8'), min(body[i], 1)))
+                i += 1
+            self._send(encode_packet(SUBACK, 0, struct.pack('!H', mid) + bytes(q for _, q in subs)))
+            for filt, q in subs:
+                self.broker.subscribe(self, filt, q)
+        elif ptype == UNSUBSCRIBE:
+            mid = struct.unpack_from('!H', body, 0)[0]
+            i = 2
+            while i < len(body):
+                filt, i = decode_str(body, i)
+                self.broker.unsubscribe(self, filt.decode('utf-8'))
+            self._send(encode_packet(UNSUBACK, 0, struct.pack('!H', mid)))
+        elif ptype == PINGREQ:
+            self._send(encode_packet(PINGRESP))
+
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+def get_broker():
+    """Process-wide broker; starts the TCP listener when MQTT_EMBEDDED_LISTEN is set."""
+    global _broker
+    with _broker_lock:
+        if _broker is None:
+            _broker = Broker()
+            listen = os.getenv("MQTT_EMBEDDED_LISTEN", "")
+            if listen:
+                host, _, port = listen.rpartition(':')
+                _broker.listen(host or '0.0.0.0', int(port or 1883))
+        return _broker
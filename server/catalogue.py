@@ -0,0 +1,99 @@
+"""In-process cache of the pill and room catalogue.
+
+Both tables are tiny and read on every queue submission, lookup and pill
+list. A snapshot is kept in memory and tagged with ``catalogue_version``,
+a counter that triggers on ``pills``/``rooms`` bump on every write (see
+init.sql), so a change made by another worker or by hand in sqlite3 is
+noticed by comparing one integer, at most every CATALOGUE_CHECK_SEC.
+
+Writers in this process don't wait for that: the pill/drug endpoints call
+``invalidate()`` and the queue stock decrement hands the amounts it read
+back inside its own transaction to ``set_stock()``.
+
+Callers get shared objects; copy before modifying.
+"""
+import os
+import threading
+import time
+
+from .db import query
+
+CATALOGUE_CHECK_SEC = float(os.getenv("CATALOGUE_CHECK_SEC", "1.0"))
+
+_lock = threading.Lock()
+_snap = None   # {'version', 'pills', 'pills_by_id', 'rooms', 'checked'}
+
+
+def _db_version():
+    rows = query("SELECT version FROM catalogue_version WHERE id=1")
+    return rows[0]['version'] if rows else 0
+
+
+def _load():
+    # version first: a write that lands in between makes the snapshot look older, never newer
+    version = _db_version()
+    pills = query("SELECT id,name,type,amount FROM pills ORDER BY id")
+    rooms = query("SELECT id,name FROM rooms ORDER BY id")
+    return {'version': version, 'pills': pills, 'pills_by_id': {p['id']: p for p in pills},
+            'rooms': rooms, 'checked': time.monotonic()}
+
+
+def _current():
+    global _snap
+    snap = _snap
+    now = time.monotonic()
+    if snap is not None and now - snap['checked'] < CATALOGUE_CHECK_SEC:
+        return snap
+    with _lock:
+        snap = _snap
+        if snap is None:
+            _snap = snap = _load()
+        elif now - snap['checked'] >= CATALOGUE_CHECK_SEC:
+            if _db_version() != snap['version']:
+                _snap = snap = _load()
+            else:
+                snap['checked'] = now
+        return snap
+
+
+def pills():
+    """All pills ordered by id: [{id, name, type, amount}]."""
+    return _current()['pills']
+
+
+def pills_by_id():
+    return _current()['pills_by_id']
+
+
+def rooms():
+    return _current()['rooms']
+
+
+def version():
+    return _current()['version']
+
+
+def invalidate():
+    """Drop the snapshot; the next read reloads (call after writing pills/rooms)."""
+    global _snap
+    with _lock:
+        _snap = None
+
+
+def set_stock(rows):
+    """Apply amounts read back in the same transaction as a stock change: [{id, amount}]."""
+    global _snap
+    with _lock:
+        snap = _snap
+        if snap is None:
+            return
+        by_id = dict(snap['pills_by_id'])
+        for r in rows:
+            p = by_id.get(r['id'])
+            if p is None:
+                _snap = None   # a pill we have not seen: reload everything
+                return
+            by_id[r['id']] = dict(p, amount=r['amount'])
+        pills = [by_id[p['id']] for p in snap['pills']]
+        # the triggers bumped the version for our own write; re-check later rather than reload now
+        _snap = dict(snap, pills=pills, pills_by_id=by_id)
@@ -0,0 +1,95 @@
+"""Per-queue completion state: which participants of its line have reported.
+
+One ``queue_completion`` row per dispatched queue holds three bitmasks over the
+line's participants (server/lines.py: its nodes in order, then ``vision`` when
+the line requires the camera to confirm the count):
+
+    required   participants that must report before the queue is decided
+    done       participants that reported
+    failed     participants that reported anything but success
+
+A report is one conditional UPDATE that sets the participant's bit only if it
+is not set yet, so a duplicate evt changes nothing and is recognised by the
+row count. The queue is decided from the returned masks alone:
+complete when ``done & required == required``, success when no required bit
+is also in ``failed``. A failure is also final as soon as every node has
+reported: the camera only confirms a count after the nodes succeed, so it is
+not waited for.
+"""
+import sqlite3
+import time
+
+# UPDATE ... RETURNING needs SQLite 3.35; older builds read the row back in the same transaction
+_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+
+class State:
+    __slots__ = ('done', 'failed', 'required', 'nodes_mask')
+
+    def __init__(self, done, failed, required, nodes_mask):
+        self.done, self.failed, self.required, self.nodes_mask = done, failed, required, nodes_mask
+
+    @property
+    def complete(self):
+        if self.done & self.required == self.required:
+            return True
+        return bool(self.failed & self.required) and self.done & self.nodes_mask == self.nodes_mask
+
+    @property
+    def success(self):
+        return self.complete and not (self.failed & self.required)
+
+    def outcome(self, line):
+        """Per participant: 'success' | 'failed' | None (not reported yet), in line order."""
+        out = {}
+        for p in line.participants:
+            bit = line.bit(p)
+            out[p] = None if not self.done & bit else ('failed' if self.failed & bit else 'success')
+        return out
+
+
+def label(participant):
+    return participant if isinstance(participant, str) else f"node{participant}"
+
+
+def reason(line, state):
+    """Failure reason in the historic format: "node1:success, node2:failed"."""
+    return ', '.join(f"{label(p)}:{st or 'missing'}" for p, st in state.outcome(line).items())
+
+
+def open_queue(conn, qid, line):
+    """Start tracking a queue the dispatcher reserved for ``line`` (same transaction)."""
+    conn.execute("""INSERT OR REPLACE INTO queue_completion(queue_id, line_id, required, done, failed, updated_at)
+                    VALUES (?,?,?,0,0,?)""", (qid, line.id, line.required, time.time()))
+
+
+def record(conn, qid, line, participant, ok):
+    """Set ``participant``'s bit; returns the new State, or None for a duplicate report or a queue
+    that is not on ``line`` (a stale or replayed evt from another line's node)."""
+    bit = line.bit(participant)
+    fail = 0 if ok else bit
+    now = time.time()
+    sql = ("UPDATE queue_completion SET done = done | ?, failed = failed | ?, updated_at = ? "
+           "WHERE queue_id = ? AND line_id = ? AND done & ? = 0")
+    params = (bit, fail, now, qid, line.id, bit)
+    if _RETURNING:
+        row = conn.execute(sql + " RETURNING done, failed, required", params).fetchone()
+    else:
+        row = None
+        if conn.execute(sql, params).rowcount:
+            row = conn.execute("SELECT done, failed, required FROM queue_completion WHERE queue_id=?", (qid,)).fetchone()
+    if row is not None:
+        return State(*row, line.nodes_mask)
+    # either a duplicate, another line's queue, or a queue dispatched before this table existed
+    cur = conn.execute("""INSERT OR IGNORE INTO queue_completion(queue_id, line_id, required, done, failed, updated_at)
+                          SELECT id, ?, ?, ?, ?, ? FROM queues WHERE id = ? AND COALESCE(line_id, ?) = ?""",
+                       (line.id, line.required, bit, fail, now, qid, line.id, line.id))
+    return State(bit, fail, line.required, line.nodes_mask) if cur.rowcount else None
+
+
+def on_line(conn, qid, line):
+    """False when the queue is known to belong to another line than ``line``."""
+    row = conn.execute("SELECT line_id FROM queue_completion WHERE queue_id=?", (qid,)).fetchone()
+    if row is None:
+        row = conn.execute("SELECT line_id FROM queues WHERE id=?", (qid,)).fetchone()
+    return row is None or row[0] is None or row[0] == line.id
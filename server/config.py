@@ -5,14 +5,22 @@ load_dotenv()
 FLASK_HOST = os.getenv("FLASK_HOST", "0.0.0.0")
 FLASK_PORT = int(os.getenv("FLASK_PORT", "5000"))
 
-DB_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "data", "app.db"))
+DB_PATH = os.getenv("DB_PATH") or os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "data", "app.db"))
+ARCHIVE_PATH = os.getenv("ARCHIVE_PATH") or os.path.join(os.path.dirname(DB_PATH), "archive.db")
 INIT_SQL = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "data", "init.sql"))
 
+MQTT_MODE = os.getenv("MQTT_MODE", "external")  # external (mosquitto) | embedded (server/broker.py)
+MQTT_EMBEDDED_LISTEN = os.getenv("MQTT_EMBEDDED_LISTEN", "")  # e.g. 0.0.0.0:1883 to let real nodes reach the embedded broker
 MQTT_BROKER = os.getenv("MQTT_BROKER", "127.0.0.1")
 MQTT_PORT = int(os.getenv("MQTT_PORT", "1883"))
 MQTT_CLIENT_ID = os.getenv("MQTT_CLIENT_ID", "odroid-flask")
+# reconnect backoff (seconds): doubles from MIN up to MAX while the broker is unreachable
+MQTT_RECONNECT_MIN = float(os.getenv("MQTT_RECONNECT_MIN", "1"))
+MQTT_RECONNECT_MAX = float(os.getenv("MQTT_RECONNECT_MAX", "30"))
 MQTT_TOPIC_CMD = os.getenv("MQTT_TOPIC_CMD", "disp/cmd/+")  # subscribe to disp/cmd/{nodeId}
 MQTT_TOPIC_ACK = os.getenv("MQTT_TOPIC_ACK", "disp/ack/+")  # ack from nodes: disp/ack/{nodeId}
 MQTT_TOPIC_EVT = os.getenv("MQTT_TOPIC_EVT", "disp/evt/+")  # event done from nodes: disp/evt/{nodeId}
 MQTT_TOPIC_STATE = os.getenv("MQTT_TOPIC_STATE", "disp/state/+")  # node state/ready: disp/state/{nodeId}
 MQTT_TOPIC_VISION = os.getenv("MQTT_TOPIC_VISION", "disp/vision/+")  # vision messages from cameras: disp/vision/{nodeId}
+# seconds a vision line waits for vision_complete after its nodes finished; then vision counts as failed (0 = wait forever)
+VISION_TIMEOUT_SEC = float(os.getenv("VISION_TIMEOUT_SEC", "60"))
@@ -1,37 +1,139 @@
+import logging
 import sqlite3
+import time
+import zlib
 from contextlib import closing
-from .config import DB_PATH, INIT_SQL
+from .config import ARCHIVE_PATH, DB_PATH, INIT_SQL
+from .metrics import DB_SECONDS, current_endpoint, startup_phase
 
-def get_conn():
+# Patient search index. The trigram tokenizer (SQLite >= 3.34) matches any 3+ character
+# substring, which also works for Thai names that have no spaces between words. Kept out
+# of init.sql so an older SQLite only loses the index (search falls back to LIKE).
+PATIENT_FTS_SQL = """
+CREATE VIRTUAL TABLE IF NOT EXISTS patients_fts USING fts5(
+  name, note, content='patients', content_rowid='id', tokenize='trigram'
+);
+CREATE TRIGGER IF NOT EXISTS patients_fts_ai AFTER INSERT ON patients BEGIN
+  INSERT INTO patients_fts(rowid, name, note) VALUES (new.id, new.name, new.note);
+END;
+CREATE TRIGGER IF NOT EXISTS patients_fts_ad AFTER DELETE ON patients BEGIN
+  INSERT INTO patients_fts(patients_fts, rowid, name, note) VALUES ('delete', old.id, old.name, old.note);
+END;
+CREATE TRIGGER IF NOT EXISTS patients_fts_au AFTER UPDATE ON patients BEGIN
+  INSERT INTO patients_fts(patients_fts, rowid, name, note) VALUES ('delete', old.id, old.name, old.note);
+  INSERT INTO patients_fts(rowid, name, note) VALUES (new.id, new.name, new.note);
+END;
+"""
+
+_patient_fts = None
+
+_logger = logging.getLogger(__name__)
+
+
+def get_conn(archive=False):
+    """``archive=True`` also attaches the archive DB as schema ``archive`` (see server/archive.py)."""
     conn = sqlite3.connect(DB_PATH, check_same_thread=False)
     conn.row_factory = sqlite3.Row
+    if archive:
+        conn.execute("ATTACH DATABASE ? AS archive", (ARCHIVE_PATH,))
     return conn
 
+def schema_version(init_sql):
+    """Fingerprint of everything init_db() creates, stored in PRAGMA user_version.
+
+    Editing init.sql, the FTS index or the archive layout changes it, so the next
+    start runs the (idempotent) schema work once; every other start skips it.
+    """
+    from .archive import ARCHIVE_SQL
+    return zlib.crc32((init_sql + PATIENT_FTS_SQL + ARCHIVE_SQL).encode('utf-8')) & 0x7FFFFFFF
+
+
+def _stored_versions():
+    with closing(get_conn(archive=True)) as conn:
+        return (conn.execute("PRAGMA main.user_version").fetchone()[0],
+                conn.execute("PRAGMA archive.user_version").fetchone()[0])
+
+
 def init_db():
-    with open(INIT_SQL, "r", encoding="utf-8") as f, closing(get_conn()) as conn:
-        conn.executescript(f.read())
+    t0 = time.perf_counter()
+    with open(INIT_SQL, "r", encoding="utf-8") as f:
+        init_sql = f.read()
+    version = schema_version(init_sql)
+    if _stored_versions() == (version, version):
+        startup_phase('schema')
+        _logger.debug('schema %s up to date (%.1f ms)', version, (time.perf_counter() - t0) * 1000)
+        return False
+    _migrate(init_sql)
+    with closing(get_conn(archive=True)) as conn:
+        # PRAGMA does not take parameters; version is an int we computed
+        conn.execute(f"PRAGMA main.user_version = {version}")
+        conn.execute(f"PRAGMA archive.user_version = {version}")
+        conn.commit()
+    startup_phase('schema')
+    _logger.info('schema migrated to %s in %.0f ms', version, (time.perf_counter() - t0) * 1000)
+    return True
+
+
+def _migrate(init_sql):
+    with closing(get_conn()) as conn:
+        conn.executescript(init_sql)
         # lightweight migration: ensure 'note' column exists in queues (older DBs)
         try:
             cur = conn.execute("PRAGMA table_info(queues)")
             cols = [r[1] for r in cur.fetchall()]
             if 'note' not in cols:
                 conn.execute("ALTER TABLE queues ADD COLUMN note TEXT")
+            if 'line_id' not in cols:
+                conn.execute("ALTER TABLE queues ADD COLUMN line_id INTEGER")
+                # a queue in progress before the upgrade belongs to the original line
+                from .lines import DEFAULT_LINE
+                conn.execute("UPDATE queues SET line_id=? WHERE status='in_progress'", (DEFAULT_LINE,))
         except Exception:
             pass
+        _init_patient_fts(conn)
         conn.commit()
+    from .archive import init_archive
+    init_archive()
+    from .reports import backfill_if_empty
+    backfill_if_empty()
 
-def query(sql, params=()):
-    with closing(get_conn()) as conn:
-        cur = conn.execute(sql, params)
-        # normalize column names to lowercase to avoid case-sensitivity issues
-        rows = []
-        for r in cur.fetchall():
-            d = dict(r)
-            rows.append({k.lower(): v for k, v in d.items()})
-    return rows
+def _init_patient_fts(conn):
+    try:
+        existed = conn.execute("SELECT 1 FROM sqlite_master WHERE name='patients_fts'").fetchone()
+        conn.executescript(PATIENT_FTS_SQL)
+        if not existed:
+            # index patients that were inserted before the triggers existed
+            conn.execute("INSERT INTO patients_fts(patients_fts) VALUES('rebuild')")
+    except sqlite3.OperationalError:
+        pass  # no FTS5 / trigram tokenizer in this SQLite build
+
+def patient_fts_available():
+    """True when the patients_fts index exists (checked once per process)."""
+    global _patient_fts
+    if _patient_fts is None:
+        _patient_fts = bool(query("SELECT 1 x FROM sqlite_master WHERE name='patients_fts'"))
+    return _patient_fts
+
+def query(sql, params=(), archive=False):
+    t0 = time.perf_counter()
+    try:
+        with closing(get_conn(archive)) as conn:
+            cur = conn.execute(sql, params)
+            # normalize column names to lowercase to avoid case-sensitivity issues
+            rows = []
+            for r in cur.fetchall():
+                d = dict(r)
+                rows.append({k.lower(): v for k, v in d.items()})
+        return rows
+    finally:
+        DB_SECONDS.observe(time.perf_counter() - t0, current_endpoint.get(), 'query')
 
 def execute(sql, params=()):
-    with closing(get_conn()) as conn:
-        cur = conn.execute(sql, params)
-        conn.commit()
-        return cur.lastrowid
+    t0 = time.perf_counter()
+    try:
+        with closing(get_conn()) as conn:
+            cur = conn.execute(sql, params)
+            conn.commit()
+            return cur.lastrowid
+    finally:
+        DB_SECONDS.observe(time.perf_counter() - t0, current_endpoint.get(), 'execute')
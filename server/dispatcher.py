@@ -0,0 +1,199 @@
+"""Single-dispatcher election for multi-process serving (server/wsgi.py).
+
+Only one process may own the MQTT client, the readiness watchdog and
+``_dispatch_next_queue``; several would share one MQTT client id and race on
+dispatch. Every worker calls ``ensure_started()``:
+
+* the worker that wins a non-blocking ``flock`` on ``DISPATCH_LOCK`` becomes
+  the owner: it starts the MQTT client and listens on a unix datagram socket
+  (``DISPATCH_SOCKET``) for dispatch triggers
+* the others stay HTTP-only, ``trigger()`` sends them one datagram, and they
+  retry the lock every ``DISPATCH_ELECT_SEC`` seconds so a new owner takes
+  over if the old one dies (the kernel drops the lock with the process)
+
+In a single process (``python -m server.app`` / ``server.asgi``) nothing is
+elected and ``trigger()`` dispatches directly.
+
+Some state only exists in the owner's memory: node readiness, vision health,
+the active-queue context, the latency window (``tracing``) and the metrics of
+the MQTT/dispatch path. Endpoints that show it call ``ask_owner(name)``; a
+follower sends ``{"q": name, "args": ...}`` over the same socket from a socket
+bound to its own path and waits up to DISPATCH_QUERY_TIMEOUT for the owner's
+zlib-compressed JSON reply. Answers are registered with ``register_query``.
+If the owner does not answer (mid-failover), the follower answers from its own
+memory.
+"""
+import errno
+import itertools
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import zlib
+
+from . import mqtt_client
+
+try:
+    import fcntl
+except ImportError:  # not on Windows; fall back to single-process behaviour
+    fcntl = None
+
+_logger = logging.getLogger(__name__)
+
+_DATA = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "data"))
+DISPATCH_LOCK = os.getenv("DISPATCH_LOCK", os.path.join(_DATA, "dispatcher.lock"))
+DISPATCH_SOCKET = os.getenv("DISPATCH_SOCKET", os.path.join(_DATA, "dispatcher.sock"))
+DISPATCH_ELECT_SEC = float(os.getenv("DISPATCH_ELECT_SEC", "5"))
+DISPATCH_QUERY_TIMEOUT = float(os.getenv("DISPATCH_QUERY_TIMEOUT", "1.0"))
+
+_TRIGGER = b'dispatch'
+_MAX_DATAGRAM = 4 * 1024 * 1024
+
+_role = None          # None (single process) | 'owner' | 'follower'
+_pid = None
+_lock_fd = None
+_start_lock = threading.Lock()
+_queries = {}         # name -> fn(**args), answered by the owner
+_query_seq = itertools.count(1)
+
+
+def role():
+    return _role
+
+
+def ensure_started():
+    """Join the election once per process (cheap to call on every request)."""
+    global _pid, _role
+    if _pid == os.getpid():
+        return
+    with _start_lock:
+        if _pid == os.getpid():
+            return
+        _pid = os.getpid()
+        _role = None
+        if fcntl is None:
+            mqtt_client.get_client()
+            return
+        if not _try_become_owner():
+            _role = 'follower'
+            _logger.info('pid %s: dispatcher owned by another worker; forwarding triggers to %s', _pid, DISPATCH_SOCKET)
+            threading.Thread(target=_elect_loop, name='dispatcher-elect', daemon=True).start()
+
+
+def _try_become_owner():
+    global _lock_fd, _role
+    fd = os.open(DISPATCH_LOCK, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError as e:
+        os.close(fd)
+        if e.errno in (errno.EAGAIN, errno.EACCES, errno.EWOULDBLOCK):
+            return False
+        raise
+    os.ftruncate(fd, 0)
+    os.write(fd, str(os.getpid()).encode())
+    _lock_fd = fd
+    _role = 'owner'
+    _logger.info('pid %s: elected dispatcher (MQTT owner)', os.getpid())
+    sock = _bind_socket()
+    client = mqtt_client.get_client()
+    threading.Thread(target=_serve_triggers, args=(sock, client), name='dispatcher-ipc', daemon=True).start()
+    return True
+
+
+def _elect_loop():
+    while _role == 'follower':
+        time.sleep(DISPATCH_ELECT_SEC)
+        try:
+            if _try_become_owner():
+                return
+        except Exception as e:
+            _logger.warning('dispatcher election failed: %s', e)
+
+
+def _bind_socket():
+    try:
+        os.unlink(DISPATCH_SOCKET)   # stale socket from a previous owner
+    except FileNotFoundError:
+        pass
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.bind(DISPATCH_SOCKET)
+    return sock
+
+
+def _serve_triggers(sock, client):
+    while True:
+        try:
+            msgs = [sock.recvfrom(65536)]
+            # coalesce a burst of triggers into one dispatch pass
+            sock.setblocking(False)
+            try:
+                while True:
+                    msgs.append(sock.recvfrom(65536))
+            except BlockingIOError:
+                pass
+            finally:
+                sock.setblocking(True)
+            triggered = False
+            for data, addr in msgs:
+                if data == _TRIGGER:
+                    triggered = True
+                elif addr:
+                    _answer(sock, data, addr)
+            if triggered:
+                mqtt_client._dispatch_next_queue(client)
+        except Exception as e:
+            _logger.warning('forwarded dispatch failed: %s', e)
+
+
+def _answer(sock, data, addr):
+    try:
+        req = json.loads(data)
+        result = _queries[req['q']](**(req.get('args') or {}))
+        sock.sendto(zlib.compress(json.dumps(result).encode('utf-8')), addr)
+    except Exception as e:
+        _logger.warning('owner query %r from %s failed: %s', data[:64], addr, e)
+
+
+def register_query(name, fn):
+    """Make ``fn(**args)`` answerable by ``ask_owner(name, **args)`` (its result must be JSON-serialisable)."""
+    _queries[name] = fn
+
+
+def ask_owner(name, **args):
+    """Answer of query ``name`` from the dispatcher owner; computed locally in the owner or a single process."""
+    if _role != 'follower':
+        return _queries[name](**args)
+    path = os.path.join(os.path.dirname(DISPATCH_SOCKET), f".query-{os.getpid()}-{next(_query_seq)}.sock")
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        s.bind(path)
+        s.settimeout(DISPATCH_QUERY_TIMEOUT)
+        s.sendto(json.dumps({'q': name, 'args': args}).encode('utf-8'), DISPATCH_SOCKET)
+        return json.loads(zlib.decompress(s.recv(_MAX_DATAGRAM)))
+    except OSError as e:
+        _logger.warning('owner did not answer %s (%s); answering from pid %s', name, e, os.getpid())
+        return _queries[name](**args)
+    finally:
+        s.close()
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+
+def trigger():
+    """Ask the dispatcher to try the next queue; returns the dispatch result, or None when forwarded."""
+    if _role == 'follower':
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            s.sendto(_TRIGGER, DISPATCH_SOCKET)
+        except OSError as e:
+            # no owner right now (e.g. mid-failover); the owner's watchdog will pick the queue up
+            _logger.warning('dispatch trigger not delivered: %s', e)
+        finally:
+            s.close()
+        return None
+    return mqtt_client._dispatch_next_queue(mqtt_client.get_client())
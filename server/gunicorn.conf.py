@@ -0,0 +1,21 @@
+import multiprocessing
+import os
+
+bind = f"{os.getenv('FLASK_HOST', '0.0.0.0')}:{os.getenv('FLASK_PORT', '5000')}"
+workers = int(os.getenv("WEB_WORKERS", str(min(4, multiprocessing.cpu_count()))))
+threads = int(os.getenv("WEB_THREADS", "4"))
+timeout = 30
+# the dispatcher election must happen per worker, after fork
+preload_app = False
+
+
+def on_starting(server):
+    # schema work once, in the master, before any worker exists (workers inherit the flag)
+    from server.db import init_db
+    init_db()
+    os.environ["DISPENSE_SCHEMA_READY"] = "1"
+
+
+def post_fork(server, worker):
+    from server import dispatcher
+    dispatcher.ensure_started()
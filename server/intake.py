@@ -0,0 +1,161 @@
+"""Queue intake: predicted wait and admission limits for POST /api/queues.
+
+Service time is how long a queue keeps its line busy, from ``reserved`` to the
+final decision. One EWMA per room is kept in ``room_service`` and updated in
+the same transaction that finishes the queue (``record_service``), so every
+worker predicts from the same numbers without scanning history.
+
+Dispatch is strict FIFO over all rooms, so a new queue waits for everything
+ahead of it, spread over the lines:
+
+    wait = (sum of service(room) over queued ahead
+            + sum of what is left of each in-progress queue) / number of lines
+
+Admission limits are checked inside the intake transaction, so concurrent
+requests can't overshoot them:
+
+    INTAKE_MAX_PENDING       queued (pending + deferred) over all rooms, 0 = no limit
+    INTAKE_MAX_PENDING_ROOM  queued per room, 0 = no limit
+    INTAKE_OVERLOAD=reject   reject: 429 with Retry-After
+                             defer:  store the queue as 'deferred'; the readiness
+                                     watchdog turns deferred queues into pending ones,
+                                     oldest first, as the backlog drains
+
+Environment (model):
+    SERVICE_EWMA_ALPHA=0.2   weight of the newest sample
+    SERVICE_DEFAULT_SEC=30   service time assumed for a room with no samples yet
+"""
+import logging
+import os
+import time
+from contextlib import closing
+
+from . import lines
+from .db import get_conn, query
+
+_logger = logging.getLogger(__name__)
+
+INTAKE_MAX_PENDING = int(os.getenv("INTAKE_MAX_PENDING", "0"))
+INTAKE_MAX_PENDING_ROOM = int(os.getenv("INTAKE_MAX_PENDING_ROOM", "0"))
+INTAKE_OVERLOAD = os.getenv("INTAKE_OVERLOAD", "reject").lower()   # reject | defer
+SERVICE_EWMA_ALPHA = float(os.getenv("SERVICE_EWMA_ALPHA", "0.2"))
+SERVICE_DEFAULT_SEC = float(os.getenv("SERVICE_DEFAULT_SEC", "30"))
+
+_UPSERT_SERVICE = """
+INSERT INTO room_service(room_id, ewma_sec, samples, updated_at) VALUES (?,?,1,?)
+ON CONFLICT(room_id) DO UPDATE SET
+  ewma_sec = ewma_sec + ? * (excluded.ewma_sec - ewma_sec),
+  samples = samples + 1,
+  updated_at = excluded.updated_at
+"""
+
+
+class Overloaded(Exception):
+    """Raised by ``admit`` when a limit is reached and INTAKE_OVERLOAD=reject."""
+
+    def __init__(self, reason, retry_after):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+def record_service(conn, qid):
+    """Feed the finished queue's reserved -> now time into its room's EWMA (same transaction)."""
+    row = conn.execute("""
+        SELECT q.target_room, MAX(t.ts) FROM queues q
+        JOIN queue_trace t ON t.queue_id = q.id AND t.stage = 'reserved'
+        WHERE q.id = ?""", (qid,)).fetchone()
+    if row is None or row[1] is None:
+        return
+    now = time.time()
+    seconds = max(0.0, now - row[1])
+    conn.execute(_UPSERT_SERVICE, (row[0], seconds, now, SERVICE_EWMA_ALPHA))
+
+
+def service_times():
+    """room_id -> EWMA service seconds (rooms without samples are absent)."""
+    return {r['room_id']: r['ewma_sec'] for r in query("SELECT room_id, ewma_sec FROM room_service")}
+
+
+def _queued_by_room(conn, before_id=None):
+    sql = "SELECT target_room, COUNT(*) FROM queues WHERE status IN ('pending','deferred')"
+    params = ()
+    if before_id is not None:
+        sql += " AND id < ?"
+        params = (before_id,)
+    return dict(conn.execute(sql + " GROUP BY target_room", params).fetchall())
+
+
+def _over_limit(queued, room):
+    if INTAKE_MAX_PENDING and sum(queued.values()) >= INTAKE_MAX_PENDING:
+        return f"{sum(queued.values())} queues waiting (limit {INTAKE_MAX_PENDING})"
+    if INTAKE_MAX_PENDING_ROOM and queued.get(room, 0) >= INTAKE_MAX_PENDING_ROOM:
+        return f"{queued.get(room, 0)} queues waiting for room {room} (limit {INTAKE_MAX_PENDING_ROOM})"
+    return None
+
+
+def admit(conn, room):
+    """Status for a new queue to ``room``: 'pending' or 'deferred'; raises Overloaded (inside the intake transaction)."""
+    if not (INTAKE_MAX_PENDING or INTAKE_MAX_PENDING_ROOM):
+        return 'pending'
+    queued = _queued_by_room(conn)
+    # deferred queues keep their place: nothing new skips ahead of them
+    deferred = conn.execute("SELECT 1 FROM queues WHERE status='deferred' LIMIT 1").fetchone()
+    reason = _over_limit(queued, room)
+    if reason is None and not deferred:
+        return 'pending'
+    if INTAKE_OVERLOAD == 'defer':
+        return 'deferred'
+    reason = reason or 'deferred queues are waiting'
+    raise Overloaded(reason, _retry_after(conn))
+
+
+def _retry_after(conn):
+    # roughly when one queue will have left the backlog
+    times = service_times()
+    avg = sum(times.values()) / len(times) if times else SERVICE_DEFAULT_SEC
+    return max(1, int(round(avg / max(1, len(lines.all_lines())))))
+
+
+def predict(qid):
+    """{'position', 'predicted_wait_sec'} for queue ``qid`` (position 1 = next to be dispatched)."""
+    times = service_times()
+    with closing(get_conn()) as conn:
+        ahead = _queued_by_room(conn, before_id=qid)
+        running = conn.execute("""
+            SELECT q.target_room, MAX(t.ts) FROM queues q
+            LEFT JOIN queue_trace t ON t.queue_id = q.id AND t.stage = 'reserved'
+            WHERE q.status = 'in_progress' GROUP BY q.id""").fetchall()
+    now = time.time()
+    work = sum(n * times.get(room, SERVICE_DEFAULT_SEC) for room, n in ahead.items())
+    for room, reserved in running:
+        expected = times.get(room, SERVICE_DEFAULT_SEC)
+        work += max(0.0, expected - (now - reserved)) if reserved else expected
+    return {'position': sum(ahead.values()) + 1,
+            'predicted_wait_sec': round(work / max(1, len(lines.all_lines())), 1)}
+
+
+def promote_deferred():
+    """Turn deferred queues into pending ones, oldest first, while the limits allow; returns how many."""
+    if not query("SELECT 1 x FROM queues WHERE status='deferred' LIMIT 1"):
+        return 0
+    promoted = []
+    with closing(get_conn()) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            queued = dict(conn.execute("""SELECT target_room, COUNT(*) FROM queues
+                                          WHERE status='pending' GROUP BY target_room""").fetchall())
+            for qid, room in conn.execute("SELECT id, target_room FROM queues WHERE status='deferred' ORDER BY id").fetchall():
+                if _over_limit(queued, room):
+                    break   # FIFO: a deferred queue never overtakes an older one
+                conn.execute("UPDATE queues SET status='pending' WHERE id=? AND status='deferred'", (qid,))
+                conn.execute("INSERT INTO events(queue_id, event, message) VALUES(?,?,?)", (qid, 'admitted', 'deferred -> pending'))
+                queued[room] = queued.get(room, 0) + 1
+                promoted.append(qid)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    if promoted:
+        _logger.info('deferred queues admitted: %s', promoted)
+    return len(promoted)
@@ -0,0 +1,91 @@
+"""Dispenser line registry.
+
+A line is one set of NodeMCUs that serve a queue together: the first node
+gets the full item list (disp/cmd/{node}), the others only the trigger, and
+the queue is done when every node of the line has sent its evt. Each line has
+its own readiness and its own in-progress slot (``queues.line_id``), so
+pending queues go to whichever line is free.
+
+Node ids are the topic namespace (disp/{cmd,ack,evt,state}/{nodeId}), so a
+second line is just a second pair of boards flashed with other ids:
+
+    DISPENSE_LINES="1:1,2"           default, the original pair
+    DISPENSE_LINES="1:1,2;2:3,4"     two lines
+    DISPENSE_LINES="1:1,2,vision"    the camera's count must also match before the queue succeeds
+                                     (no vision_complete within VISION_TIMEOUT_SEC of the
+                                     last node report fails the queue)
+
+The participants of a line (its nodes, then ``vision``) are the bits of the
+completion masks in server/completion.py.
+"""
+import os
+
+DISPENSE_LINES = os.getenv("DISPENSE_LINES", "1:1,2")
+
+
+VISION = 'vision'
+
+
+class Line:
+    __slots__ = ('id', 'nodes', 'vision', 'participants', 'required', 'nodes_mask')
+
+    def __init__(self, line_id, nodes, vision=False):
+        self.id = line_id
+        self.nodes = tuple(nodes)
+        self.vision = vision
+        self.participants = self.nodes + ((VISION,) if vision else ())
+        self.required = (1 << len(self.participants)) - 1
+        self.nodes_mask = (1 << len(self.nodes)) - 1
+
+    def bit(self, participant):
+        return 1 << self.participants.index(participant)
+
+    def requires(self, participant):
+        return participant in self.participants
+
+    @property
+    def items_node(self):
+        """Node that receives the item list (node 1 on the original line)."""
+        return self.nodes[0]
+
+    def __repr__(self):
+        return f"Line({self.id}, nodes={self.nodes}{', vision' if self.vision else ''})"
+
+
+def parse(spec):
+    lines = {}
+    seen = set()
+    for part in (spec or '').split(';'):
+        if not part.strip():
+            continue
+        lid, _, nodes = part.partition(':')
+        tokens = [n.strip() for n in nodes.split(',') if n.strip()]
+        vision = VISION in tokens
+        ids = [int(n) for n in tokens if n != VISION]
+        if not ids:
+            raise ValueError(f"line '{part}' has no nodes")
+        if seen & set(ids):
+            raise ValueError(f"node(s) {sorted(seen & set(ids))} belong to more than one line")
+        seen.update(ids)
+        lines[int(lid)] = Line(int(lid), ids, vision)
+    if not lines:
+        raise ValueError("DISPENSE_LINES is empty")
+    return lines
+
+
+LINES = parse(DISPENSE_LINES)
+DEFAULT_LINE = min(LINES)
+_by_node = {n: line for line in LINES.values() for n in line.nodes}
+
+
+def all_lines():
+    return [LINES[k] for k in sorted(LINES)]
+
+
+def get(line_id):
+    return LINES.get(line_id)
+
+
+def of_node(node_id):
+    """Line a node belongs to (None for unknown nodes)."""
+    return _by_node.get(node_id)
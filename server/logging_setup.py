@@ -0,0 +1,141 @@
+"""Logging pipeline for the server.
+
+Request and MQTT threads only enqueue records (``QueueHandler``). Formatting
+and I/O happen on one ``QueueListener`` thread, so a slow SD card or terminal
+never adds to request latency. Record arguments are formatted on that thread
+too; callers must keep using ``%s`` arguments rather than f-strings, so a
+disabled level costs one ``isEnabledFor`` check.
+
+Environment:
+    LOG_LEVEL=INFO                  root level
+    LOG_LEVELS=werkzeug=WARNING,... per-category levels (logger=LEVEL, comma separated)
+    LOG_FORMAT=json|text            one JSON object per line (default) or classic text
+    LOG_FILE=path                   also write to a rotating file
+    LOG_HEARTBEAT_EVERY=60          an unchanged node heartbeat is logged at most once per N seconds
+"""
+import atexit
+import datetime
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+import time
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_LEVELS = os.getenv("LOG_LEVELS", "werkzeug=WARNING")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+LOG_FILE = os.getenv("LOG_FILE", "")
+LOG_HEARTBEAT_EVERY = float(os.getenv("LOG_HEARTBEAT_EVERY", "60"))
+
+HEARTBEAT_LOGGER = 'server.mqtt_client.heartbeat'
+
+_STD_ATTRS = set(vars(logging.LogRecord('x', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+_listener = None
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record; ``extra={...}`` fields are kept as top-level keys."""
+
+    def format(self, record):
+        out = {
+            'ts': datetime.datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+            'thread': record.threadName,
+        }
+        for k, v in record.__dict__.items():
+            if k not in _STD_ATTRS and not k.startswith('_'):
+                out[k] = v
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            out['exc'] = record.exc_text
+        return json.dumps(out, ensure_ascii=False, default=str)
+
+
+class RateLimitFilter(logging.Filter):
+    """Let through one record per distinct (message, args) every ``interval`` seconds.
+
+    Repeats of the same heartbeat are sampled while a change (e.g. ready 0 -> 1)
+    is a new key and always logged.
+    The next record that passes carries ``suppressed=<n>`` for what was dropped.
+    """
+
+    def __init__(self, interval):
+        super().__init__()
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._last = {}
+        self._dropped = {}
+
+    def filter(self, record):
+        key = (record.msg, record.args if isinstance(record.args, tuple) else None)
+        try:
+            hash(key)
+        except TypeError:
+            key = (record.msg, None)
+        now = time.monotonic()
+        with self._lock:
+            last = self._last.get(key)
+            if last is not None and now - last < self.interval:
+                self._dropped[key] = self._dropped.get(key, 0) + 1
+                return False
+            self._last[key] = now
+            dropped = self._dropped.pop(key, 0)
+        if dropped:
+            record.suppressed = dropped
+        return True
+
+
+class _LazyQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # the stock prepare() formats the message on the calling thread; defer that to the
+        # listener and only render the traceback, which cannot outlive the caller's frames
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def _parse_levels(spec):
+    levels = {}
+    for part in (spec or '').split(','):
+        name, _, level = part.partition('=')
+        if name.strip() and level.strip():
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def setup_logging():
+    """Install the queue pipeline on the root logger (idempotent)."""
+    global _listener
+    if _listener is not None:
+        return _listener
+    if LOG_FORMAT == 'text':
+        formatter = logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s')
+    else:
+        formatter = JsonFormatter()
+    handlers = [logging.StreamHandler()]
+    if LOG_FILE:
+        handlers.append(logging.handlers.RotatingFileHandler(LOG_FILE, maxBytes=5 * 1024 * 1024, backupCount=3,
+                                                             encoding='utf-8'))
+    for h in handlers:
+        h.setFormatter(formatter)
+
+    q = queue.SimpleQueue()
+    root = logging.getLogger()
+    for h in list(root.handlers):
+        root.removeHandler(h)
+    root.addHandler(_LazyQueueHandler(q))
+    root.setLevel(LOG_LEVEL.upper())
+    for name, level in _parse_levels(LOG_LEVELS).items():
+        logging.getLogger(name).setLevel(level)
+    logging.getLogger(HEARTBEAT_LOGGER).addFilter(RateLimitFilter(LOG_HEARTBEAT_EVERY))
+
+    _listener = logging.handlers.QueueListener(q, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
+    return _listener
@@ -0,0 +1,161 @@
+"""Tiny in-process metrics registry (counters + histograms) with Prometheus text output.
+
+Kept dependency-free on purpose: one small lock per metric, fixed buckets, label
+values as tuples. Recording a sample is a dict lookup + bisect, so it is cheap
+enough to sit in db.query/db.execute and the MQTT callback.
+"""
+import bisect
+import threading
+import time
+from contextvars import ContextVar
+
+# Flask endpoint of the request being served ('-' outside a request: MQTT thread, watchdog, ...)
+current_endpoint = ContextVar('current_endpoint', default='-')
+
+PROCESS_START = time.perf_counter()
+_phases_seen = set()
+_phases_lock = threading.Lock()
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+STAGE_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+
+def _escape(value):
+    # Prometheus text format: backslash, double quote and newline are escaped in label values
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _fmt_labels(names, values, extra=None):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _label_key(item):
+    return tuple(str(v) for v in item[0])
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, doc, labelnames=()):
+        self.name = name
+        self.doc = doc
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        with self._lock:
+            items = list(self._values.items())
+        return [f'{self.name}{_fmt_labels(self.labelnames, k)} {v}' for k, v in sorted(items, key=_label_key)]
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, doc, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.doc = doc
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}  # labels -> [bucket counts..., +Inf count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            s = self._series.get(labels)
+            if s is None:
+                s = self._series[labels] = [0] * (len(self.buckets) + 2)
+            s[i] += 1
+            s[-1] += value
+
+    def time(self, *labels):
+        return _Timer(self, labels)
+
+    def render(self):
+        with self._lock:
+            items = [(k, list(v)) for k, v in self._series.items()]
+        out = []
+        for labels, s in sorted(items, key=_label_key):
+            acc = 0
+            for b, c in zip(self.buckets + ('+Inf',), s[:-1]):
+                acc += c
+                le = 'le="%s"' % b
+                out.append(f'{self.name}_bucket{_fmt_labels(self.labelnames, labels, le)} {acc}')
+            out.append(f'{self.name}_sum{_fmt_labels(self.labelnames, labels)} {s[-1]:.6f}')
+            out.append(f'{self.name}_count{_fmt_labels(self.labelnames, labels)} {acc}')
+        return out
+
+
+class _Timer:
+    __slots__ = ('hist', 'labels', 't0')
+
+    def __init__(self, hist, labels):
+        self.hist = hist
+        self.labels = labels
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.hist.observe(time.perf_counter() - self.t0, *self.labels)
+        return False
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name, doc, labelnames=()):
+        m = Counter(name, doc, labelnames)
+        self._metrics.append(m)
+        return m
+
+    def histogram(self, name, doc, labelnames=(), buckets=DEFAULT_BUCKETS):
+        m = Histogram(name, doc, labelnames, buckets)
+        self._metrics.append(m)
+        return m
+
+    def render(self):
+        lines = []
+        for m in self._metrics:
+            lines.append(f'# HELP {m.name} {m.doc}')
+            lines.append(f'# TYPE {m.name} {m.kind}')
+            lines.extend(m.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+# ---- server metrics
+HTTP_SECONDS = REGISTRY.histogram('dispense_http_request_seconds', 'HTTP request latency', ('endpoint', 'method', 'status'))
+DB_SECONDS = REGISTRY.histogram('dispense_db_seconds', 'Time spent in db.query/db.execute', ('endpoint', 'op'))
+DISPATCH_SECONDS = REGISTRY.histogram('dispense_dispatch_seconds', 'Duration of _dispatch_next_queue', ('result',))
+DISPATCH_TOTAL = REGISTRY.counter('dispense_dispatch_total', 'Dispatch attempts by result', ('result',))
+COMPLETION_SECONDS = REGISTRY.histogram('dispense_completion_seconds', 'Duration of node completion handling', ('node',))
+MQTT_MESSAGES = REGISTRY.counter('dispense_mqtt_messages_total', 'MQTT messages received', ('kind', 'node'))
+MQTT_SECONDS = REGISTRY.histogram('dispense_mqtt_handle_seconds', 'on_message handling time', ('kind',))
+# seconds since this module was imported (process start) when each startup step finished; see startup_phase()
+STARTUP_SECONDS = REGISTRY.histogram('dispense_startup_seconds', 'Time from process start to each startup phase',
+                                     ('phase',), (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60))
+QUEUE_STAGE_SECONDS = REGISTRY.histogram('dispense_queue_stage_seconds',
+                                         'Queue time per lifecycle transition', ('transition',), STAGE_BUCKETS)
+
+
+def startup_phase(phase):
+    """Record the first time ``phase`` is reached in this process; returns the elapsed seconds (None after the first)."""
+    with _phases_lock:
+        if phase in _phases_seen:
+            return None
+        _phases_seen.add(phase)
+    elapsed = time.perf_counter() - PROCESS_START
+    STARTUP_SECONDS.observe(elapsed, phase)
+    return elapsed
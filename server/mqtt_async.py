@@ -0,0 +1,211 @@
+"""asyncio MQTT 3.1.1 client for the ASGI runtime (server/asgi.py).
+
+Speaks the same packet codec as the embedded broker and keeps the paho
+callback signatures, so ``mqtt_client.on_connect``/``on_message`` work
+unchanged. Socket I/O, keepalive and QoS1 retransmission live on the event
+loop (``retry_interval=None`` turns retransmission off for a caller that
+redelivers itself, like the command outbox); callbacks run on ``handler_executor`` (one thread by default, which
+keeps per-topic ordering like paho's network thread). ``publish`` and
+``subscribe`` are safe to call from any thread.
+"""
+import asyncio
+import itertools
+import logging
+import struct
+
+from .broker import (CONNACK, CONNECT, PINGREQ, PINGRESP, PUBACK, PUBCOMP, PUBLISH, PUBREC, PUBREL,
+                     SUBACK, SUBSCRIBE, MQTTMessage, PublishInfo, decode_str, encode_packet,
+                     encode_publish, encode_str, next_packet_id, _to_bytes)
+
+_logger = logging.getLogger(__name__)
+
+
+async def read_packet(reader):
+    """-> (ptype, flags, body); raises IncompleteReadError on EOF."""
+    head = await reader.readexactly(1)
+    mult, length = 1, 0
+    while True:
+        b = (await reader.readexactly(1))[0]
+        length += (b & 0x7F) * mult
+        if not b & 0x80:
+            break
+        mult *= 128
+    body = await reader.readexactly(length) if length else b''
+    return head[0] >> 4, head[0] & 0x0F, body
+
+
+class AsyncMQTTClient:
+    def __init__(self, client_id, handler_executor=None, retry_interval=5.0):
+        self._client_id = client_id
+        self._executor = handler_executor
+        self.retry_interval = retry_interval
+        self.on_connect = None
+        self.on_message = None
+        self.on_publish = None
+        self._userdata = None
+        self._loop = None
+        self._writer = None
+        self._connected = False
+        self._mids = itertools.count(1)
+        self._subs = {}       # filter -> qos, re-sent on every reconnect
+        self._inflight = {}   # mid -> (topic, payload, retain, PublishInfo, sent_at)
+        self._stop = False
+
+    # ---- paho-compatible, thread-safe
+    def is_connected(self):
+        return self._connected
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        info = PublishInfo(self._next_mid())
+        payload = _to_bytes(payload)
+        qos = min(int(qos), 1)
+        self._call(self._send_publish, topic, payload, qos, retain, info)
+        return info
+
+    def subscribe(self, topic, qos=0):
+        mid = self._next_mid()
+        self._subs[topic] = min(int(qos), 1)
+        self._call(self._send_subscribe, mid, [(topic, self._subs[topic])])
+        return (0, mid)
+
+    def disconnect(self):
+        self._stop = True
+        self._call(self._close)
+
+    # ---- loop side
+    def _next_mid(self):
+        return next_packet_id(self._mids, self._inflight)
+
+    def _call(self, fn, *args):
+        loop = self._loop
+        if loop is None:
+            return
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            fn(*args)
+        else:
+            loop.call_soon_threadsafe(fn, *args)
+
+    def _write(self, data):
+        if self._writer is not None and self._connected:
+            self._writer.write(data)
+            return True
+        return False
+
+    def _send_publish(self, topic, payload, qos, retain, info, dup=False):
+        if qos:
+            self._inflight[info.mid] = (topic, payload, retain, info, self._loop.time())
+        if self._write(encode_publish(topic, payload, qos, retain, info.mid if qos else None, dup)) and not qos:
+            info._done.set()
+        elif not qos:
+            _logger.warning('MQTT publish dropped (not connected): %s', topic)
+
+    def _send_subscribe(self, mid, subs):
+        body = struct.pack('!H', mid) + b''.join(encode_str(t) + bytes([q]) for t, q in subs)
+        self._write(encode_packet(SUBSCRIBE, 0x02, body))
+
+    def _close(self):
+        if self._writer is not None:
+            self._writer.close()
+
+    async def run(self, host, port, keepalive=60, max_backoff=30.0):
+        """Connect and keep reconnecting (exponential backoff) until ``disconnect()``."""
+        self._loop = asyncio.get_running_loop()
+        backoff = 1.0
+        while not self._stop:
+            try:
+                reader, writer = await asyncio.open_connection(host, port)
+            except OSError as e:
+                _logger.warning('MQTT connect to %s:%s failed: %s (retry in %.0fs)', host, port, e, backoff)
+                await asyncio.sleep(backoff)
+                backoff = min(max_backoff, backoff * 2)
+                continue
+            self._writer = writer
+            try:
+                await self._session(reader, writer, keepalive)
+                backoff = 1.0
+            except (asyncio.IncompleteReadError, ConnectionError, OSError) as e:
+                _logger.warning('MQTT connection lost: %s', e)
+            finally:
+                self._connected = False
+                self._writer = None
+                writer.close()
+            if not self._stop:
+                await asyncio.sleep(backoff)
+                backoff = min(max_backoff, backoff * 2)
+
+    async def _session(self, reader, writer, keepalive):
+        body = encode_str('MQTT') + bytes([4, 0x02]) + struct.pack('!H', keepalive) + encode_str(self._client_id)
+        writer.write(encode_packet(CONNECT, 0, body))
+        ptype, _, body = await asyncio.wait_for(read_packet(reader), timeout=10)
+        if ptype != CONNACK or body[1] != 0:
+            raise ConnectionError(f'CONNACK refused ({body[1] if len(body) > 1 else "?"})')
+        self._connected = True
+        if self._subs:
+            self._send_subscribe(self._next_mid(), list(self._subs.items()))
+        if self.retry_interval is None:
+            # clean session: the broker forgot these; whoever published them redelivers
+            self._inflight.clear()
+        else:
+            self._resend(0)
+        self._run_callback(self.on_connect, self, self._userdata, {'session present': 0}, 0)
+        ping = asyncio.create_task(self._keepalive(writer, keepalive))
+        try:
+            while True:
+                ptype, flags, body = await read_packet(reader)
+                self._on_packet(ptype, flags, body)
+        finally:
+            ping.cancel()
+
+    async def _keepalive(self, writer, keepalive):
+        period = max(1.0, keepalive / 2.0)
+        while True:
+            await asyncio.sleep(period if self.retry_interval is None else min(period, self.retry_interval))
+            writer.write(encode_packet(PINGREQ))
+            if self.retry_interval is not None:
+                self._resend(self.retry_interval)
+
+    def _resend(self, older_than):
+        now = self._loop.time()
+        for topic, payload, retain, info, sent_at in list(self._inflight.values()):
+            if now - sent_at >= older_than:
+                self._send_publish(topic, payload, 1, retain, info, dup=True)
+
+    def _on_packet(self, ptype, flags, body):
+        if ptype == PUBLISH:
+            qos = (flags >> 1) & 0x03
+            topic, i = decode_str(body, 0)
+            mid = None
+            if qos:
+                mid = struct.unpack_from('!H', body, i)[0]
+                i += 2
+            msg = MQTTMessage(topic.decode('utf-8'), body[i:], qos, bool(flags & 0x01), mid or 0, bool(flags & 0x08))
+            fut = self._run_callback(self.on_message, self, self._userdata, msg)
+            if qos == 1:
+                # ack once the handler is done so a crash mid-handling gets the message redelivered
+                fut.add_done_callback(lambda _f, m=mid: self._call(self._write, encode_packet(PUBACK, 0, struct.pack('!H', m))))
+            elif qos == 2:
+                self._write(encode_packet(PUBREC, 0, struct.pack('!H', mid)))
+        elif ptype == PUBACK:
+            mid = struct.unpack_from('!H', body, 0)[0]
+            entry = self._inflight.pop(mid, None)
+            if entry:
+                entry[3]._done.set()
+                self._run_callback(self.on_publish, self, self._userdata, mid)
+        elif ptype == PUBREL:
+            self._write(encode_packet(PUBCOMP, 0, body[:2]))
+        elif ptype in (SUBACK, PINGRESP):
+            pass
+
+    def _run_callback(self, fn, *args):
+        def call():
+            if fn is None:
+                return
+            try:
+                fn(*args)
+            except Exception as e:
+                _logger.exception('MQTT callback failed: %s', e)
+        return self._loop.run_in_executor(self._executor, call)
@@ -3,16 +3,32 @@ import logging
 import paho.mqtt.client as mqtt
 import time
 from datetime import datetime, timedelta
-from .config import MQTT_BROKER, MQTT_PORT, MQTT_CLIENT_ID, MQTT_TOPIC_ACK, MQTT_TOPIC_CMD, MQTT_TOPIC_EVT, MQTT_TOPIC_STATE
+from .config import (MQTT_BROKER, MQTT_PORT, MQTT_CLIENT_ID, MQTT_TOPIC_ACK, MQTT_TOPIC_CMD, MQTT_TOPIC_EVT,
+                     MQTT_TOPIC_STATE, MQTT_MODE, MQTT_EMBEDDED_LISTEN, MQTT_RECONNECT_MIN, MQTT_RECONNECT_MAX,
+                     VISION_TIMEOUT_SEC)
 from .db import execute, query, get_conn
+from . import active
+from . import completion
+from . import intake
+from . import lines
+from . import outbox
+from . import tracing
+from . import reports
+from .metrics import (COMPLETION_SECONDS, DISPATCH_SECONDS, DISPATCH_TOTAL, MQTT_MESSAGES,
+                      MQTT_SECONDS, QUEUE_STAGE_SECONDS, startup_phase)
 
 _logger = logging.getLogger(__name__)
+_hb_logger = logging.getLogger(__name__ + '.heartbeat')   # rate-limited by logging_setup
 _client = None
 
 # in-memory node readiness (node_id -> bool) - kept for logging only
 _node_ready = {}
 # in-memory node online presence - kept for logging only
 _node_online = {}
+# latest camera health/FPS snapshot per node (from disp/vision/{nodeId})
+_vision_health = {}
+# queue_id -> time.time() when it went in_progress (for the in_progress->done stage metric)
+_dispatched_at = {}
 
 
 def on_connect(client, userdata, flags, rc, properties=None):
@@ -35,14 +51,29 @@ def on_connect(client, userdata, flags, rc, properties=None):
         _logger.info('Successfully subscribed to MQTT topics')
     except Exception as e:
         _logger.exception('subscribe failed: %s', e)
+    if rc != 0:
+        return
+    elapsed = startup_phase('mqtt_connected')
+    if elapsed is not None:
+        _logger.info('MQTT connected %.0f ms after start', elapsed * 1000)
+        client.publish('test/server', 'Server started', qos=1)
+    # (re)connected: send what the outbox holds and fill free lines now,
+    # instead of waiting for the next state message or watchdog pass
+    outbox.kick()
+    initial_dispatch(client)
+
+
+def on_disconnect(client, userdata, rc, properties=None):
+    if rc != 0:
+        _logger.warning('MQTT connection lost (rc=%s), reconnecting with backoff up to %.0fs', rc, MQTT_RECONNECT_MAX)
 
 
 # Removed _publish_next_pending - using centralized _dispatch_next_queue instead
 
 
-def _check_both_nodes_ready():
-    """Check if both nodes are ready for new commands - kept for legacy logging only"""
-    return _node_ready.get(1, False) and _node_ready.get(2, False)
+def _check_both_nodes_ready(line_id=lines.DEFAULT_LINE):
+    """Check if all nodes of a line are ready for new commands - kept for legacy logging only"""
+    return all(_node_ready.get(n, False) for n in lines.get(line_id).nodes)
 
 
 def _upsert_node_state(node_id: int, online: int, ready: int, uptime: int | None):
@@ -71,12 +102,12 @@ def _upsert_node_state(node_id: int, online: int, ready: int, uptime: int | None
         )
 
 
-def _both_nodes_ready_db(max_age_sec=10, debounce_ms=500):
-    """Check if both nodes are ready based on DB state with staleness and debounce checks"""
-    rows = query("""SELECT node_id, online, ready, last_seen, last_ready_change
+def _line_ready_db(line, max_age_sec=10, debounce_ms=500):
+    """Check if every node of a line is ready based on DB state with staleness and debounce checks"""
+    rows = query(f"""SELECT node_id, online, ready, last_seen, last_ready_change
                     FROM node_status
-                    WHERE node_id IN (1,2)""")
-    if len(rows) < 2:
+                    WHERE node_id IN ({','.join('?' * len(line.nodes))})""", line.nodes)
+    if len(rows) < len(line.nodes):
         return False
     now = datetime.utcnow()
     def ok(r):
@@ -91,162 +122,265 @@ def _both_nodes_ready_db(max_age_sec=10, debounce_ms=500):
         if (now - lrc).total_seconds() < (debounce_ms/1000.0):
             return False
         return True
-    return ok(rows[0]) and ok(rows[1])
+    return all(ok(r) for r in rows)
+
+
+def _line_busy(line):
+    return bool(query("SELECT 1 x FROM queues WHERE status='in_progress' AND line_id=? LIMIT 1", (line.id,)))
+
+
+def _free_lines():
+    """Lines with every node ready (DB) and nothing in progress."""
+    return [line for line in lines.all_lines() if _line_ready_db(line) and not _line_busy(line)]
 
 
 def _handle_node_completion_atomic(qid, node_id, status, payload):
-    """Atomically update SQLite DB when a node finishes a queue"""
+    """Atomically record a node's evt for a queue; the queue is decided once its whole line reported"""
+    line = lines.of_node(node_id)
+    if line is None:
+        _logger.warning('evt from node %s which is in no line (DISPENSE_LINES) - ignoring queue %s', node_id, qid)
+        return None
+    # Log completion
+    if status in ('timeout', 'failed'):
+        _logger.warning('Node%s failed/timeout for queue %s: %s', node_id, qid, status)
+    else:
+        _logger.info('Node%s completed processing for queue %s', node_id, qid)
+    state = _record_participant(qid, line, node_id, status == 'success',
+                                event=(f'evt_done_node{node_id}', json.dumps(payload)), stage=f'done_node{node_id}')
+    if state is not None:
+        # After commit: mark in-memory _node_ready[node_id] = True (legacy logging only)
+        _node_ready[node_id] = True
+    return state
+
+
+def _handle_ack_rejected(qid, node_id, payload):
+    """A node refused the command: it will never send its evt, so the queue fails on this report alone"""
+    line = lines.of_node(node_id)
+    if line is None:
+        _logger.warning('ack_rejected from node %s which is in no line (DISPENSE_LINES) - ignoring queue %s', node_id, qid)
+        return None
+    _logger.warning('Node%s rejected queue %s', node_id, qid)
+    return _record_participant(qid, line, node_id, False, event=('ack_rejected', json.dumps(payload)), decide=True)
+
+
+def record_vision(qid, ok, line=None):
+    """Vision result as a completion participant; a no-op unless the queue's line requires vision."""
+    if line is None:
+        aq = active.get(qid)
+        if aq is not None:
+            line = lines.get(aq.line_id)
+        else:
+            row = query("SELECT line_id FROM queues WHERE id=?", (qid,))
+            line = lines.get(row[0]['line_id']) if row else None
+    if line is None or not line.requires(lines.VISION):
+        return None
+    return _record_participant(qid, line, lines.VISION, ok)
+
+
+def expire_vision(now=None):
+    """Fail vision on queues whose nodes all reported but whose camera stayed silent for VISION_TIMEOUT_SEC;
+    returns how many were decided (the camera process died or never saw the tray)."""
+    if VISION_TIMEOUT_SEC <= 0:
+        return 0
+    now = time.time() if now is None else now
+    rows = query("""SELECT c.queue_id, c.line_id, c.done FROM queue_completion c JOIN queues q ON q.id = c.queue_id
+                    WHERE q.status = 'in_progress' AND c.updated_at < ?""", (now - VISION_TIMEOUT_SEC,))
+    expired = 0
+    for r in rows:
+        line = lines.get(r['line_id'])
+        if line is None or not line.requires(lines.VISION):
+            continue
+        done = r['done']
+        if done & line.nodes_mask != line.nodes_mask or done & line.bit(lines.VISION):
+            continue
+        _logger.warning('No vision_complete for queue %s within %.0fs of its nodes finishing - vision failed',
+                        r['queue_id'], VISION_TIMEOUT_SEC)
+        if _record_participant(r['queue_id'], line, lines.VISION, False,
+                               event=('vision_timeout', f'no vision_complete within {VISION_TIMEOUT_SEC:g}s')):
+            expired += 1
+    return expired
+
+
+def _record_participant(qid, line, participant, ok, event=None, stage=None, decide=False):
+    """One participant reported: a single conditional write on queue_completion decides the queue
+    (server/completion.py); when the line is complete the next queue is dispatched to it right away.
+    ``decide`` finishes the queue on this report even if others are still missing (a rejected command)."""
+    t0 = time.perf_counter()
+    node_id = participant if participant != lines.VISION else None
+    spans = []   # latency samples, recorded once the transaction commits
     conn = get_conn()
     try:
         # Use transaction to ensure atomicity
         conn.execute("BEGIN IMMEDIATE")  # Lock database immediately
-        
-        # Insert event row "evt_done_node{node_id}" with payload JSON
-        event_name = f'evt_done_node{node_id}'
-        
-        # Check if this node already completed this queue (prevent duplicates)
-        existing = conn.execute("SELECT 1 FROM events WHERE queue_id=? AND event=?", (qid, event_name)).fetchone()
-        if existing:
-            _logger.warning('Node%s already completed queue %s, ignoring duplicate', node_id, qid)
+        state = completion.record(conn, qid, line, participant, ok)
+        if state is None:
+            if not completion.on_line(conn, qid, line):
+                _logger.warning('%s is not on the line of queue %s (line %s), dropping its report',
+                                completion.label(participant), qid, line.id)
+            else:
+                _logger.warning('%s already reported for queue %s, ignoring duplicate', completion.label(participant), qid)
             conn.rollback()
-            return
-        
-        # Record this node's completion event
-        conn.execute("INSERT INTO events(queue_id, event, message) VALUES(?,?,?)", 
-                    (qid, event_name, json.dumps(payload)))
-        
-        # Log completion
-        if status in ('timeout', 'failed'):
-            _logger.warning('Node%s failed/timeout for queue %s: %s', node_id, qid, status)
-        else:
-            _logger.info('Node%s completed processing for queue %s', node_id, qid)
-        
-        # Check if both node1 and node2 have done this queue (within this transaction)
-        node1_done = conn.execute("SELECT 1 FROM events WHERE queue_id=? AND event='evt_done_node1'", (qid,)).fetchone()
-        node2_done = conn.execute("SELECT 1 FROM events WHERE queue_id=? AND event='evt_done_node2'", (qid,)).fetchone()
-        
-        if node1_done and node2_done:
-            # Both nodes completed - get their statuses
-            node1_result = conn.execute("SELECT message FROM events WHERE queue_id=? AND event='evt_done_node1' ORDER BY id DESC LIMIT 1", (qid,)).fetchone()
-            node2_result = conn.execute("SELECT message FROM events WHERE queue_id=? AND event='evt_done_node2' ORDER BY id DESC LIMIT 1", (qid,)).fetchone()
-            
-            try:
-                n1_msg = json.loads(node1_result[0]) if node1_result else {}
-                n2_msg = json.loads(node2_result[0]) if node2_result else {}
-                n1_st = n1_msg.get('status', 'success').lower()
-                n2_st = n2_msg.get('status', 'success').lower()
-            except Exception as e:
-                _logger.exception('Failed to parse node completion status: %s', e)
-                n1_st = n2_st = 'failed'  # Mark as failed on parse error
-            
-            # If both success: update queues.status='success' + served_at=NOW
-            # If one failed or timeout: update queues.status='failed'
-            if n1_st == 'success' and n2_st == 'success':
-                conn.execute("UPDATE queues SET status=?, served_at=CURRENT_TIMESTAMP WHERE id=?", ('success', qid))
-                _logger.info('Queue %s completed successfully by both nodes', qid)
+            return None
+        if event:
+            conn.execute("INSERT INTO events(queue_id, event, message) VALUES(?,?,?)", (qid,) + event)
+        if stage:
+            spans.append(tracing.mark(qid, stage, node_id, conn=conn))
+
+        decided = state.complete or decide
+        if decided:
+            # All participants reported: success only if none of them failed
+            # (a queue already finished, e.g. rejected by a node, is not touched or counted again)
+            final_status = 'success' if state.complete and state.success else 'failed'
+            if final_status == 'success':
+                cur = conn.execute("UPDATE queues SET status=?, served_at=CURRENT_TIMESTAMP WHERE id=? "
+                                   "AND status NOT IN ('success','failed')", ('success', qid))
+                _logger.info('Queue %s completed successfully by line %s', qid, line.id)
             else:
                 # Failed case: timeout, failed, or mixed results
-                failure_reason = f"node1:{n1_st}, node2:{n2_st}"
+                failure_reason = completion.reason(line, state)
                 _logger.warning('Queue %s FAILED - changing status to failed. Reason: %s', qid, failure_reason)
-                conn.execute("UPDATE queues SET status=? WHERE id=?", ('failed', qid))
+                cur = conn.execute("UPDATE queues SET status=? WHERE id=? AND status NOT IN ('success','failed')",
+                                   ('failed', qid))
                 conn.execute("INSERT INTO events(queue_id, event, message) VALUES(?,?,?)", (qid, 'queue_failed', failure_reason))
-        
+            spans.append(tracing.mark(qid, 'served' if final_status == 'success' else 'failed', conn=conn))
+            if cur.rowcount:
+                reports.record_completion(conn, qid, final_status)
+                intake.record_service(conn, qid)
+
         # Commit transaction
         conn.commit()
-        
-        # After commit: mark in-memory _node_ready[node_id] = True (legacy logging only)
-        _node_ready[node_id] = True
-        _logger.info('Node%s marked ready after completing queue %s', node_id, qid)
-        
-        # 3. When both nodes send evt_done: trigger next dispatch if both ready per DB
-        if node1_done and node2_done:
-            global _client
-            if _client:
-                _logger.info('Both nodes completed queue %s - checking DB readiness for next dispatch', qid)
-                try:
-                    # Use DB-based check for dispatch decision
-                    if _both_nodes_ready_db():
-                        _logger.info('Both nodes ready (DB) - triggering next dispatch')
-                        _dispatch_next_queue(_client)
-                    else:
-                        _logger.info('Both nodes completed but not ready (DB) - waiting for readiness')
-                except Exception as e:
-                    _logger.exception('Failed to dispatch next queue after completion: %s', e)
-            
+        tracing.record(*spans)
     except Exception as e:
         conn.rollback()
-        _logger.exception('Failed to handle node completion atomically: %s', e)
+        _logger.exception('Failed to handle completion of queue %s atomically: %s', qid, e)
+        return None
     finally:
         conn.close()
+        COMPLETION_SECONDS.observe(time.perf_counter() - t0, str(participant))
+
+    aq = active.get(qid)
+    if aq is not None:
+        aq.done[participant] = 'success' if ok else 'failed'
+    if decided:
+        active.finish(qid)
+        started = _dispatched_at.pop(qid, None)
+        if started is not None:
+            QUEUE_STAGE_SECONDS.observe(time.time() - started, f'in_progress_to_{final_status}')
+        # same step: hand the line its next queue (still gated on the line's DB readiness)
+        if _client:
+            try:
+                _dispatch_next_queue(_client, [line])
+            except Exception as e:
+                _logger.exception('Failed to dispatch next queue after completion: %s', e)
+    return state
+
+
+def _dispatch_next_queue(client, candidates=None):
+    """Dispatcher for MQTT-based queue system: strict FIFO, at most one in_progress queue per line"""
+    t0 = time.perf_counter()
+    dispatched = 0
+    # fill every free line (or just ``candidates``), oldest pending queue first
+    for line in candidates or lines.all_lines():
+        if _try_dispatch_next_queue(client, line):
+            dispatched += 1
+    result = 'dispatched' if dispatched else 'skipped'
+    DISPATCH_SECONDS.observe(time.perf_counter() - t0, result)
+    DISPATCH_TOTAL.inc(result)
+    return dispatched
 
 
-def _dispatch_next_queue(client):
-    """Dispatcher for MQTT-based queue system with strict FIFO and single in_progress rule"""
+def _try_dispatch_next_queue(client, line):
     try:
-        _logger.info('_dispatch_next_queue called - scanning DB directly')
+        _logger.debug('_dispatch_next_queue called for line %s - scanning DB directly', line.id)
         
         # Always scan the queues table directly (not just memory flags)
-        # Rule: at most 1 queue can be in_progress at a time
-        # Priority order is strict FIFO (lowest queue.id first)
+        # Rule: at most 1 queue can be in_progress per line at a time
+        # Priority order is strict FIFO (lowest queue.id first) across lines
         
-        # 1. If there is any queue with status='in_progress':
-        in_progress_queues = query("SELECT id, patient_id, target_room FROM queues WHERE status='in_progress' ORDER BY id ASC")
+        # 1. If this line has a queue with status='in_progress':
+        in_progress_queues = query("SELECT id, patient_id, target_room FROM queues WHERE status='in_progress' AND line_id=? ORDER BY id ASC",
+                                   (line.id,))
         
         if in_progress_queues:
             # -> select the lowest-id in_progress queue
-            # -> monitor it until done (no new dispatch until it finishes)
+            # -> monitor it until done (no new dispatch on this line until it finishes)
             active_queue = in_progress_queues[0]
-            _logger.info('Monitoring in_progress queue %s - no new dispatch until it finishes', active_queue['id'])
+            _logger.debug('Monitoring in_progress queue %s on line %s - no new dispatch until it finishes', active_queue['id'], line.id)
             
             # If there are multiple in_progress (should not happen but handle gracefully)
             if len(in_progress_queues) > 1:
                 extra_ids = [str(q['id']) for q in in_progress_queues[1:]]
-                _logger.warning('Found multiple in_progress queues (should not happen): monitoring %s, extras: %s', 
-                               active_queue['id'], ', '.join(extra_ids))
+                _logger.warning('Found multiple in_progress queues on line %s (should not happen): monitoring %s, extras: %s',
+                               line.id, active_queue['id'], ', '.join(extra_ids))
             
             return False  # No new dispatch while monitoring
         
-        # 2. If there are no in_progress queues:
+        # 2. If the line has no in_progress queue:
         # -> select the lowest-id pending queue (status='pending')
-        pending_queues = query("SELECT id, patient_id, target_room FROM queues WHERE status='pending' ORDER BY id ASC LIMIT 1")
+        pending_queues = query("""
+            SELECT q.id, q.queue_number, q.patient_id, p.name AS patient_name, q.target_room, q.note, q.created_at
+            FROM queues q LEFT JOIN patients p ON p.id=q.patient_id
+            WHERE q.status='pending' ORDER BY q.id ASC LIMIT 1""")
         
         if not pending_queues:
-            _logger.info('No pending queues to dispatch')
+            _logger.debug('No pending queues to dispatch')
             return False
         
-        # Check if both nodes are ready before attempting dispatch (DB-based)
-        if not _both_nodes_ready_db():
-            _logger.warning('Dispatch BLOCKED - Nodes not both ready (DB) - checking node_status table')
-            # Log current DB state for debugging
-            db_status = query("SELECT node_id, online, ready, last_seen FROM node_status WHERE node_id IN (1,2)")
-            for status in db_status:
-                _logger.info('Node %s DB state: online=%s ready=%s last_seen=%s', 
-                           status['node_id'], status['online'], status['ready'], status['last_seen'])
+        # Check if every node of the line is ready before attempting dispatch (DB-based)
+        if not _line_ready_db(line):
+            _logger.debug('Dispatch to line %s BLOCKED - nodes %s not all ready (DB)', line.id, line.nodes)
             return False
             
         q = pending_queues[0]
         items = query("SELECT pill_id,quantity FROM queue_items WHERE queue_id=?", (q['id'],))
+
+        # commands for the line:
+        # - disp/cmd/{items node} (with full items)
+        # - disp/cmd/{other nodes} (with trigger only)
+        payload1 = {
+            'queue_id': q['id'],
+            'patient_id': q['patient_id'], 
+            'target_room': q['target_room'],
+            'items': [{'pill_id': it['pill_id'], 'quantity': it['quantity']} for it in items]
+        }
+        payload2 = {
+            'queue_id': q['id'],
+            'patient_id': q['patient_id'],
+            'target_room': q['target_room']
+        }
         
-        # -> atomically UPDATE that queue to 'in_progress'
+        # -> atomically UPDATE that queue to 'in_progress' on this line
         conn = get_conn()
         try:
             # Handle transactions with BEGIN IMMEDIATE to prevent race
             conn.execute("BEGIN IMMEDIATE")
             
-            # Atomic check: ensure no other in_progress exists and this queue is still pending
+            # Atomic check: ensure the line has no other in_progress and this queue is still pending
             cur = conn.execute("""
-                UPDATE queues SET status='in_progress' 
+                UPDATE queues SET status='in_progress', line_id=?
                 WHERE id=? AND status='pending' 
-                AND NOT EXISTS (SELECT 1 FROM queues WHERE status='in_progress')
-            """, (q['id'],))
+                AND NOT EXISTS (SELECT 1 FROM queues WHERE status='in_progress' AND line_id=?)
+            """, (line.id, q['id'], line.id))
             
             if not cur.rowcount or cur.rowcount == 0:
-                _logger.warning('Failed to atomically reserve queue %s (already taken or another queue became in_progress)', q['id'])
+                _logger.warning('Failed to atomically reserve queue %s for line %s (already taken or the line became busy)', q['id'], line.id)
                 conn.rollback()
                 return False
                 
+            completion.open_queue(conn, q['id'], line)
+            # the commands commit with the reservation; the outbox thread publishes them
+            for n in line.nodes:
+                outbox.enqueue(conn, q['id'], n, f'disp/cmd/{n}', payload1 if n == line.items_node else payload2)
+            span = tracing.mark(q['id'], 'reserved', conn=conn)
             conn.commit()
-            _logger.info('Successfully reserved queue %s for dispatch (FIFO strict)', q['id'])
+            tracing.record(span)
+            outbox.kick()
+            active.start(q, line.id, items)
+            _logger.info('Successfully reserved queue %s for line %s (FIFO strict)', q['id'], line.id)
+            _dispatched_at[q['id']] = time.time()
+            if q.get('created_at'):
+                waited = (datetime.utcnow() - datetime.fromisoformat(q['created_at'])).total_seconds()
+                QUEUE_STAGE_SECONDS.observe(max(0.0, waited), 'pending_to_in_progress')
             
         except Exception as e:
             conn.rollback()
@@ -255,30 +389,11 @@ def _dispatch_next_queue(client):
         finally:
             conn.close()
             
-        # -> publish MQTT messages:
-        # - disp/cmd/1 (with full items)
-        # - disp/cmd/2 (with trigger only)
-        payload1 = {
-            'queue_id': q['id'],
-            'patient_id': q['patient_id'], 
-            'target_room': q['target_room'],
-            'items': [{'pill_id': it['pill_id'], 'quantity': it['quantity']} for it in items]
-        }
-        payload2 = {
-            'queue_id': q['id'],
-            'patient_id': q['patient_id'],
-            'target_room': q['target_room']
-        }
-        
-        # Publish to both nodes simultaneously 
-        client.publish('disp/cmd/1', json.dumps(payload1), qos=1, retain=False)
-        client.publish('disp/cmd/2', json.dumps(payload2), qos=1, retain=False)
-        
-        # -> mark _node_ready[1] = False, _node_ready[2] = False
-        _node_ready[1] = False
-        _node_ready[2] = False
+        for n in line.nodes:
+            # -> mark _node_ready[n] = False
+            _node_ready[n] = False
         
-        _logger.info('Successfully dispatched queue %s to both nodes (FIFO: lowest id first)', q['id'])
+        _logger.info('Successfully dispatched queue %s to line %s nodes %s (FIFO: lowest id first)', q['id'], line.id, line.nodes)
         return True
         
     except Exception as e:
@@ -289,19 +404,36 @@ def _dispatch_next_queue(client):
 # centralized _dispatch_next_queue
 
 
+# metric labels come from topics anyone on the broker can publish: only known values get their own series
+_MESSAGE_KINDS = frozenset(('cmd', 'ack', 'evt', 'state', 'vision'))
+
+
+def _node_label(suffix):
+    try:
+        return suffix if lines.of_node(int(suffix)) is not None else 'other'
+    except ValueError:
+        return 'other'
+
+
 def on_message(client, userdata, msg):
+    parts = msg.topic.split('/')
+    kind = parts[1] if len(parts) > 1 and parts[1] in _MESSAGE_KINDS else 'other'
+    MQTT_MESSAGES.inc(kind, _node_label(parts[-1]) if len(parts) >= 3 else '-')
+    with MQTT_SECONDS.time(kind):
+        _handle_message(client, userdata, msg)
+
+
+def _handle_message(client, userdata, msg):
     try:
-        _logger.info('MQTT message received - Topic: %s, Payload: %s', msg.topic, msg.payload.decode())
+        _logger.debug('MQTT message received - Topic: %s, Payload: %s', msg.topic, msg.payload)
         payload = json.loads(msg.payload.decode())
         topic = msg.topic
         # try to extract node id from topic suffix (disp/ack/{nodeId}, disp/evt/{nodeId}, disp/state/{nodeId})
         parts = topic.split('/')
         node_id = None
-        _logger.info('Topic parts: %s', parts)
         if len(parts) >= 3:
             try:
                 node_id = int(parts[-1])
-                _logger.info('Extracted node_id: %s', node_id)
             except Exception as e:
                 _logger.warning('Failed to parse node_id from topic %s: %s', topic, e)
                 node_id = None
@@ -316,11 +448,14 @@ def on_message(client, userdata, msg):
             else:
                 accepted = int(payload.get('accepted', 0))
                 if accepted:
-                    execute("UPDATE queues SET status=? WHERE id=?", ('in_progress', qid))
+                    # never revive a queue the other node already rejected (it would stay in_progress forever)
+                    execute("UPDATE queues SET status=? WHERE id=? AND status NOT IN ('success','failed')", ('in_progress', qid))
                     execute("INSERT INTO events(queue_id, event, message) VALUES(?,?,?)", (qid, 'ack_accepted', json.dumps(payload)))
+                    tracing.mark(qid, f'acked_node{node_id}', node_id)
+                    active.mark_acked(qid, node_id)
+                    outbox.node_acked(qid, node_id)
                 else:
-                    execute("UPDATE queues SET status=? WHERE id=?", ('failed', qid))
-                    execute("INSERT INTO events(queue_id, event, message) VALUES(?,?,?)", (qid, 'ack_rejected', json.dumps(payload)))
+                    _handle_ack_rejected(qid, node_id, payload)
             return
 
         # EVT: {"queue_id":..., "done":1, "status":"success", "room":<id>}
@@ -340,10 +475,16 @@ def on_message(client, userdata, msg):
                             note = f"ตรวจนับถูกต้อง {detected}/{expected}"
                         else:
                             note = f"จำนวนไม่ตรง {detected}/{expected}"
-                        # write note to queues and insert event
+                        # write note to queues and insert event (with evidence snapshot path if the camera sent one)
+                        message = note
+                        if payload.get('snapshot'):
+                            message = f"{note} snapshot={payload['snapshot']}"
                         execute("UPDATE queues SET note=? WHERE id=?", (note, qid))
-                        execute("INSERT INTO events(queue_id,event,message) VALUES(?,?,?)", (qid, 'vision_check', note))
-                        _logger.info('Processed vision completion for queue %s: %s', qid, note)
+                        execute("INSERT INTO events(queue_id,event,message) VALUES(?,?,?)", (qid, 'vision_check', message))
+                        active.set_note(qid, note)
+                        tracing.mark(qid, 'vision_finalized', node_id)
+                        _logger.info('Processed vision completion for queue %s: %s', qid, message)
+                        record_vision(qid, detected == expected, lines.of_node(node_id))
                     except Exception as e:
                         _logger.exception('Failed to process vision completion: %s', e)
                 else:
@@ -351,21 +492,41 @@ def on_message(client, userdata, msg):
                     _handle_node_completion_atomic(qid, node_id, st, payload)
             return
 
+        # VISION HEALTH: camera service heartbeat {"camera":..,"healthy":..,"fps":..} on disp/vision/{nodeId}
+        if len(parts) >= 3 and parts[1] == 'vision' and 'fps' in payload and 'count_detected' not in payload:
+            _vision_health[node_id] = dict(payload, received_at=time.time())
+            if not payload.get('healthy', True):
+                _logger.warning('Vision camera for node %s unhealthy: %s', node_id, payload.get('error'))
+            return
+
         # VISION: camera reports detection count
         # Payload expected: {"count_detected": <int>, "queue_id": <int> (optional)}
         if 'count_detected' in payload:
             try:
                 qid = payload.get('queue_id')
                 detected = int(payload.get('count_detected'))
-                # If queue id not supplied, find the current in_progress queue
+                # If queue id not supplied, find the current in_progress queue (of the camera's line)
+                line = lines.of_node(node_id)
                 if qid is None:
-                    cur = query("SELECT id FROM queues WHERE status='in_progress' ORDER BY id ASC LIMIT 1")
-                    if not cur:
+                    aq = active.for_line(line.id) if line else active.current()
+                    if aq is None and not active.is_owner():
+                        if line:
+                            cur = query("SELECT id FROM queues WHERE status='in_progress' AND line_id=? ORDER BY id ASC LIMIT 1", (line.id,))
+                        else:
+                            cur = query("SELECT id FROM queues WHERE status='in_progress' ORDER BY id ASC LIMIT 1")
+                        if cur:
+                            qid = cur[0]['id']
+                    elif aq is not None:
+                        qid = aq.queue_id
+                    if qid is None:
                         _logger.info('Vision report received but no in_progress queue')
                         return
-                    qid = cur[0]['id']
-                expected_row = query("SELECT COALESCE(SUM(quantity),0) AS total FROM queue_items WHERE queue_id=?", (qid,))
-                expected = expected_row[0]['total'] if expected_row else 0
+                aq = active.get(qid)
+                if aq is not None:
+                    expected = aq.expected
+                else:
+                    expected_row = query("SELECT COALESCE(SUM(quantity),0) AS total FROM queue_items WHERE queue_id=?", (qid,))
+                    expected = expected_row[0]['total'] if expected_row else 0
                 if detected == expected:
                     note = f"ตรวจนับถูกต้อง {detected}/{expected}"
                 else:
@@ -373,7 +534,10 @@ def on_message(client, userdata, msg):
                 # write note to queues and insert event
                 execute("UPDATE queues SET note=? WHERE id=?", (note, qid))
                 execute("INSERT INTO events(queue_id,event,message) VALUES(?,?,?)", (qid, 'vision_check', note))
+                active.set_note(qid, note)
+                tracing.mark(qid, 'vision_finalized', node_id)
                 _logger.info('Processed vision for queue %s: %s', qid, note)
+                record_vision(qid, detected == expected, line)
             except Exception as e:
                 _logger.exception('Failed to process vision payload: %s', e)
             return
@@ -390,16 +554,16 @@ def on_message(client, userdata, msg):
                 # keep event log
                 execute("INSERT INTO events(queue_id, event, message) VALUES(?,?,?)",
                         (None, 'node_state', json.dumps({'node': node_id, 'online': online, 'ready': ready})))
-                _logger.info('Node %s (DB) online=%s ready=%s', node_id, online, ready)
+                _hb_logger.info('Node %s (DB) online=%s ready=%s', node_id, online, ready)
 
-                # Auto-dispatch when both ready (per DB), no in_progress, and pending exists
+                # Auto-dispatch when the node's line is ready (per DB), has nothing in_progress, and pending exists
                 try:
-                    has_inprog = query("SELECT 1 x FROM queues WHERE status='in_progress' LIMIT 1")
-                    if _both_nodes_ready_db() and not has_inprog:
+                    line = lines.of_node(node_id)
+                    if line and _line_ready_db(line) and not _line_busy(line):
                         has_pending = query("SELECT 1 x FROM queues WHERE status='pending' LIMIT 1")
                         if has_pending:
-                            _logger.info('STATE auto-dispatch: both-ready (DB) & pending exists -> dispatch')
-                            _dispatch_next_queue(client)
+                            _logger.info('STATE auto-dispatch: line %s ready (DB) & pending exists -> dispatch', line.id)
+                            _dispatch_next_queue(client, [line])
                 except Exception as e:
                     _logger.warning('STATE auto-dispatch failed: %s', e)
             return
@@ -424,56 +588,90 @@ class _DummyClient:
         _logger.debug('MQTT subscribe skipped (no broker)')
 
 
+def watchdog_tick(c):
+    """One readiness-watchdog pass: dispatch to every line that is ready, has nothing in progress, while work is pending."""
+    try:
+        active.reconcile()
+        expire_vision()
+        intake.promote_deferred()
+        free = _free_lines()
+        if free:
+            has_pending = query("SELECT 1 x FROM queues WHERE status='pending' LIMIT 1")
+            if has_pending:
+                _logger.info('Watchdog: lines %s ready (DB), pending exists -> dispatch', [l.id for l in free])
+                _dispatch_next_queue(c, free)
+    except Exception as e:
+        _logger.warning('Watchdog error: %s', e)
+
+
+def initial_dispatch(c):
+    try:
+        n = _dispatch_next_queue(c)
+    except Exception as e:
+        _logger.warning('Initial dispatch failed: %s', e)
+        return
+    elapsed = startup_phase('first_dispatch')
+    if elapsed is not None:
+        _logger.info('first dispatch pass %.0f ms after start (%s queue(s) dispatched)', elapsed * 1000, n)
+
+
+def _start_background(c):
+    import threading
+
+    # the first dispatch pass runs from on_connect, as soon as the broker accepts us
+    # Readiness watchdog thread (defensive)
+    def readiness_watchdog():
+        while True:
+            watchdog_tick(c)
+            time.sleep(2)
+
+    threading.Thread(target=readiness_watchdog, daemon=True).start()
+    outbox.start(c)
+    # only the process that dispatches moves old queues to the archive DB
+    from .archive import start_scheduler
+    start_scheduler()
+    from . import backup
+    backup.start_scheduler()
+
+
+def use_client(c):
+    """Install an externally managed client (the asyncio runtime in server/asgi.py)."""
+    global _client
+    _client = c
+    active.rebuild()
+    outbox.start(c)
+    return c
+
+
 def get_client():
     global _client
     if _client:
         return _client
 
     try:
-        c = mqtt.Client(client_id=MQTT_CLIENT_ID, clean_session=True)
+        if MQTT_MODE == 'embedded':
+            from .broker import get_broker
+            c = get_broker().client(MQTT_CLIENT_ID)
+        else:
+            c = mqtt.Client(client_id=MQTT_CLIENT_ID, clean_session=True)
         c.on_connect = on_connect
+        c.on_disconnect = on_disconnect
         c.on_message = on_message
-        # attempt connect
-        c.connect(MQTT_BROKER, MQTT_PORT, keepalive=60)
+        c.reconnect_delay_set(min_delay=MQTT_RECONNECT_MIN, max_delay=MQTT_RECONNECT_MAX)
+        # this process dispatches: load what the lines were doing before a restart (before any message arrives)
+        active.rebuild()
+        # returns at once; paho's network thread connects, and keeps reconnecting with backoff
+        # (on_connect resubscribes every time), so a broker that is down at boot is picked up later
+        c.connect_async(MQTT_BROKER, MQTT_PORT, keepalive=60)
         c.loop_start()
         _client = c
-        _logger.info('Connected to MQTT broker %s:%s', MQTT_BROKER, MQTT_PORT)
-        
-        # Test publish to see if MQTT is working
-        import time
-        time.sleep(1)  # Wait for connection to stabilize
-        c.publish('test/server', 'Server started', qos=1)
-        _logger.info('Sent test message to test/server')
-        
-        # Initial dispatch attempt after server starts (if nodes become ready)
-        def delayed_initial_dispatch():
-            time.sleep(3)  # Wait for nodes to connect and report ready
-            try:
-                _dispatch_next_queue(c)
-            except Exception as e:
-                _logger.warning('Initial dispatch failed: %s', e)
-        
-        # Readiness watchdog thread (defensive)
-        def readiness_watchdog():
-            import time
-            while True:
-                try:
-                    has_inprog = query("SELECT 1 x FROM queues WHERE status='in_progress' LIMIT 1")
-                    if _both_nodes_ready_db() and not has_inprog:
-                        has_pending = query("SELECT 1 x FROM queues WHERE status='pending' LIMIT 1")
-                        if has_pending:
-                            _logger.info('Watchdog: both-ready (DB), pending exists -> dispatch')
-                            _dispatch_next_queue(c)
-                except Exception as e:
-                    _logger.warning('Watchdog error: %s', e)
-                time.sleep(2)
-        
-        import threading
-        threading.Thread(target=delayed_initial_dispatch, daemon=True).start()
-        threading.Thread(target=readiness_watchdog, daemon=True).start()
-        
+        if MQTT_MODE == 'embedded':
+            _logger.info('Using embedded MQTT broker (listen=%s)', MQTT_EMBEDDED_LISTEN or 'in-process only')
+        else:
+            _logger.info('Connecting to MQTT broker %s:%s in the background', MQTT_BROKER, MQTT_PORT)
+        _start_background(c)
         return _client
     except Exception as e:
-        _logger.warning('Could not connect to MQTT broker %s:%s — proceeding without MQTT (%s)', MQTT_BROKER, MQTT_PORT, e)
+        _logger.warning('Could not set up MQTT client for %s:%s — proceeding without MQTT (%s)', MQTT_BROKER, MQTT_PORT, e)
         _client = _DummyClient()
         return _client
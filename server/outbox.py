@@ -0,0 +1,203 @@
+"""Transactional outbox for dispatch commands.
+
+The dispatcher used to commit a queue as in_progress and then call
+``client.publish()``: with the broker down (or the dummy client) the
+commands were gone and the line stalled. Now every ``disp/cmd/{node}`` is an
+``outbox`` row written by ``enqueue()`` inside the transaction that reserves
+the queue, and one publisher thread does the network part:
+
+    pending --publish--> sent --PUBACK or node ack--> delivered
+                          '-- not confirmed after the backoff --> published again
+    queue no longer in_progress before delivery --> dropped
+
+Each pass publishes up to OUTBOX_BATCH due rows and writes their state back
+in one transaction. PUBACKs (``on_publish``) and node acks are collected in
+memory and marked in the next pass. Nothing is published while the client is
+disconnected and the rows survive a restart, so a command is delivered or
+dropped because its queue ended, never lost.
+
+A resend is a new PUBLISH and the node firmware does not de-duplicate by
+queue_id, so a row is only resent while its queue is in progress and that
+node has not acked it yet. The outbox is the only retry schedule: the asyncio
+client runs with ``retry_interval=None`` (no retransmission of its own), and
+paho only repeats an unacked PUBLISH once, on reconnect.
+
+Environment:
+    OUTBOX_BATCH=50         rows per publish pass
+    OUTBOX_RETRY_MIN=5      seconds before the first resend, doubling...
+    OUTBOX_RETRY_MAX=60     ...up to this
+    OUTBOX_KEEP_HOURS=24    delivered/dropped rows are pruned after this
+"""
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import closing
+
+from . import tracing
+from .db import get_conn, query
+
+_logger = logging.getLogger(__name__)
+
+OUTBOX_BATCH = int(os.getenv("OUTBOX_BATCH", "50"))
+OUTBOX_RETRY_MIN = float(os.getenv("OUTBOX_RETRY_MIN", "5"))
+OUTBOX_RETRY_MAX = float(os.getenv("OUTBOX_RETRY_MAX", "60"))
+OUTBOX_KEEP_HOURS = float(os.getenv("OUTBOX_KEEP_HOURS", "24"))
+
+_POLL_SEC = 1.0        # a pass runs at least this often (resends, reconnects)
+_PRUNE_SEC = 600.0
+
+_lock = threading.Lock()
+_wake = threading.Event()
+_inflight = {}     # mid -> outbox id, published and waiting for PUBACK
+_early = set()     # mids PUBACKed before publish() returned to us
+_acked = []        # outbox ids confirmed by PUBACK
+_node_acks = []    # (queue_id, node_id) acks received from nodes
+_thread = None
+_client = None
+
+
+def enqueue(conn, queue_id, node_id, topic, payload, qos=1):
+    """Add a command inside the caller's transaction; call ``kick()`` after the commit."""
+    if not isinstance(payload, str):
+        payload = json.dumps(payload)
+    conn.execute("""INSERT INTO outbox(queue_id, node_id, topic, payload, qos, created_at)
+                    VALUES (?,?,?,?,?,?)""", (queue_id, node_id, topic, payload, qos, time.time()))
+
+
+def kick():
+    """Wake the publisher now instead of at its next poll."""
+    _wake.set()
+
+
+def on_publish(client, userdata, mid):
+    with _lock:
+        oid = _inflight.pop(mid, None)
+        if oid is None:
+            _early.add(mid)
+        else:
+            _acked.append(oid)
+    _wake.set()
+
+
+def node_acked(queue_id, node_id):
+    """A node acked ``queue_id``: it has the command even if the PUBACK got lost."""
+    if queue_id is None or node_id is None:
+        return
+    with _lock:
+        _node_acks.append((queue_id, node_id))
+    _wake.set()
+
+
+def _connected(client):
+    is_connected = getattr(client, 'is_connected', None)
+    return bool(is_connected and is_connected())
+
+
+def _backoff(attempts):
+    return min(OUTBOX_RETRY_MAX, OUTBOX_RETRY_MIN * (2 ** attempts))
+
+
+def _mark_confirmed(conn, now):
+    with _lock:
+        acked, node_acks = list(_acked), list(_node_acks)
+        del _acked[:], _node_acks[:]
+    if acked:
+        conn.executemany("UPDATE outbox SET status='delivered', delivered_at=? WHERE id=? AND status IN ('pending','sent')",
+                         [(now, oid) for oid in acked])
+    if node_acks:
+        conn.executemany("""UPDATE outbox SET status='delivered', delivered_at=?
+                            WHERE queue_id=? AND node_id=? AND status IN ('pending','sent')""",
+                         [(now, qid, node) for qid, node in node_acks])
+    return len(acked) + len(node_acks)
+
+
+def publish_pass(client):
+    """Mark confirmations, then publish the rows that are due; returns how many were published."""
+    now = time.time()
+    published = 0
+    with closing(get_conn()) as conn:
+        if _mark_confirmed(conn, now):
+            conn.commit()
+        if not _connected(client):
+            return 0
+        rows = conn.execute("""
+            SELECT o.id, o.queue_id, o.node_id, o.topic, o.payload, o.qos, o.attempts, q.status AS queue_status
+            FROM outbox o LEFT JOIN queues q ON q.id = o.queue_id
+            WHERE o.status IN ('pending','sent') AND o.next_attempt <= ?
+            ORDER BY o.id LIMIT ?""", (now, OUTBOX_BATCH)).fetchall()
+        if not rows:
+            return 0
+        sent, dropped = [], []
+        for r in rows:
+            if r['queue_id'] is not None and r['queue_status'] != 'in_progress':
+                dropped.append((now, r['id']))
+                continue
+            if r['attempts']:
+                _logger.warning('outbox: resending %s for queue %s (attempt %s)', r['topic'], r['queue_id'], r['attempts'] + 1)
+            info = client.publish(r['topic'], r['payload'], qos=r['qos'], retain=False)
+            mid = getattr(info, 'mid', None)
+            with _lock:
+                if not r['qos']:
+                    _acked.append(r['id'])
+                elif mid in _early:
+                    _early.discard(mid)
+                    _acked.append(r['id'])
+                elif mid is not None:
+                    _inflight[mid] = r['id']
+            sent.append((now, now + _backoff(r['attempts']), r['id']))
+            published += 1
+        conn.executemany("""UPDATE outbox SET status='sent', attempts=attempts+1, sent_at=?, next_attempt=?
+                            WHERE id=? AND status IN ('pending','sent')""", sent)
+        conn.executemany("UPDATE outbox SET status='dropped', delivered_at=? WHERE id=?", dropped)
+        # one span per queue, when its commands first went out
+        spans = [tracing.mark(qid, 'published', ts=now, conn=conn)
+                 for qid in {r['queue_id'] for r in rows if r['attempts'] == 0 and r['queue_status'] == 'in_progress'}]
+        conn.commit()
+        tracing.record(*spans)
+    with _lock:
+        # PUBACKs for our own publishes were matched above; anything left is someone else's
+        _early.clear()
+    if dropped:
+        _logger.info('outbox: dropped %s command(s) whose queue is no longer in progress', len(dropped))
+    return published
+
+
+def prune():
+    cutoff = time.time() - OUTBOX_KEEP_HOURS * 3600
+    with closing(get_conn()) as conn:
+        n = conn.execute("DELETE FROM outbox WHERE status IN ('delivered','dropped') AND created_at < ?", (cutoff,)).rowcount
+        conn.commit()
+    return n
+
+
+def stats():
+    return {r['status']: r['n'] for r in query("SELECT status, COUNT(*) n FROM outbox GROUP BY status")}
+
+
+def _run():
+    next_prune = time.monotonic() + _PRUNE_SEC
+    while True:
+        _wake.wait(_POLL_SEC)
+        _wake.clear()
+        try:
+            # a full batch means more is due: go again without waiting
+            while publish_pass(_client) >= OUTBOX_BATCH:
+                pass
+            if time.monotonic() >= next_prune:
+                next_prune = time.monotonic() + _PRUNE_SEC
+                prune()
+        except Exception as e:
+            _logger.warning('outbox publish pass failed: %s', e)
+
+
+def start(client):
+    """Publish through ``client`` from a daemon thread (once per process; a later call swaps the client)."""
+    global _thread, _client
+    _client = client
+    client.on_publish = on_publish
+    if _thread is None:
+        _thread = threading.Thread(target=_run, name='outbox', daemon=True)
+        _thread.start()
+    kick()
@@ -0,0 +1,187 @@
+"""Daily rollups: per day x room and per day x pill, maintained as queues finish.
+
+``record_completion`` runs inside the transaction that moves a queue to
+success/failed, so the rollups never disagree with ``queues``. Reports and the
+dashboard counters read only these small tables.
+
+Service time is the same one server/intake.py predicts with: from the queue's
+``reserved`` trace span to its final decision, not from ``created_at`` (that
+would include the time it waited in the backlog). Queues without a
+``reserved`` span (from before tracing) count toward success/failed only.
+
+    python -m server.reports backfill   # rebuild from queues/queue_items/events (stop the server first)
+"""
+import argparse
+import logging
+import time
+from contextlib import closing
+
+from .db import get_conn, query
+
+_logger = logging.getLogger(__name__)
+
+BACKFILL_BATCH = 1000
+
+_UPSERT_ROOM = """
+    INSERT INTO rollup_daily_room(day, room_id, success, failed, service_sec_sum, service_n)
+    VALUES (?,?,?,?,?,?)
+    ON CONFLICT(day, room_id) DO UPDATE SET
+      success = success + excluded.success,
+      failed = failed + excluded.failed,
+      service_sec_sum = service_sec_sum + excluded.service_sec_sum,
+      service_n = service_n + excluded.service_n
+"""
+_UPSERT_PILL = """
+    INSERT INTO rollup_daily_pill(day, pill_id, quantity, queues, failed_quantity)
+    VALUES (?,?,?,?,?)
+    ON CONFLICT(day, pill_id) DO UPDATE SET
+      quantity = quantity + excluded.quantity,
+      queues = queues + excluded.queues,
+      failed_quantity = failed_quantity + excluded.failed_quantity
+"""
+
+
+def record_completion(conn, qid, status):
+    """Add one finished queue to today's rollups (call inside the status-change transaction)."""
+    row = conn.execute("""
+        SELECT q.target_room, date('now') AS day,
+               (SELECT MAX(ts) FROM queue_trace WHERE queue_id = q.id AND stage = 'reserved') AS reserved
+        FROM queues q WHERE q.id=?""", (qid,)).fetchone()
+    if row is None:
+        return
+    room, day, reserved = row[0], row[1], row[2]
+    ok = status == 'success'
+    timed = ok and reserved is not None
+    conn.execute(_UPSERT_ROOM, (day, room, int(ok), int(not ok),
+                                max(0.0, time.time() - reserved) if timed else 0.0, int(timed)))
+    for pill_id, qty in conn.execute("SELECT pill_id, SUM(quantity) FROM queue_items WHERE queue_id=? GROUP BY pill_id", (qid,)):
+        conn.execute(_UPSERT_PILL, (day, pill_id, qty if ok else 0, int(ok), 0 if ok else qty))
+
+
+def totals():
+    """(success, failed) over all time, from the rollups."""
+    r = query("SELECT COALESCE(SUM(success),0) AS s, COALESCE(SUM(failed),0) AS f FROM rollup_daily_room")[0]
+    return r['s'], r['f']
+
+
+def _avg(total, n):
+    return round(total / n, 1) if n else None
+
+
+def report(day_from, day_to):
+    """Per-day, per-room and per-pill figures for [day_from, day_to] (YYYY-MM-DD, inclusive)."""
+    rng = (day_from, day_to)
+    days = query("""
+        SELECT day, SUM(success) AS success, SUM(failed) AS failed, SUM(service_sec_sum) AS ss, SUM(service_n) AS sn
+        FROM rollup_daily_room WHERE day BETWEEN ? AND ? GROUP BY day ORDER BY day""", rng)
+    rooms = query("""
+        SELECT x.room_id, r.name AS room, SUM(x.success) AS success, SUM(x.failed) AS failed,
+               SUM(x.service_sec_sum) AS ss, SUM(x.service_n) AS sn
+        FROM rollup_daily_room x LEFT JOIN rooms r ON r.id=x.room_id
+        WHERE x.day BETWEEN ? AND ? GROUP BY x.room_id ORDER BY x.room_id""", rng)
+    pills = query("""
+        SELECT x.pill_id, p.name, p.type, SUM(x.quantity) AS quantity, SUM(x.queues) AS queues,
+               SUM(x.failed_quantity) AS failed_quantity
+        FROM rollup_daily_pill x LEFT JOIN pills p ON p.id=x.pill_id
+        WHERE x.day BETWEEN ? AND ? GROUP BY x.pill_id ORDER BY quantity DESC""", rng)
+    for r in days + rooms:
+        r['avg_service_sec'] = _avg(r.pop('ss') or 0.0, r.pop('sn') or 0)
+    success = sum(r['success'] for r in days)
+    failed = sum(r['failed'] for r in days)
+    return {
+        "from": day_from,
+        "to": day_to,
+        "totals": {
+            "success": success,
+            "failed": failed,
+            "success_rate": round(success / (success + failed), 4) if success + failed else None,
+            "quantity": sum(p['quantity'] for p in pills),
+        },
+        "days": days,
+        "rooms": rooms,
+        "pills": pills,
+    }
+
+
+def backfill(batch=BACKFILL_BATCH):
+    """Rebuild both rollup tables from history, BACKFILL_BATCH queues per transaction."""
+    t0 = time.time()
+    done = 0
+    with closing(get_conn(archive=True)) as conn:
+        conn.execute("DELETE FROM rollup_daily_room")
+        conn.execute("DELETE FROM rollup_daily_pill")
+        conn.commit()
+        for db in ('main', 'archive'):   # archived queues (server/archive.py) count too
+            done += _backfill_schema(conn, db, batch)
+    _logger.info('rollup backfill: %s queues in %.1fs', done, time.time() - t0)
+    return done
+
+
+def _backfill_schema(conn, db, batch):
+    last, done = 0, 0
+    while True:
+        rows = conn.execute(f"""
+            SELECT q.id, q.status, q.target_room, q.created_at, q.served_at,
+                   (julianday(q.served_at) - 2440587.5) * 86400.0
+                   - (SELECT MAX(t.ts) FROM {db}.queue_trace t WHERE t.queue_id = q.id AND t.stage = 'reserved') AS service_sec
+            FROM {db}.queues q WHERE q.id > ? AND q.status IN ('success','failed') ORDER BY q.id LIMIT ?""",
+                            (last, batch)).fetchall()
+        if not rows:
+            break
+        ids = [r['id'] for r in rows]
+        marks = ','.join('?' * len(ids))
+        failed_at = dict(conn.execute(
+            f"SELECT queue_id, MAX(ts) FROM {db}.events WHERE event IN ('queue_failed','ack_rejected') "
+            f"AND queue_id IN ({marks}) GROUP BY queue_id", ids).fetchall())
+        items = {}
+        for qid, pill_id, qty in conn.execute(
+                f"SELECT queue_id, pill_id, SUM(quantity) FROM {db}.queue_items WHERE queue_id IN ({marks}) "
+                f"GROUP BY queue_id, pill_id", ids):
+            items.setdefault(qid, []).append((pill_id, qty))
+
+        room_acc, pill_acc = {}, {}
+        for r in rows:
+            ok = r['status'] == 'success'
+            day = ((r['served_at'] if ok else failed_at.get(r['id'])) or r['created_at'] or '')[:10]
+            a = room_acc.setdefault((day, r['target_room']), [0, 0, 0.0, 0])
+            a[0 if ok else 1] += 1
+            if ok and r['service_sec'] is not None:
+                a[2] += max(0.0, r['service_sec'])
+                a[3] += 1
+            for pill_id, qty in items.get(r['id'], ()):
+                p = pill_acc.setdefault((day, pill_id), [0, 0, 0])
+                if ok:
+                    p[0] += qty
+                    p[1] += 1
+                else:
+                    p[2] += qty
+        conn.executemany(_UPSERT_ROOM, [k + tuple(v) for k, v in room_acc.items()])
+        conn.executemany(_UPSERT_PILL, [k + tuple(v) for k, v in pill_acc.items()])
+        conn.commit()
+        last = ids[-1]
+        done += len(rows)
+    return done
+
+
+def backfill_if_empty():
+    """First start after upgrading: build the rollups once so counters don't drop to zero."""
+    if query("SELECT 1 x FROM rollup_daily_room LIMIT 1"):
+        return 0
+    if not query("SELECT 1 x FROM queues WHERE status IN ('success','failed') LIMIT 1"):
+        return 0
+    return backfill()
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(prog='python -m server.reports', description='Daily rollup maintenance')
+    sub = ap.add_subparsers(dest='cmd', required=True)
+    b = sub.add_parser('backfill', help='rebuild rollups from queues/queue_items/events')
+    b.add_argument('--batch', type=int, default=BACKFILL_BATCH)
+    args = ap.parse_args(argv)
+    if args.cmd == 'backfill':
+        n = backfill(args.batch)
+        print(f"rebuilt rollups from {n} finished queues")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+"""Per-queue lifecycle tracing.
+
+Every stage a queue passes through is stored as one ``queue_trace`` row with a
+high-resolution ``time.time()`` timestamp:
+
+    created -> reserved -> published -> acked_node{n} -> done_node{n}
+            -> vision_finalized -> served | failed
+
+``/api/queues/<id>/trace`` reads those rows. ``/api/stats/latency`` is answered
+from an in-memory sliding window of "seconds since created" per stage, so the
+aggregate never scans the table.
+"""
+import collections
+import logging
+import os
+import threading
+import time
+
+from .db import execute, query
+
+_logger = logging.getLogger(__name__)
+
+TRACE_WINDOW_SEC = float(os.getenv("TRACE_WINDOW_SEC", "3600"))   # aggregate over the last hour
+TRACE_WINDOW_MAX = int(os.getenv("TRACE_WINDOW_MAX", "2000"))      # samples kept per stage
+_OPEN_MAX = 5000                                                  # created timestamps kept in memory
+
+_lock = threading.Lock()
+_created = collections.OrderedDict()   # queue_id -> created ts
+_samples = {}                          # stage -> deque[(ts, seconds_since_created)]
+
+
+def _created_ts(qid):
+    with _lock:
+        ts = _created.get(qid)
+    if ts is not None:
+        return ts
+    # not in memory (e.g. after a restart): fall back to the stored span once
+    rows = query("SELECT ts FROM queue_trace WHERE queue_id=? AND stage='created' LIMIT 1", (qid,))
+    if not rows:
+        return None
+    ts = rows[0]['ts']
+    _remember(qid, ts)
+    return ts
+
+
+def _remember(qid, ts):
+    with _lock:
+        _created[qid] = ts
+        _created.move_to_end(qid)
+        while len(_created) > _OPEN_MAX:
+            _created.popitem(last=False)
+
+
+def mark(qid, stage, node_id=None, ts=None, conn=None):
+    """Record that queue ``qid`` reached ``stage`` (never raises).
+
+    Pass ``conn`` to write the span inside an open transaction: the in-memory
+    latency sample is then returned instead of recorded, and the caller hands it
+    to ``record()`` after the commit, so a rollback leaves no sample behind.
+    """
+    if qid is None:
+        return None
+    ts = time.time() if ts is None else ts
+    try:
+        sql = "INSERT INTO queue_trace(queue_id, stage, node_id, ts) VALUES(?,?,?,?)"
+        if conn is not None:
+            conn.execute(sql, (qid, stage, node_id, ts))
+            return (qid, stage, ts)
+        execute(sql, (qid, stage, node_id, ts))
+    except Exception as e:
+        _logger.warning('trace mark failed for queue %s stage %s: %s', qid, stage, e)
+        return None
+    record((qid, stage, ts))
+    return None
+
+
+def record(*samples):
+    """Add committed spans (as returned by ``mark(..., conn=...)``; None is ignored) to the latency window."""
+    for sample in samples:
+        if sample is None:
+            continue
+        qid, stage, ts = sample
+        try:
+            if stage == 'created':
+                _remember(qid, ts)
+                continue
+            created = _created_ts(qid)
+            if created is None:
+                continue
+            with _lock:
+                dq = _samples.get(stage)
+                if dq is None:
+                    dq = _samples[stage] = collections.deque(maxlen=TRACE_WINDOW_MAX)
+                dq.append((ts, ts - created))
+                if stage in ('served', 'failed'):
+                    _created.pop(qid, None)
+        except Exception as e:
+            _logger.warning('latency sample failed for queue %s stage %s: %s', qid, stage, e)
+
+
+def trace(qid):
+    """Spans for one queue, ordered by time, with offsets in ms."""
+    rows = query("SELECT stage, node_id, ts FROM queue_trace WHERE queue_id=? ORDER BY ts ASC, id ASC", (qid,))
+    if not rows:   # finished long ago: moved to the archive DB
+        rows = query("SELECT stage, node_id, ts FROM archive.queue_trace WHERE queue_id=? ORDER BY ts ASC, id ASC",
+                     (qid,), archive=True)
+    spans = []
+    start = prev = None
+    for r in rows:
+        ts = r['ts']
+        if start is None:
+            start = prev = ts
+        spans.append({
+            'stage': r['stage'],
+            'node_id': r['node_id'],
+            'ts': ts,
+            'since_created_ms': round((ts - start) * 1000, 1),
+            'since_prev_ms': round((ts - prev) * 1000, 1),
+        })
+        prev = ts
+    return spans
+
+
+def _percentile(sorted_vals, p):
+    if not sorted_vals:
+        return None
+    k = min(len(sorted_vals) - 1, max(0, int(round(p / 100.0 * (len(sorted_vals) - 1)))))
+    return sorted_vals[k]
+
+
+def latency_stats(window_sec=None):
+    """{stage: {count, p50_ms, p95_ms, p99_ms}} measured from 'created', over the sliding window."""
+    window_sec = TRACE_WINDOW_SEC if window_sec is None else window_sec
+    cutoff = time.time() - window_sec
+    with _lock:
+        snap = {stage: [d for (ts, d) in dq if ts >= cutoff] for stage, dq in _samples.items()}
+    out = {}
+    for stage, vals in snap.items():
+        vals.sort()
+        out[stage] = {
+            'count': len(vals),
+            'p50_ms': None if not vals else round(_percentile(vals, 50) * 1000, 1),
+            'p95_ms': None if not vals else round(_percentile(vals, 95) * 1000, 1),
+            'p99_ms': None if not vals else round(_percentile(vals, 99) * 1000, 1),
+        }
+    return out
@@ -0,0 +1,48 @@
+"""Production WSGI entry point (several worker processes).
+
+    gunicorn -c server/gunicorn.conf.py server.wsgi:app
+
+Every worker serves HTTP; exactly one of them is elected to own the MQTT
+client and the dispatcher (see server/dispatcher.py). Other WSGI servers work
+too: the election also runs lazily on a worker's first request.
+
+The schema work (init_db) runs once: gunicorn's master does it before forking
+(``on_starting`` in gunicorn.conf.py) and the workers skip it. Under another
+server each worker takes ``SCHEMA_LOCK`` in turn, so the first one migrates
+and the rest find the schema fingerprint already up to date.
+"""
+import os
+
+from .db import init_db
+from .app import app
+from . import dispatcher
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+SCHEMA_LOCK = os.getenv("SCHEMA_LOCK", os.path.join(os.path.dirname(dispatcher.DISPATCH_LOCK), "schema.lock"))
+SCHEMA_READY_ENV = "DISPENSE_SCHEMA_READY"   # set by the gunicorn master once init_db() ran
+
+
+def init_db_once():
+    if os.environ.get(SCHEMA_READY_ENV) == '1':
+        return
+    if fcntl is None:
+        init_db()
+        return
+    with open(SCHEMA_LOCK, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            init_db()
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+init_db_once()
+
+
+@app.before_request
+def _join_dispatcher_election():
+    dispatcher.ensure_started()
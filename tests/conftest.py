@@ -0,0 +1,36 @@
+import os
+import sys
+import tempfile
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+# server.config reads these at import time: point every test run at a throwaway database
+_TMP = tempfile.mkdtemp(prefix='dispense-tests-')
+os.environ['DB_PATH'] = os.path.join(_TMP, 'app.db')
+os.environ['ARCHIVE_PATH'] = os.path.join(_TMP, 'archive.db')
+os.environ.setdefault('BACKUP_DIR', os.path.join(_TMP, 'backups'))
+os.environ.setdefault('BACKUP_INTERVAL', '0')
+os.environ.setdefault('DISPENSE_LINES', '1:1,2;2:3,4,vision')
+
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'ino', 'cam'))
+
+import pytest  # noqa: E402
+
+
+@pytest.fixture
+def db():
+    """Fresh app.db / archive.db with the full schema."""
+    from server import db as dbmod
+    for path in (os.environ['DB_PATH'], os.environ['ARCHIVE_PATH']):
+        for suffix in ('', '-journal', '-wal', '-shm'):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+    dbmod.init_db()
+    return dbmod
+
+
+def make_queue(conn, status='pending', room=1, patient=1, line=None):
+    cur = conn.execute("INSERT INTO queues(patient_id, target_room, status, line_id) VALUES (?,?,?,?)",
+                       (patient, room, status, line))
+    return cur.lastrowid
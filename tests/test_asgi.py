@@ -0,0 +1,47 @@
+import asyncio
+
+from server import asgi
+
+
+async def _echo(scope, receive, send):
+    msg = await receive()
+    body = b'%s %s %s' % (scope['method'].encode(), scope['path'].encode(), msg['body'])
+    await send({'type': 'http.response.start', 'status': 200,
+                'headers': [(b'content-length', str(len(body)).encode())]})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def _exchange(monkeypatch, request):
+    monkeypatch.setattr(asgi, 'app', _echo)
+    server = await asyncio.start_server(asgi._handle_conn, '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+    async with server:
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(request)
+        await writer.drain()
+        data = await asyncio.wait_for(reader.read(), 5)
+        writer.close()
+    return data
+
+
+def test_chunked_body_then_keep_alive(monkeypatch):
+    request = (b'POST /api/queues HTTP/1.1\r\nHost: x\r\nTransfer-Encoding: chunked\r\n\r\n'
+               b'4\r\n{"a"\r\n3;ext=1\r\n:1}\r\n0\r\n\r\n'
+               b'GET /next HTTP/1.1\r\nHost: x\r\nConnection: close\r\n\r\n')
+    data = asyncio.run(_exchange(monkeypatch, request))
+    assert data.count(b'HTTP/1.1 200') == 2
+    assert b'POST /api/queues {"a":1}' in data
+    assert data.endswith(b'GET /next ')
+
+
+def test_unsupported_transfer_encoding_closes(monkeypatch):
+    request = (b'POST /x HTTP/1.1\r\nTransfer-Encoding: gzip, chunked\r\n\r\n'
+               b'GET /smuggled HTTP/1.1\r\n\r\n')
+    data = asyncio.run(_exchange(monkeypatch, request))
+    assert data.startswith(b'HTTP/1.1 501') and b'smuggled' not in data
+
+
+def test_malformed_chunk_is_rejected(monkeypatch):
+    request = b'POST /x HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\nzz\r\n'
+    data = asyncio.run(_exchange(monkeypatch, request))
+    assert data.startswith(b'HTTP/1.1 400')
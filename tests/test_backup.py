@@ -0,0 +1,77 @@
+import gzip
+import os
+import sqlite3
+from contextlib import closing
+
+import pytest
+
+from server import backup
+
+
+@pytest.fixture
+def live(tmp_path, monkeypatch):
+    app = str(tmp_path / 'app.db')
+    with closing(sqlite3.connect(app)) as conn:
+        conn.execute("CREATE TABLE queues(id INTEGER PRIMARY KEY, status TEXT)")
+        conn.executemany("INSERT INTO queues(status) VALUES (?)", [('pending',)] * 3)
+        conn.execute("PRAGMA user_version=7")
+        conn.commit()
+    monkeypatch.setattr(backup, 'DATABASES', {'app': app, 'archive': str(tmp_path / 'archive.db')})
+    monkeypatch.setattr(backup, 'BACKUP_DIR', str(tmp_path / 'backups'))
+    return app
+
+
+def _rows(path):
+    with closing(sqlite3.connect(path)) as conn:
+        return conn.execute("SELECT COUNT(*) FROM queues").fetchone()[0]
+
+
+def test_backup_and_verify(live):
+    done = backup.run_once()
+    assert [d['database'] for d in done] == ['app']    # archive.db does not exist
+    summary = backup.verify(done[0]['file'])
+    assert summary['ok'] and summary['user_version'] == 7 and summary['rows'] == {'queues': 3}
+
+
+def test_verify_reports_corruption(live, tmp_path):
+    bad = str(tmp_path / 'app-20250101-000000.db.gz')
+    with open(live, 'rb') as f:
+        data = bytearray(f.read())
+    data[len(data) // 2:] = b'\xff' * (len(data) - len(data) // 2)   # trash the table pages
+    with gzip.open(bad, 'wb') as g:
+        g.write(bytes(data))
+    try:
+        ok = backup.verify(bad)['ok']
+    except sqlite3.DatabaseError:
+        ok = False    # too broken to even open
+    assert not ok
+    with pytest.raises((RuntimeError, sqlite3.DatabaseError)):
+        backup.restore(bad, force=True)
+    assert _rows(live) == 3
+    assert not os.path.exists(live + '.pre-restore')
+
+
+def test_restore_keeps_pre_restore_copy(live):
+    path = backup.backup_one('app')['file']
+    with closing(sqlite3.connect(live)) as conn:
+        conn.execute("DELETE FROM queues")
+        conn.commit()
+    with pytest.raises(FileExistsError):
+        backup.restore(path)
+    info = backup.restore(path, force=True)
+    assert info['restored_to'] == live
+    assert _rows(live) == 3
+    assert _rows(live + '.pre-restore') == 0
+
+
+def test_restore_rejects_unknown_name(live, tmp_path):
+    with pytest.raises(ValueError):
+        backup.restore(str(tmp_path / 'other-20250101-000000.db.gz'))
+
+
+def test_prune_keeps_newest(live):
+    for stamp in ('20250101-000000', '20250102-000000', '20250103-000000'):
+        backup.backup_one('app', stamp)
+    removed = backup.prune(keep=2)
+    assert [os.path.basename(p) for p in removed] == ['app-20250101-000000.db.gz']
+    assert len(backup.list_backups()) == 2
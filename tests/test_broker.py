@@ -0,0 +1,134 @@
+import itertools
+import socket
+import struct
+import threading
+import time
+
+from server.broker import (CONNACK, CONNECT, PUBACK, PUBLISH, SUBACK, SUBSCRIBE, Broker, decode_str,
+                           _TCPSession, encode_packet, encode_publish, encode_str, next_packet_id,
+                           read_packet, topic_matches)
+
+
+def test_packet_id_wraps_within_range():
+    mids = itertools.count(65533)
+    assert [next_packet_id(mids) for _ in range(4)] == [65534, 65535, 1, 2]
+
+
+def test_packet_id_skips_inflight():
+    mids = itertools.count(65534)
+    assert next_packet_id(mids, {65535, 1}) == 2
+
+
+def test_publish_roundtrip():
+    a, b = socket.socketpair()
+    with a, b:
+        a.sendall(encode_publish('disp/cmd/1', b'{"x":1}', qos=1, retain=True, mid=65535, dup=True))
+        ptype, flags, body = read_packet(b)
+    assert ptype == PUBLISH
+    assert flags == 0x08 | 0x02 | 0x01
+    topic, i = decode_str(body, 0)
+    assert topic == b'disp/cmd/1'
+    assert struct.unpack_from('!H', body, i)[0] == 65535
+    assert body[i + 2:] == b'{"x":1}'
+
+
+def test_long_packet_length_encoding():
+    payload = b'x' * 20000   # needs a 3-byte remaining length
+    a, b = socket.socketpair()
+    with a, b:
+        a.sendall(encode_publish('t', payload))
+        _, _, body = read_packet(b)
+    assert body.endswith(payload) and len(body) == 2 + 1 + len(payload)
+
+
+def test_topic_matches():
+    assert topic_matches('disp/+/1', 'disp/cmd/1')
+    assert topic_matches('disp/#', 'disp')
+    assert topic_matches('disp/#', 'disp/evt/2')
+    assert not topic_matches('disp/+', 'disp/evt/2')
+    assert not topic_matches('#', '$SYS/uptime')
+
+
+def _connect(port):
+    s = socket.create_connection(('127.0.0.1', port), timeout=5)
+    body = encode_str('MQTT') + bytes([4, 0x02]) + struct.pack('!H', 60) + encode_str('node-test')
+    s.sendall(encode_packet(CONNECT, 0, body))
+    ptype, _, body = read_packet(s)
+    assert ptype == CONNACK and body[1] == 0
+    s.sendall(encode_packet(SUBSCRIBE, 0x02, struct.pack('!H', 1) + encode_str('disp/cmd/+') + b'\x01'))
+    assert read_packet(s)[0] == SUBACK
+    return s
+
+
+def test_tcp_session_packet_ids_wrap():
+    broker = Broker(retry_interval=60)
+    server = broker.listen('127.0.0.1', 0)
+    try:
+        s = _connect(server.server_address[1])
+        with s:
+            # SUBACK goes out just before the broker registers the filter
+            deadline = time.time() + 2
+            while not any(broker._subs.values()) and time.time() < deadline:
+                time.sleep(0.01)
+            session = next(iter(broker._subs))
+            session._mids = itertools.count(65534)
+            mids = []
+            for n in range(3):
+                broker.publish('disp/cmd/1', b'%d' % n, qos=1)
+                ptype, _, body = read_packet(s)
+                assert ptype == PUBLISH
+                _, i = decode_str(body, 0)
+                mid = struct.unpack_from('!H', body, i)[0]
+                mids.append(mid)
+                s.sendall(encode_packet(PUBACK, 0, struct.pack('!H', mid)))
+            assert mids == [65535, 1, 2]
+            deadline = time.time() + 2
+            while session._inflight and time.time() < deadline:
+                time.sleep(0.01)
+            assert session._inflight == {}
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+class _NullSock:
+    def sendall(self, data):
+        pass
+
+
+def test_concurrent_deliveries_get_distinct_packet_ids():
+    session = _TCPSession.__new__(_TCPSession)
+    session.broker = Broker(retry_interval=60)
+    session.request = _NullSock()
+    session.setup()
+
+    def publish():
+        for _ in range(500):
+            session.deliver('disp/cmd/1', b'x', 1, False)
+
+    threads = [threading.Thread(target=publish) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(session._inflight) == 8 * 500
+
+
+def test_in_process_handler_failure_is_not_redelivered():
+    broker = Broker(retry_interval=0.05)
+    client = broker.client('server')
+    calls = []
+
+    def on_message(c, userdata, msg):
+        calls.append(msg.payload)
+        raise RuntimeError('boom')
+
+    client.on_message = on_message
+    client.connect('embedded')
+    client.loop_start()
+    client.subscribe('disp/evt/+', qos=1)
+    time.sleep(0.05)
+    broker.publish('disp/evt/1', b'{}', qos=1)
+    time.sleep(0.3)
+    client.loop_stop()
+    assert calls == [b'{}']
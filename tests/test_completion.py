@@ -0,0 +1,60 @@
+from contextlib import closing
+
+from conftest import make_queue
+from server import completion, lines
+
+
+def _state(done, failed, line):
+    return completion.State(done, failed, line.required, line.nodes_mask)
+
+
+def test_state_waits_for_every_participant():
+    line = lines.Line(1, [1, 2], vision=True)           # bits: node1=1, node2=2, vision=4
+    assert not _state(0b011, 0, line).complete
+    st = _state(0b111, 0, line)
+    assert st.complete and st.success
+
+
+def test_failure_is_final_once_all_nodes_reported():
+    line = lines.Line(1, [1, 2], vision=True)
+    assert not _state(0b001, 0b001, line).complete      # node2 may still report
+    st = _state(0b011, 0b010, line)                     # vision is not waited for
+    assert st.complete and not st.success
+    assert st.outcome(line) == {1: 'success', 2: 'failed', 'vision': None}
+    assert completion.reason(line, st) == 'node1:success, node2:failed, vision:missing'
+
+
+def test_record_is_idempotent(db):
+    line = lines.get(1)
+    with closing(db.get_conn()) as conn:
+        qid = make_queue(conn, status='in_progress', line=line.id)
+        completion.open_queue(conn, qid, line)
+        st = completion.record(conn, qid, line, 1, True)
+        assert (st.done, st.failed, st.complete) == (1, 0, False)
+        assert completion.record(conn, qid, line, 1, False) is None
+        st = completion.record(conn, qid, line, 2, True)
+        assert st.complete and st.success
+
+
+def test_record_without_open_row(db):
+    # a queue dispatched before queue_completion existed still gets a row on its first report
+    line = lines.get(1)
+    with closing(db.get_conn()) as conn:
+        qid = make_queue(conn, status='in_progress', line=line.id)
+        st = completion.record(conn, qid, line, 2, False)
+        assert (st.done, st.failed) == (2, 2)
+        assert completion.record(conn, qid, line, 2, True) is None
+
+
+def test_report_from_another_line_is_dropped(db):
+    line1, line2 = lines.get(1), lines.get(2)
+    with closing(db.get_conn()) as conn:
+        qid = make_queue(conn, status='in_progress', line=line2.id)
+        completion.open_queue(conn, qid, line2)
+        assert completion.record(conn, qid, line1, 1, True) is None
+        assert completion.record(conn, qid, line1, 2, True) is None
+        assert not completion.on_line(conn, qid, line1)
+        assert conn.execute("SELECT done FROM queue_completion WHERE queue_id=?", (qid,)).fetchone()[0] == 0
+        legacy = make_queue(conn, status='in_progress', line=line2.id)    # no queue_completion row yet
+        assert completion.record(conn, legacy, line1, 1, True) is None
+        assert completion.record(conn, legacy, line2, 3, True).done == 1
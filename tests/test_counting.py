@@ -0,0 +1,68 @@
+import random
+import statistics
+from collections import deque
+
+import pytest
+
+from counting import CountConfig, CountingSession, StableWindow
+
+
+def _window(values, size=7):
+    w = StableWindow(size)
+    for v in values:
+        w.push(v)
+    return w
+
+
+def test_empty_window():
+    w = StableWindow(5)
+    assert (w.mode(), w.median(), w.mean()) == (None, None, None)
+
+
+def test_mode_tie_goes_to_first_seen():
+    assert _window([3, 4, 4, 3]).mode() == 3
+    assert _window([4, 3, 3, 4]).mode() == 4
+    # after 5 drops out of a full window, 2 is the oldest of the tied values
+    assert _window([5, 2, 2, 1, 1], size=4).mode() == 2
+
+
+def test_even_length_median_averages_and_truncates():
+    assert _window([2, 5]).median() == 3
+    assert _window([1, 2, 3, 4]).median() == 2
+    assert _window([2, 2, 4, 4]).median() == 3
+    assert _window([0, 9]).median() == 4
+
+
+def test_odd_length_median():
+    assert _window([5, 1, 3]).median() == 3
+
+
+@pytest.mark.parametrize('size', [1, 2, 4, 7, 8])
+def test_matches_statistics_module_on_random_streams(size):
+    rng = random.Random(size)
+    w = StableWindow(size)
+    ref = deque(maxlen=size)
+    for _ in range(3000):
+        v = rng.choice([0, 1, 2, 3, 3, 4, 7, 12])
+        w.push(v)
+        ref.append(v)
+        data = list(ref)
+        assert w.mode() == statistics.mode(data)
+        assert w.median() == int(statistics.median(data))
+        assert w.mean() == int(round(sum(data) / len(data)))
+
+
+def test_values_clamped_to_range():
+    w = StableWindow(3, max_value=10)
+    for v in (-4, 50, 5):
+        w.push(v)
+    assert w.median() == 5 and w.mode() == 0
+
+
+def test_session_peak_and_stable():
+    sess = CountingSession(CountConfig(mode='peak', window=3), queue_id=1, expected_total=3)
+    for n, t in ((1, 0.0), (3, 0.1), (3, 0.2), (2, 0.3)):
+        sess.observe([(0, 0, 5)] * n, t)
+    assert sess.peak == 3
+    assert sess.stable('mode') == 3
+    assert sess.latest == 2
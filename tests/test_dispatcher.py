@@ -0,0 +1,52 @@
+import os
+import threading
+import time
+
+import pytest
+
+from server import dispatcher, mqtt_client
+
+
+@pytest.fixture
+def owner(monkeypatch, tmp_path):
+    """An owner socket served on a thread; this process then plays the follower."""
+    monkeypatch.setattr(dispatcher, 'DISPATCH_SOCKET', str(tmp_path / 'd.sock'))
+    passes = []
+    monkeypatch.setattr(mqtt_client, '_dispatch_next_queue', lambda client, candidates=None: passes.append(client))
+    sock = dispatcher._bind_socket()
+    threading.Thread(target=dispatcher._serve_triggers, args=(sock, 'owner-client'), daemon=True).start()
+    monkeypatch.setattr(dispatcher, '_role', 'follower')
+    yield passes
+    sock.close()
+
+
+def test_follower_query_is_answered_by_owner(owner, monkeypatch):
+    calls = []
+
+    def answer(window=None):
+        calls.append(threading.current_thread().name)
+        return {'window': window, 'pid': os.getpid()}
+    monkeypatch.setitem(dispatcher._queries, 'probe', answer)
+    assert dispatcher.ask_owner('probe', window=60) == {'window': 60, 'pid': os.getpid()}
+    assert calls and calls[0] != threading.current_thread().name   # ran on the owner's thread
+
+
+def test_large_reply_fits(owner, monkeypatch):
+    text = '\n'.join(f'dispense_metric{{endpoint="e{i}"}} {i}' for i in range(20000))
+    monkeypatch.setitem(dispatcher._queries, 'big', lambda: text)
+    assert dispatcher.ask_owner('big') == text
+
+
+def test_follower_falls_back_when_owner_is_gone(monkeypatch, tmp_path):
+    monkeypatch.setattr(dispatcher, 'DISPATCH_SOCKET', str(tmp_path / 'missing.sock'))
+    monkeypatch.setattr(dispatcher, '_role', 'follower')
+    monkeypatch.setitem(dispatcher._queries, 'probe', lambda: 'local')
+    assert dispatcher.ask_owner('probe') == 'local'
+
+
+def test_trigger_runs_a_dispatch_pass_on_the_owner(owner):
+    assert dispatcher.trigger() is None
+    deadline = time.time() + 2
+    while not owner and time.time() < deadline:
+        time.sleep(0.01)
+    assert owner and owner[0] == 'owner-client'
@@ -0,0 +1,51 @@
+import numpy as np
+
+from framebus import FrameBus
+
+
+class _Cap:
+    """cv2.VideoCapture stand-in that fills the array it is given, like cap.read(frame) does."""
+
+    def __init__(self, shape):
+        self.shape = shape
+        self.n = 0
+
+    def read(self, out=None):
+        self.n += 1
+        if out is None:
+            out = np.empty(self.shape, np.uint8)
+        out[:] = self.n
+        return True, out
+
+
+def test_capture_lands_in_shared_memory_and_readers_see_it():
+    bus = FrameBus.create(slots=2, max_size=(8, 4))
+    try:
+        reader = FrameBus.attach(bus.name)
+        cap = _Cap((4, 8, 3))
+        for _ in range(2):
+            ok, frame = bus.capture(cap)
+            assert ok
+            bus.commit([(1, 2, 3)], count=5)
+        assert np.shares_memory(frame, bus._data)    # second frame was read straight into its slot
+        f = reader.latest()
+        assert f.seq == 2 and f.count == 5 and f.detections == [(1, 2, 3)]
+        assert f.image.shape == (4, 8, 3) and int(f.image[0, 0, 0]) == 2
+        assert reader.valid(f)
+        assert reader.latest(after=2) is None
+        for _ in range(2):      # go round the ring: f's slot is reused
+            bus.capture(cap)
+            bus.commit()
+        assert not reader.valid(f)
+        reader.close()
+    finally:
+        bus.close()
+
+
+def test_oversize_frames_are_not_published():
+    bus = FrameBus.create(slots=2, max_size=(4, 4))
+    try:
+        assert bus.publish(np.zeros((8, 8, 3), np.uint8)) is None
+        assert bus.oversize == 1 and bus.latest() is None
+    finally:
+        bus.close()
@@ -0,0 +1,67 @@
+import time
+from contextlib import closing
+
+import pytest
+
+from conftest import make_queue
+from server import intake
+
+
+def test_predict_spreads_work_over_lines(db):
+    with closing(db.get_conn()) as conn:
+        conn.execute("INSERT INTO room_service(room_id, ewma_sec, samples, updated_at) VALUES (1, 20, 1, 0)")
+        running = make_queue(conn, status='in_progress', room=1)
+        conn.execute("INSERT INTO queue_trace(queue_id, stage, ts) VALUES(?,?,?)", (running, 'reserved', time.time() - 5))
+        make_queue(conn, room=1)
+        make_queue(conn, room=2)     # no samples: SERVICE_DEFAULT_SEC
+        qid = make_queue(conn, room=1)
+        conn.commit()
+    got = intake.predict(qid)
+    assert got['position'] == 3
+    # (15 left of the running one + 20 + 30) over 2 lines
+    assert got['predicted_wait_sec'] == pytest.approx((15 + 20 + intake.SERVICE_DEFAULT_SEC) / 2, abs=0.2)
+
+
+def test_record_service_ewma(db, monkeypatch):
+    monkeypatch.setattr(intake, 'SERVICE_EWMA_ALPHA', 0.5)
+    with closing(db.get_conn()) as conn:
+        for seconds in (10, 30):
+            qid = make_queue(conn, room=3)
+            conn.execute("INSERT INTO queue_trace(queue_id, stage, ts) VALUES(?,?,?)", (qid, 'reserved', time.time() - seconds))
+            intake.record_service(conn, qid)
+        conn.commit()
+    assert intake.service_times()[3] == pytest.approx(20, abs=0.5)
+
+
+def test_admit_without_limits(db):
+    with closing(db.get_conn()) as conn:
+        assert intake.admit(conn, 1) == 'pending'
+
+
+def test_admit_rejects_over_room_limit(db, monkeypatch):
+    monkeypatch.setattr(intake, 'INTAKE_MAX_PENDING_ROOM', 2)
+    with closing(db.get_conn()) as conn:
+        make_queue(conn, room=1)
+        assert intake.admit(conn, 1) == 'pending'
+        make_queue(conn, room=1)
+        assert intake.admit(conn, 2) == 'pending'
+        with pytest.raises(intake.Overloaded) as exc:
+            intake.admit(conn, 1)
+        assert exc.value.retry_after >= 1
+
+
+def test_defer_keeps_fifo_and_promotes(db, monkeypatch):
+    monkeypatch.setattr(intake, 'INTAKE_MAX_PENDING', 1)
+    monkeypatch.setattr(intake, 'INTAKE_OVERLOAD', 'defer')
+    with closing(db.get_conn()) as conn:
+        first = make_queue(conn, room=1)
+        assert intake.admit(conn, 1) == 'deferred'
+        second = make_queue(conn, status='deferred', room=1)
+        conn.commit()
+    monkeypatch.setattr(intake, 'INTAKE_MAX_PENDING', 2)
+    with closing(db.get_conn()) as conn:
+        # a deferred queue is waiting: a new one may not skip ahead of it, even under the limit
+        assert intake.admit(conn, 2) == 'deferred'
+    assert intake.promote_deferred() == 1
+    assert db.query("SELECT status FROM queues WHERE id=?", (second,))[0]['status'] == 'pending'
+    assert db.query("SELECT status FROM queues WHERE id=?", (first,))[0]['status'] == 'pending'
@@ -0,0 +1,25 @@
+import pytest
+
+from server import lines
+
+
+def test_parse():
+    parsed = lines.parse('1:1,2; 2: 3,4,vision')
+    assert sorted(parsed) == [1, 2]
+    assert parsed[1].participants == (1, 2) and not parsed[1].vision
+    assert parsed[2].participants == (3, 4, 'vision')
+    assert parsed[2].required == 0b111 and parsed[2].nodes_mask == 0b011
+    assert parsed[2].bit('vision') == 4 and parsed[2].items_node == 3
+
+
+@pytest.mark.parametrize('spec', ['', ' ; ', '1:vision', '1:1,2;2:2,3'])
+def test_parse_rejects(spec):
+    with pytest.raises(ValueError):
+        lines.parse(spec)
+
+
+def test_module_lines_from_env():
+    # tests/conftest.py sets DISPENSE_LINES='1:1,2;2:3,4,vision'
+    assert lines.of_node(3) is lines.get(2)
+    assert lines.of_node(9) is None
+    assert [line.id for line in lines.all_lines()] == [1, 2]
@@ -0,0 +1,30 @@
+from server import metrics, mqtt_client
+from server.broker import MQTTMessage
+
+
+def test_label_values_are_escaped():
+    reg = metrics.Registry()
+    c = reg.counter('t_total', 'test', ('v',))
+    c.inc('a"b\\c\nd')
+    assert 't_total{v="a\\"b\\\\c\\nd"} 1' in reg.render().splitlines()
+
+
+def test_histogram_render_is_cumulative():
+    reg = metrics.Registry()
+    h = reg.histogram('t_seconds', 'test', ('op',), buckets=(0.1, 1))
+    for v in (0.05, 0.5, 5):
+        h.observe(v, 'q')
+    out = reg.render().splitlines()
+    assert 't_seconds_bucket{op="q",le="0.1"} 1' in out
+    assert 't_seconds_bucket{op="q",le="1"} 2' in out
+    assert 't_seconds_bucket{op="q",le="+Inf"} 3' in out
+    assert 't_seconds_count{op="q"} 3' in out
+
+
+def test_unknown_nodes_and_kinds_share_one_series(monkeypatch):
+    monkeypatch.setattr(mqtt_client, '_handle_message', lambda *a: None)
+    before = dict(metrics.MQTT_MESSAGES._values)
+    for topic in ('disp/evt/1', 'disp/evt/999', 'disp/evt/x"y', 'disp/junk/1'):
+        mqtt_client.on_message(None, None, MQTTMessage(topic, b'{}'))
+    new = {k: v - before.get(k, 0) for k, v in metrics.MQTT_MESSAGES._values.items() if v != before.get(k, 0)}
+    assert new == {('evt', '1'): 1, ('evt', 'other'): 2, ('other', '1'): 1}
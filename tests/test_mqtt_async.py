@@ -0,0 +1,85 @@
+import asyncio
+import itertools
+
+from server.broker import Broker
+from server.mqtt_async import AsyncMQTTClient
+
+
+async def _until(cond, timeout=3.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not cond():
+        assert asyncio.get_running_loop().time() < deadline, 'timed out'
+        await asyncio.sleep(0.01)
+
+
+def _run_against_broker(scenario):
+    broker = Broker(retry_interval=60)
+    server = broker.listen('127.0.0.1', 0)
+    port = server.server_address[1]
+
+    async def main():
+        client = AsyncMQTTClient('test-client')
+        task = asyncio.create_task(client.run('127.0.0.1', port, keepalive=30))
+        try:
+            await _until(client.is_connected)
+            await scenario(client)
+        finally:
+            client.disconnect()
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+    try:
+        asyncio.run(main())
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_packet_ids_wrap_after_65535():
+    async def scenario(client):
+        client._mids = itertools.count(65534)
+        infos = [client.publish('disp/cmd/1', b'%d' % n, qos=1) for n in range(3)]
+        assert [i.mid for i in infos] == [65535, 1, 2]
+        await _until(lambda: all(i.is_published() for i in infos))
+        assert client._inflight == {}
+    _run_against_broker(scenario)
+
+
+def test_messages_delivered_to_subscriber():
+    received = []
+
+    async def scenario(client):
+        client.on_message = lambda c, u, msg: received.append((msg.topic, msg.payload))
+        client.subscribe('disp/evt/+', qos=1)
+        await asyncio.sleep(0.2)
+        client.publish('disp/evt/2', b'{"done":1}', qos=1)
+        await _until(lambda: received)
+    _run_against_broker(scenario)
+    assert received == [('disp/evt/2', b'{"done":1}')]
+
+
+def test_no_client_resend_when_retry_disabled():
+    broker = Broker(retry_interval=60)
+    server = broker.listen('127.0.0.1', 0)
+    try:
+        async def main():
+            client = AsyncMQTTClient('no-retry', retry_interval=None)
+            client._loop = asyncio.get_running_loop()
+            info = client.publish('disp/cmd/1', b'x', qos=1)   # not connected yet: stays in flight
+            await asyncio.sleep(0)
+            assert info.mid in client._inflight
+            task = asyncio.create_task(client.run('127.0.0.1', server.server_address[1]))
+            await _until(client.is_connected)
+            assert client._inflight == {}                     # dropped, not resent, on connect
+            client.disconnect()
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        asyncio.run(main())
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,84 @@
+import json
+import time
+from contextlib import closing
+
+from conftest import make_queue
+from server import completion, lines, mqtt_client, tracing
+
+
+class _Msg:
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = json.dumps(payload).encode()
+
+
+def _dispatched_queue(db, line_id=1):
+    line = lines.get(line_id)
+    with closing(db.get_conn()) as conn:
+        qid = make_queue(conn, status='in_progress', line=line.id)
+        completion.open_queue(conn, qid, line)
+        conn.execute("INSERT INTO queue_trace(queue_id, stage, ts) VALUES(?,?,?)", (qid, 'reserved', time.time() - 5))
+        conn.commit()
+    tracing.mark(qid, 'created')
+    return qid
+
+
+def _events(db, qid):
+    return [r['event'] for r in db.query("SELECT event FROM events WHERE queue_id=? ORDER BY id", (qid,))]
+
+
+def test_rejected_ack_finishes_queue_like_a_failed_evt(db):
+    tracing._samples.clear()
+    qid = _dispatched_queue(db)
+    mqtt_client._handle_message(None, None, _Msg('disp/ack/1', {'queue_id': qid, 'accepted': 0}))
+
+    assert db.query("SELECT status FROM queues WHERE id=?", (qid,))[0]['status'] == 'failed'
+    assert _events(db, qid) == ['ack_rejected', 'queue_failed']
+    assert db.query("SELECT SUM(failed) AS f FROM rollup_daily_room")[0]['f'] == 1
+    assert db.query("SELECT COUNT(*) AS n FROM room_service")[0]['n'] == 1
+    assert tracing.latency_stats()['failed']['count'] == 1
+
+    # the other node's evt arrives later: nothing is counted twice
+    mqtt_client._handle_message(None, None, _Msg('disp/evt/2', {'queue_id': qid, 'done': 1, 'status': 'success'}))
+    assert db.query("SELECT SUM(failed) AS f FROM rollup_daily_room")[0]['f'] == 1
+    assert db.query("SELECT status FROM queues WHERE id=?", (qid,))[0]['status'] == 'failed'
+
+
+def test_duplicate_rejection_is_ignored(db):
+    qid = _dispatched_queue(db)
+    for _ in range(2):
+        mqtt_client._handle_message(None, None, _Msg('disp/ack/1', {'queue_id': qid, 'accepted': 0}))
+    assert _events(db, qid).count('ack_rejected') == 1
+
+
+def test_all_nodes_success_completes_queue(db):
+    qid = _dispatched_queue(db)
+    for node in (1, 2):
+        mqtt_client._handle_message(None, None, _Msg(f'disp/evt/{node}', {'queue_id': qid, 'done': 1, 'status': 'success'}))
+    assert db.query("SELECT status FROM queues WHERE id=?", (qid,))[0]['status'] == 'success'
+
+
+def test_evt_from_other_line_does_not_complete_queue(db):
+    qid = _dispatched_queue(db, line_id=2)
+    for node in (1, 2):
+        mqtt_client._handle_message(None, None, _Msg(f'disp/evt/{node}', {'queue_id': qid, 'done': 1, 'status': 'success'}))
+    assert db.query("SELECT status FROM queues WHERE id=?", (qid,))[0]['status'] == 'in_progress'
+
+
+def test_missing_vision_report_fails_queue_after_timeout(db):
+    qid = _dispatched_queue(db, line_id=2)     # nodes 3, 4 and vision
+    for node in (3, 4):
+        mqtt_client._handle_message(None, None, _Msg(f'disp/evt/{node}', {'queue_id': qid, 'done': 1, 'status': 'success'}))
+    assert mqtt_client.expire_vision() == 0
+    assert db.query("SELECT status FROM queues WHERE id=?", (qid,))[0]['status'] == 'in_progress'
+
+    assert mqtt_client.expire_vision(now=time.time() + mqtt_client.VISION_TIMEOUT_SEC + 1) == 1
+    assert db.query("SELECT status FROM queues WHERE id=?", (qid,))[0]['status'] == 'failed'
+    assert 'vision_timeout' in _events(db, qid)
+    assert mqtt_client.expire_vision(now=time.time() + mqtt_client.VISION_TIMEOUT_SEC + 1) == 0
+
+
+def test_vision_timeout_waits_for_the_nodes(db):
+    qid = _dispatched_queue(db, line_id=2)
+    mqtt_client._handle_message(None, None, _Msg('disp/evt/3', {'queue_id': qid, 'done': 1, 'status': 'success'}))
+    assert mqtt_client.expire_vision(now=time.time() + mqtt_client.VISION_TIMEOUT_SEC + 1) == 0
@@ -0,0 +1,108 @@
+from contextlib import closing
+
+import pytest
+
+from conftest import make_queue
+from server import outbox
+
+
+class FakeClient:
+    def __init__(self, connected=True, ack_inline=False):
+        self.connected = connected
+        self.ack_inline = ack_inline
+        self.sent = []
+        self._mid = 0
+
+    def is_connected(self):
+        return self.connected
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        self._mid += 1
+        self.sent.append((topic, payload, qos, self._mid))
+        if self.ack_inline:
+            outbox.on_publish(self, None, self._mid)   # PUBACK racing ahead of publish() returning
+
+        class Info:
+            mid = self._mid
+        return Info()
+
+
+@pytest.fixture(autouse=True)
+def _reset():
+    for state in (outbox._inflight, outbox._early):
+        state.clear()
+    del outbox._acked[:], outbox._node_acks[:]
+    yield
+
+
+def _queue_with_command(db, status='in_progress', node=1):
+    with closing(db.get_conn()) as conn:
+        qid = make_queue(conn, status=status, line=1)
+        outbox.enqueue(conn, qid, node, f'disp/cmd/{node}', {'queue_id': qid})
+        conn.commit()
+    return qid
+
+
+def _rows(db):
+    return [dict(r) for r in db.query("SELECT * FROM outbox ORDER BY id")]
+
+
+def test_publish_then_puback_marks_delivered(db):
+    _queue_with_command(db)
+    client = FakeClient()
+    assert outbox.publish_pass(client) == 1
+    row = _rows(db)[0]
+    assert row['status'] == 'sent' and row['attempts'] == 1
+    outbox.on_publish(client, None, client.sent[0][3])
+    outbox.publish_pass(client)
+    assert _rows(db)[0]['status'] == 'delivered'
+
+
+def test_puback_before_publish_returns(db):
+    _queue_with_command(db)
+    client = FakeClient(ack_inline=True)
+    outbox.publish_pass(client)
+    outbox.publish_pass(client)
+    assert _rows(db)[0]['status'] == 'delivered'
+    assert outbox._early == set() and outbox._inflight == {}
+
+
+def test_node_ack_confirms_without_puback(db):
+    qid = _queue_with_command(db, node=2)
+    outbox.publish_pass(FakeClient())
+    outbox.node_acked(qid, 2)
+    outbox.publish_pass(FakeClient())
+    assert _rows(db)[0]['status'] == 'delivered'
+
+
+def test_nothing_published_while_disconnected(db):
+    _queue_with_command(db)
+    client = FakeClient(connected=False)
+    assert outbox.publish_pass(client) == 0
+    assert client.sent == [] and _rows(db)[0]['status'] == 'pending'
+
+
+def test_command_for_finished_queue_is_dropped(db):
+    _queue_with_command(db, status='success')
+    client = FakeClient()
+    assert outbox.publish_pass(client) == 0
+    assert client.sent == [] and _rows(db)[0]['status'] == 'dropped'
+
+
+def test_unconfirmed_row_resent_only_when_due(db):
+    _queue_with_command(db)
+    client = FakeClient()
+    outbox.publish_pass(client)
+    assert outbox.publish_pass(client) == 0          # backoff not over yet
+    with closing(db.get_conn()) as conn:
+        conn.execute("UPDATE outbox SET next_attempt = 0")
+        conn.commit()
+    assert outbox.publish_pass(client) == 1
+    row = _rows(db)[0]
+    assert len(client.sent) == 2 and row['attempts'] == 2 and row['status'] == 'sent'
+
+
+def test_backoff_doubles_up_to_max():
+    assert outbox._backoff(0) == outbox.OUTBOX_RETRY_MIN
+    assert outbox._backoff(1) == min(outbox.OUTBOX_RETRY_MAX, 2 * outbox.OUTBOX_RETRY_MIN)
+    assert outbox._backoff(30) == outbox.OUTBOX_RETRY_MAX
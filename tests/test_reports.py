@@ -0,0 +1,42 @@
+import time
+from contextlib import closing
+
+import pytest
+
+from conftest import make_queue
+from server import reports
+
+
+def _served_queue(conn, waited, served_after):
+    """A queue created ``waited`` seconds before it was reserved and decided ``served_after`` seconds later."""
+    now = time.time()
+    qid = make_queue(conn, status='success', room=1)
+    conn.execute("UPDATE queues SET created_at=datetime(?, 'unixepoch'), served_at=datetime(?, 'unixepoch') WHERE id=?",
+                 (now - served_after - waited, now, qid))
+    conn.execute("INSERT INTO queue_trace(queue_id, stage, ts) VALUES(?,?,?)", (qid, 'reserved', now - served_after))
+    return qid
+
+
+def _avg_service():
+    day = time.strftime('%Y-%m-%d', time.gmtime())
+    return reports.report(day, day)['rooms'][0]['avg_service_sec']
+
+
+def test_service_time_starts_at_reserved(db):
+    with closing(db.get_conn()) as conn:
+        qid = _served_queue(conn, waited=600, served_after=20)
+        reports.record_completion(conn, qid, 'success')
+        untraced = make_queue(conn, status='success', room=1)
+        reports.record_completion(conn, untraced, 'success')
+        conn.commit()
+    assert _avg_service() == pytest.approx(20, abs=1)
+    assert reports.totals() == (2, 0)
+
+
+def test_backfill_uses_the_same_definition(db):
+    with closing(db.get_conn()) as conn:
+        _served_queue(conn, waited=600, served_after=20)
+        _served_queue(conn, waited=5, served_after=40)
+        conn.commit()
+    assert reports.backfill() == 2
+    assert _avg_service() == pytest.approx(30, abs=1)
@@ -0,0 +1,62 @@
+import os
+import threading
+
+import numpy as np
+
+from snapshots import FrameRing, SnapshotWriter
+
+
+def test_longest_side_is_capped():
+    ring = FrameRing(capacity=2, max_side=100)
+    ring.offer(np.zeros((400, 50, 3), np.uint8), 1, now=0.0)    # portrait: height is the long side
+    ring.offer(np.zeros((30, 300, 3), np.uint8), 2, now=0.0)
+    assert max(ring.best(1).shape[:2]) == 100
+    assert max(ring.best(2).shape[:2]) == 100
+
+
+def test_small_frames_are_copied_not_viewed():
+    frame = np.zeros((20, 20, 3), np.uint8)
+    ring = FrameRing(max_side=100)
+    ring.offer(frame, 3, now=0.0)
+    frame[:] = 255
+    assert ring.best(3).max() == 0
+
+
+def test_evicts_smallest_count_and_refreshes():
+    ring = FrameRing(capacity=2, max_side=0, refresh=1.0)
+    frames = [np.full((4, 4, 3), i, np.uint8) for i in range(5)]
+    ring.offer(frames[1], 1, now=0.0)
+    ring.offer(frames[2], 2, now=0.0)
+    ring.offer(frames[0], 0, now=0.0)      # smaller than everything kept: ignored
+    ring.offer(frames[3], 3, now=0.0)      # evicts count 1
+    assert sorted(ring._frames) == [2, 3]
+    ring.offer(frames[4], 3, now=0.5)      # not due for a refresh yet
+    assert ring.best(3).max() == 3
+    ring.offer(frames[4], 3, now=1.5)
+    assert ring.best(3).max() == 4
+    assert ring.best(7).max() == 4         # unknown count: most recent frame
+
+
+def test_detections_drawn_on_copy_only():
+    frame = np.zeros((200, 400, 3), np.uint8)
+    ring = FrameRing(max_side=200)
+    ring.offer(frame, 1, now=0.0, detections=[(100, 100, 20)])
+    assert frame.max() == 0
+    assert ring.best(1).max() > 0
+
+
+def test_writer_stores_by_content(tmp_path):
+    writer = SnapshotWriter(str(tmp_path))
+    done = threading.Event()
+    paths = []
+
+    def on_done(path):
+        paths.append(path)
+        done.set()
+
+    assert writer.submit(np.full((16, 16, 3), 128, np.uint8), on_done)
+    assert done.wait(5)
+    path = paths[0]
+    assert os.path.exists(path)
+    digest = os.path.basename(path)[:-len('.jpg')]
+    assert path == writer.path_for(digest)
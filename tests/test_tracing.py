@@ -0,0 +1,54 @@
+from contextlib import closing
+
+from conftest import make_queue
+from server import tracing
+
+
+def _stages():
+    return {stage: s['count'] for stage, s in tracing.latency_stats().items()}
+
+
+def _reset():
+    tracing._samples.clear()
+    tracing._created.clear()
+
+
+def test_span_in_rolled_back_transaction_leaves_no_sample(db):
+    _reset()
+    with closing(db.get_conn()) as conn:
+        qid = make_queue(conn)
+        conn.commit()
+    tracing.mark(qid, 'created')
+    with closing(db.get_conn()) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        span = tracing.mark(qid, 'reserved', conn=conn)
+        conn.rollback()
+    assert span is not None
+    assert 'reserved' not in _stages()
+    assert not db.query("SELECT 1 FROM queue_trace WHERE queue_id=? AND stage='reserved'", (qid,))
+
+
+def test_span_recorded_after_commit(db):
+    _reset()
+    with closing(db.get_conn()) as conn:
+        qid = make_queue(conn)
+        conn.commit()
+    tracing.mark(qid, 'created')
+    with closing(db.get_conn()) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        span = tracing.mark(qid, 'reserved', conn=conn)
+        conn.commit()
+    tracing.record(span)
+    assert _stages()['reserved'] == 1
+    assert [s['stage'] for s in tracing.trace(qid)] == ['created', 'reserved']
+
+
+def test_mark_without_conn_records_immediately(db):
+    _reset()
+    with closing(db.get_conn()) as conn:
+        qid = make_queue(conn)
+        conn.commit()
+    tracing.mark(qid, 'created')
+    tracing.mark(qid, 'served')
+    assert _stages() == {'served': 1}
+    assert qid not in tracing._created
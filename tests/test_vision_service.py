@@ -0,0 +1,40 @@
+import json
+import queue
+import signal
+import threading
+import time
+
+import vision_service
+
+
+def test_parse_cameras():
+    cams = vision_service.parse_cameras('0:2, rtsp://cam/1:4')
+    assert cams == [{'index': 0, 'source': 0, 'node': 2},
+                    {'index': 1, 'source': 'rtsp://cam/1', 'node': 4}]
+
+
+def test_missing_camera_does_not_block_finalize(monkeypatch, tmp_path):
+    monkeypatch.setattr(signal, 'signal', lambda *a: None)   # the worker runs in a thread here
+    monkeypatch.setattr(vision_service, 'FINAL_DELAY_SEC', 0.1)
+    monkeypatch.setattr(vision_service, 'SNAPSHOT_DIR', str(tmp_path))
+    cam = {'index': 0, 'source': str(tmp_path / 'missing.mp4'), 'node': 2}
+    inbox, outbox, stop = queue.Queue(), queue.Queue(), threading.Event()
+    t = threading.Thread(target=vision_service.camera_worker, args=(cam, inbox, outbox, stop), daemon=True)
+    t.start()
+    try:
+        time.sleep(0.3)   # first open has failed; the reopen backoff is running
+        sent = time.time()
+        inbox.put(('cmd', {'queue_id': 7, 'items': [{'quantity': 2}]}))
+        inbox.put(('evt', {'queue_id': 7, 'done': 1, 'status': 'success'}))
+        deadline = sent + 5
+        while time.time() < deadline:
+            topic, payload, _ = outbox.get(timeout=deadline - time.time())
+            payload = json.loads(payload)
+            if payload.get('status') == 'vision_complete':
+                break
+        assert time.time() - sent < 0.9
+        assert topic == 'disp/evt/2'
+        assert payload['queue_id'] == 7 and payload['expected'] == 2 and 'snapshot' not in payload
+    finally:
+        stop.set()
+        t.join(timeout=3)
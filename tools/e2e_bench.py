@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""Whole dispatch loop in one process: embedded broker + Flask app + virtual fleet + loadgen.
+
+    python tools/e2e_bench.py --proc const:0.2 --vision 2 -- --rate 5 --duration 20
+
+No mosquitto and no data/app.db involved: the server runs with MQTT_MODE=embedded
+against a scratch database, the fleet simulator talks to the same in-process
+broker, and tools/loadgen.py drives it over HTTP. Arguments after ``--`` go to
+loadgen; the rest are fleet_sim options (--broker/--port are ignored).
+"""
+import os
+import sys
+import tempfile
+import threading
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+
+def main(argv=None):
+    argv = list(sys.argv[1:] if argv is None else argv)
+    sim_argv, load_argv = (argv[:argv.index('--')], argv[argv.index('--') + 1:]) if '--' in argv else (argv, [])
+
+    tmp = tempfile.mkdtemp(prefix='dispense-bench-')
+    os.environ['MQTT_MODE'] = 'embedded'
+    os.environ.setdefault('DB_PATH', os.path.join(tmp, 'app.db'))
+    sys.path.insert(0, ROOT)
+    sys.path.insert(0, os.path.dirname(__file__))
+
+    from werkzeug.serving import make_server
+    from server.db import init_db
+    from server import mqtt_client
+    from server.app import app
+    from server.broker import get_broker
+    import fleet_sim
+    import loadgen
+
+    init_db()
+    mqtt_client.get_client()
+    httpd = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{httpd.server_port}"
+
+    args = fleet_sim.build_parser().parse_args(sim_argv)
+    nodes, cams = fleet_sim.run(args, client_factory=get_broker().client)
+    print(f"[bench] server {base}  db {os.environ['DB_PATH']}  {len(nodes)} node(s) + {len(cams)} camera(s)")
+
+    rc = loadgen.main(['--base', base] + load_argv)
+    for n in nodes:
+        print(f"[sim] node{n.node_id}: {n.stats}")
+    for c in cams:
+        print(f"[sim] vision{c.node_id}: {c.stats}")
+    httpd.shutdown()
+    return rc
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+"""Virtual NodeMCU fleet (+ vision camera) speaking the protocol in ino/format.txt.
+
+    python tools/fleet_sim.py --nodes 1,2 --proc "normal:3,0.5" --fail-rate 0.02 --vision 2
+
+Every virtual node:
+  * publishes disp/state/{id} {"online":1} (retained) on connect, then the
+    combined {"online":1,"ready":r,"uptime":s} heartbeat every --heartbeat seconds
+  * on disp/cmd/{id}: ignores it while busy (like the hardware), otherwise sets
+    ready=0, acks on disp/ack/{id}, "works" for a sampled processing time and
+    publishes disp/evt/{id} {"queue_id","done":1,"status","room"}; then ready=1
+  * can reject acks, fail, or lose the evt entirely (stuck queue) at given rates
+
+``--vision N`` adds a simulated camera bound to node N (like ino/cam/cam.py):
+it reads the expected count from disp/cmd/N and publishes vision_complete on
+disp/evt/N after node N reports success, miscounting at --miscount-rate.
+"""
+import argparse
+import json
+import random
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+
+
+def make_sampler(spec):
+    """Parse "normal:3,0.5" | "exp:2" | "uniform:1,3" | "const:1.5" into a sampler (seconds)."""
+    kind, _, args = spec.partition(':')
+    vals = [float(x) for x in args.split(',') if x] or [1.0]
+    if kind == 'normal':
+        mu, sigma = vals[0], (vals[1] if len(vals) > 1 else vals[0] * 0.2)
+        return lambda: max(0.0, random.gauss(mu, sigma))
+    if kind == 'exp':
+        return lambda: random.expovariate(1.0 / vals[0])
+    if kind == 'uniform':
+        lo, hi = vals[0], (vals[1] if len(vals) > 1 else vals[0])
+        return lambda: random.uniform(lo, hi)
+    if kind == 'const':
+        return lambda: vals[0]
+    raise ValueError(f"unknown distribution '{spec}'")
+
+
+class VirtualNode:
+    def __init__(self, node_id, args, client_factory):
+        self.node_id = node_id
+        self.args = args
+        self.sample = make_sampler(args.proc)
+        self.ready = 1
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.stats = {'cmd': 0, 'ignored_busy': 0, 'ack_rejected': 0, 'success': 0, 'failed': 0, 'lost_evt': 0}
+        self.c = client_factory(f"sim-node{node_id}-{random.randint(0, 99999)}")
+        self.c.on_connect = self._on_connect
+        self.c.on_message = self._on_message
+        self.c.will_set(f"disp/state/{node_id}", json.dumps({"online": 0}), qos=1, retain=True)
+
+    def start(self):
+        self.c.connect(self.args.broker, self.args.port, keepalive=30)
+        self.c.loop_start()
+        threading.Thread(target=self._heartbeat_loop, daemon=True).start()
+
+    def _state(self):
+        return {"online": 1, "ready": self.ready, "uptime": int(time.time() - self.started)}
+
+    def _on_connect(self, client, userdata, flags, rc, properties=None):
+        client.publish(f"disp/state/{self.node_id}", json.dumps({"online": 1}), qos=1, retain=True)
+        client.subscribe(f"disp/cmd/{self.node_id}", qos=1)
+
+    def _heartbeat_loop(self):
+        while True:
+            with self.lock:
+                payload = self._state()
+            self.c.publish(f"disp/state/{self.node_id}", json.dumps(payload), qos=0)
+            time.sleep(self.args.heartbeat)
+
+    def _on_message(self, client, userdata, msg):
+        try:
+            cmd = json.loads(msg.payload.decode())
+        except Exception:
+            return
+        qid = cmd.get('queue_id')
+        if qid is None:
+            return
+        with self.lock:
+            self.stats['cmd'] += 1
+            if not self.ready:
+                self.stats['ignored_busy'] += 1
+                return
+            if random.random() < self.args.reject_rate:
+                self.stats['ack_rejected'] += 1
+                client.publish(f"disp/ack/{self.node_id}", json.dumps({"queue_id": qid, "accepted": 0}), qos=1)
+                return
+            self.ready = 0
+        client.publish(f"disp/ack/{self.node_id}", json.dumps({"queue_id": qid, "accepted": 1}), qos=1)
+        threading.Timer(self.sample(), self._finish, args=(qid, cmd.get('target_room'))).start()
+
+    def _finish(self, qid, room):
+        if random.random() < self.args.lose_rate:
+            with self.lock:
+                self.stats['lost_evt'] += 1
+            # evt never arrives; node becomes ready again after a while (queue stays in_progress)
+        else:
+            status = 'failed' if random.random() < self.args.fail_rate else 'success'
+            with self.lock:
+                self.stats[status] += 1
+            self.c.publish(f"disp/evt/{self.node_id}",
+                           json.dumps({"queue_id": qid, "done": 1, "status": status, "room": room}), qos=1)
+        time.sleep(self.args.post_delay)
+        with self.lock:
+            self.ready = 1
+            payload = self._state()
+        self.c.publish(f"disp/state/{self.node_id}", json.dumps(payload), qos=0)
+
+
+class VirtualCamera:
+    def __init__(self, node_id, args, client_factory):
+        self.node_id = node_id
+        self.args = args
+        self.expected = {}
+        self.sent = set()
+        self.stats = {'vision_complete': 0, 'miscount': 0}
+        self.c = client_factory(f"sim-vision{node_id}-{random.randint(0, 99999)}")
+        self.c.on_connect = lambda c, u, f, rc, p=None: (c.subscribe(f"disp/cmd/{node_id}", qos=1),
+                                                         c.subscribe(f"disp/evt/{node_id}", qos=1))
+        self.c.on_message = self._on_message
+
+    def start(self):
+        self.c.connect(self.args.broker, self.args.port, keepalive=30)
+        self.c.loop_start()
+
+    def _on_message(self, client, userdata, msg):
+        try:
+            p = json.loads(msg.payload.decode())
+        except Exception:
+            return
+        qid = p.get('queue_id')
+        if msg.topic.startswith('disp/cmd/'):
+            self.expected[qid] = sum(int(it.get('quantity') or 0) for it in p.get('items') or [])
+            return
+        if p.get('done') == 1 and (p.get('status') or '').lower() == 'success' and qid not in self.sent:
+            self.sent.add(qid)
+            exp = self.expected.pop(qid, 0)
+            got = exp
+            if random.random() < self.args.miscount_rate:
+                got = max(0, exp + random.choice((-1, 1)))
+                self.stats['miscount'] += 1
+            self.stats['vision_complete'] += 1
+            threading.Timer(self.args.vision_delay, lambda: self.c.publish(
+                f"disp/evt/{self.node_id}",
+                json.dumps({"queue_id": qid, "done": 1, "status": "vision_complete",
+                            "count_detected": got, "expected": exp}), qos=1)).start()
+
+
+def build_parser():
+    ap = argparse.ArgumentParser(description='Virtual NodeMCU fleet simulator')
+    ap.add_argument('--broker', default='127.0.0.1')
+    ap.add_argument('--port', type=int, default=1883)
+    ap.add_argument('--nodes', default='1,2', help='comma separated node ids')
+    ap.add_argument('--proc', default='normal:2,0.3', help='processing time distribution (normal|exp|uniform|const)')
+    ap.add_argument('--heartbeat', type=float, default=1.0, help='state heartbeat period (s)')
+    ap.add_argument('--post-delay', type=float, default=0.2, help='delay between evt and ready=1 (s)')
+    ap.add_argument('--fail-rate', type=float, default=0.0)
+    ap.add_argument('--reject-rate', type=float, default=0.0)
+    ap.add_argument('--lose-rate', type=float, default=0.0, help='probability the evt is never sent')
+    ap.add_argument('--vision', default='', help='comma separated node ids that have a simulated camera')
+    ap.add_argument('--vision-delay', type=float, default=0.5)
+    ap.add_argument('--miscount-rate', type=float, default=0.0)
+    ap.add_argument('--duration', type=float, default=0, help='seconds to run (0 = until Ctrl-C)')
+    return ap
+
+
+def run(args, client_factory=None):
+    """Start the fleet; returns (nodes, cameras). ``client_factory(client_id)`` defaults to paho."""
+    client_factory = client_factory or (lambda cid: mqtt.Client(client_id=cid, clean_session=True))
+    nodes = [VirtualNode(int(n), args, client_factory) for n in args.nodes.split(',') if n.strip()]
+    cams = [VirtualCamera(int(n), args, client_factory) for n in args.vision.split(',') if n.strip()]
+    for x in nodes + cams:
+        x.start()
+    return nodes, cams
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    nodes, cams = run(args)
+    print(f"[sim] {len(nodes)} node(s) + {len(cams)} camera(s) on {args.broker}:{args.port}")
+    t0 = time.time()
+    try:
+        while not args.duration or time.time() - t0 < args.duration:
+            time.sleep(0.5)
+    except KeyboardInterrupt:
+        pass
+    for n in nodes:
+        print(f"[sim] node{n.node_id}: {n.stats}")
+    for c in cams:
+        print(f"[sim] vision{c.node_id}: {c.stats}")
+
+
+if __name__ == '__main__':
+    main()
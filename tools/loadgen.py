@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""End-to-end load test: queue intake + dashboard polling against a running server.
+
+    python tools/fleet_sim.py --proc const:0.5 --vision 2 &   # or any real/virtual nodes
+    python tools/loadgen.py --rate 2 --duration 60 --dashboards 5
+
+Submits POST /api/queues at --rate per second, keeps --dashboards clients polling
+GET /api/dashboard, then waits up to --drain seconds for every submitted queue
+to finish. End-to-end latency comes from /api/queues/<id>/trace (created ->
+served/failed). Prints throughput, latency percentiles and the stuck-queue count.
+"""
+import argparse
+import random
+import threading
+import time
+
+import requests
+
+
+def pct(vals, p):
+    if not vals:
+        return None
+    vals = sorted(vals)
+    return vals[min(len(vals) - 1, int(round(p / 100.0 * (len(vals) - 1))))]
+
+
+def fmt_ms(v):
+    return '-' if v is None else f"{v * 1000:8.1f}"
+
+
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.http = {}     # name -> [seconds]
+        self.errors = {}   # name -> count
+
+    def call(self, name, fn):
+        t0 = time.perf_counter()
+        try:
+            r = fn()
+            ok = r.status_code < 400
+        except Exception:
+            r, ok = None, False
+        dt = time.perf_counter() - t0
+        with self.lock:
+            self.http.setdefault(name, []).append(dt)
+            if not ok:
+                self.errors[name] = self.errors.get(name, 0) + 1
+        return r if ok else None
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description='Queue intake / dashboard load generator')
+    ap.add_argument('--base', default='http://127.0.0.1:5000')
+    ap.add_argument('--rate', type=float, default=1.0, help='queues per second')
+    ap.add_argument('--duration', type=float, default=30.0, help='intake duration (s)')
+    ap.add_argument('--dashboards', type=int, default=2, help='concurrent dashboard pollers')
+    ap.add_argument('--poll', type=float, default=1.0, help='dashboard poll period per client (s)')
+    ap.add_argument('--drain', type=float, default=120.0, help='max seconds to wait for completion')
+    ap.add_argument('--pills', default='1,2,3,4', help='pill ids to pick from')
+    args = ap.parse_args(argv)
+
+    s = requests.Session()
+    rec = Recorder()
+    pid = s.post(f"{args.base}/api/patients", json={"name": f"loadgen {int(time.time())}"}, timeout=5).json()['id']
+    pills = [int(x) for x in args.pills.split(',')]
+    stop = threading.Event()
+
+    def dashboard_poller():
+        ds = requests.Session()
+        while not stop.is_set():
+            rec.call('GET /api/dashboard', lambda: ds.get(f"{args.base}/api/dashboard", timeout=10))
+            stop.wait(args.poll)
+
+    pollers = [threading.Thread(target=dashboard_poller, daemon=True) for _ in range(args.dashboards)]
+    for t in pollers:
+        t.start()
+
+    submitted = []
+    t_start = time.time()
+    next_at = t_start
+    while time.time() - t_start < args.duration:
+        items = [{"pill_id": p, "quantity": random.randint(1, 3)} for p in random.sample(pills, random.randint(1, 2))]
+        r = rec.call('POST /api/queues', lambda: s.post(f"{args.base}/api/queues",
+                                                         json={"patient_id": pid, "items": items}, timeout=10))
+        if r is not None:
+            submitted.append(r.json()['queue_id'])
+        next_at += 1.0 / args.rate
+        time.sleep(max(0.0, next_at - time.time()))
+    intake_end = time.time()
+
+    # drain: wait until every submitted queue is served/failed (or give up)
+    done = {}  # qid -> (final stage, seconds created->final)
+    deadline = intake_end + args.drain
+    while len(done) < len(submitted) and time.time() < deadline:
+        for qid in submitted:
+            if qid in done:
+                continue
+            r = rec.call('GET /api/queues/<id>/trace', lambda: s.get(f"{args.base}/api/queues/{qid}/trace", timeout=5))
+            if r is None:
+                continue
+            spans = r.json().get('spans', [])
+            final = [sp for sp in spans if sp['stage'] in ('served', 'failed')]
+            if final:
+                done[qid] = (final[-1]['stage'], final[-1]['since_created_ms'] / 1000.0)
+        time.sleep(0.5)
+    finished = time.time()
+    stop.set()
+
+    served = [d for st, d in done.values() if st == 'served']
+    failed = [d for st, d in done.values() if st == 'failed']
+    stuck = len(submitted) - len(done)
+    e2e = served + failed
+    print()
+    print(f"submitted {len(submitted)} queues in {intake_end - t_start:.1f}s, "
+          f"completed {len(done)} ({len(served)} served, {len(failed)} failed), stuck {stuck}")
+    print(f"throughput {len(done) / max(1e-9, finished - t_start):.3f} queues/s")
+    print(f"end-to-end ms   p50 {fmt_ms(pct(e2e, 50))}  p95 {fmt_ms(pct(e2e, 95))}  p99 {fmt_ms(pct(e2e, 99))}")
+    print()
+    print(f"{'http endpoint':30} {'n':>6} {'err':>5} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for name, vals in sorted(rec.http.items()):
+        print(f"{name:30} {len(vals):6d} {rec.errors.get(name, 0):5d} "
+              f"{fmt_ms(pct(vals, 50))} {fmt_ms(pct(vals, 95))} {fmt_ms(pct(vals, 99))}")
+    return 0 if stuck == 0 else 1
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())